@@ -0,0 +1,62 @@
+"""
+Compares the cell by cell eCRF post-treatments (DataFrame.applymap) and their
+column-wise implementations (fhir_api.fhir2ecrf.export_tools) on synthetic
+wide frames shaped like the query results: cells holding the lists of values
+of the selected elements, and NaN for the patients without joined resources.
+
+Usage (from the fhir-api directory): python -m benchmarks.ecrf_treatments
+"""
+import random
+import timeit
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from fhir_api.fhir2ecrf.export_tools import (
+    treatment_bool,
+    treatment_bool_column,
+    treatment_first,
+    treatment_first_column,
+    treatment_list,
+    treatment_list_column,
+)
+
+TREATMENTS = {
+    "first": (treatment_first, treatment_first_column),
+    "bool": (treatment_bool, treatment_bool_column),
+    "list": (treatment_list, treatment_list_column),
+}
+
+
+def make_cell():
+    if random.random() < 0.3:
+        return np.nan
+    values = [random.choice([round(random.random() * 100, 1), "Doe", np.nan])]
+    return values * random.randint(1, 3)
+
+
+def make_frame(rows, columns):
+    return pd.DataFrame({f"column_{i}": [make_cell() for _ in range(rows)] for i in range(columns)})
+
+
+def bench(name, f, number):
+    seconds = min(timeit.repeat(f, number=number, repeat=3)) / number
+    print(f"  {name:<30} {seconds * 1000:10.3f} ms")
+    return seconds
+
+
+def main():
+    for rows, columns in ((1000, 20), (10000, 50), (50000, 100)):
+        df = make_frame(rows, columns)
+        number = max(100000 // (rows * columns) * 10, 1)
+        print(f"Frame of {rows} rows and {columns} columns")
+        for name, (cell_treatment, column_treatment) in TREATMENTS.items():
+            assert_frame_equal(df.applymap(cell_treatment), df.apply(column_treatment))
+            applymap = bench(f"{name}: applymap", lambda: df.applymap(cell_treatment), number)
+            vectorized = bench(f"{name}: column-wise", lambda: df.apply(column_treatment), number)
+            print(f"  speedup: x{applymap / vectorized:.1f}")
+
+
+if __name__ == "__main__":
+    main()
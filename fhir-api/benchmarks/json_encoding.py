@@ -0,0 +1,82 @@
+"""
+Compares the stdlib JSON encoder (through flask) and orjson
+(fhir_api.serialization) on search bundles and FHIR models of realistic sizes.
+
+Usage (from the fhir-api directory): python -m benchmarks.json_encoding
+"""
+import random
+import timeit
+import uuid
+
+from fhir.resources.patient import Patient
+from flask import Flask
+from flask import json as flask_json
+
+from fhir_api.serialization import dumps
+
+
+def make_patient():
+    return {
+        "resourceType": "Patient",
+        "id": str(uuid.uuid4()),
+        "meta": {"lastUpdated": "2021-01-15T10:00:00+00:00", "tag": [{"code": "abc"}]},
+        "identifier": [{"system": "http://hospital/ipp", "value": str(random.randint(0, 10**9))}],
+        "name": [{"family": "Doe", "given": ["John", "Jack"]}],
+        "gender": random.choice(["male", "female"]),
+        "birthDate": "1970-01-01",
+        "address": [{"line": ["1 rue de la Paix"], "city": "Paris", "postalCode": "75001"}],
+    }
+
+
+def make_observation(patient_id):
+    return {
+        "resourceType": "Observation",
+        "id": str(uuid.uuid4()),
+        "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "2345-7"}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "effectiveDateTime": "2021-01-15T10:00:00+00:00",
+        "valueQuantity": {"value": random.random() * 10, "unit": "mmol/L"},
+    }
+
+
+def make_bundle(size):
+    entries = []
+    for _ in range(size // 5):
+        patient = make_patient()
+        entries.append({"resource": patient, "search": {"mode": "match"}})
+        for _ in range(4):
+            entries.append(
+                {"resource": make_observation(patient["id"]), "search": {"mode": "match"}}
+            )
+    return {"resourceType": "Bundle", "type": "searchset", "total": size, "entry": entries}
+
+
+def bench(name, f, number):
+    seconds = min(timeit.repeat(f, number=number, repeat=5)) / number
+    print(f"  {name:<30} {seconds * 1000:10.3f} ms")
+    return seconds
+
+
+def main():
+    app = Flask(__name__)
+    with app.app_context():
+        for size in (10, 100, 1000, 10000):
+            bundle = make_bundle(size)
+            number = max(10000 // size, 3)
+            print(f"Bundle of {size} entries ({len(dumps(bundle)) / 1e6:.3f} MB)")
+            stdlib = bench("flask.json.dumps (stdlib)", lambda: flask_json.dumps(bundle), number)
+            fast = bench("serialization.dumps (orjson)", lambda: dumps(bundle), number)
+            print(f"  speedup: x{stdlib / fast:.1f}")
+
+        patient = Patient.parse_obj(make_patient())
+        print("Patient model")
+        stdlib = bench(
+            "flask.json.dumps(model.dict())", lambda: flask_json.dumps(patient.dict()), 1000
+        )
+        fast = bench("serialization.dumps(model)", lambda: dumps(patient), 1000)
+        print(f"  speedup: x{stdlib / fast:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,4 +6,8 @@ set -e
 export UWSGI_PROCESSES=${UWSGI_PROCESSES:-5}
 export UWSGI_THREADS=${UWSGI_THREADS:-4}
 
+# The documents index is updated every 10 minutes (see uwsgi.ini): a new
+# deployment builds it at once, in the background.
+flask index-documents --if-empty &
+
 uwsgi --ini uwsgi.ini
\ No newline at end of file
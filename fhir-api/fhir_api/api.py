@@ -1,21 +1,31 @@
-import logging
 import os
 
 from fhir.resources.operationoutcome import OperationOutcome
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, request, send_from_directory, stream_with_context, url_for
 from flask_cors import CORS
+from werkzeug.urls import url_encode
 
+from fhir_api import cache, change_stream, changes, ecrf, export, jobs, outbox, settings, streaming
 from fhir_api.authentication import auth_required
+from fhir_api.batch import BatchProcessor
+from fhir_api.bundle import BundleLoader, iter_bundle_entries
 from fhir_api.db import get_store
-from fhir_api.errors import AuthenticationError, BadRequest
+from fhir_api.errors import AuthenticationError, BadRequest, NotFound
 from fhir_api.models import resources_models
-
-# from fhir2ecrf import FHIR2eCRF
+from fhir_api.models.base import resource_cache
+from fhir_api.serialization import jsonify
+
+# serialized search results, invalidated by the writes of the searched types
+search_cache = cache.SearchCache(
+    "searches",
+    max_items=settings.SEARCH_CACHE_SIZE,
+    max_bytes=settings.SEARCH_CACHE_MAX_BYTES,
+    max_entry_bytes=settings.SEARCH_CACHE_MAX_ENTRY_BYTES,
+    ttl=settings.SEARCH_CACHE_TTL,
+)
 
 # from arkhn_arx import Anonymizer
 
-# FHIR_API_URL = os.getenv("FHIR_API_URL")
-# FHIR_API_TOKEN = os.getenv("FHIR_API_TOKEN")
 # ARX_HOST = os.getenv("ARX_HOST")
 # ARX_PORT = os.getenv("ARX_PORT")
 
@@ -24,10 +34,21 @@ api = Blueprint("api", __name__, static_folder=".")
 # "Allow-Control-Allow-Origin" HTTP header
 CORS(api)
 
-# fhir2ecrf = FHIR2eCRF(FHIR_API_TOKEN, f"{FHIR_API_URL}/")
 # anonymizer = Anonymizer(f"{ARX_HOST}:{ARX_PORT}")
 
 
+def prefers_async():
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+def accepted(job_id):
+    """Returns the response of an asynchronous request (see
+    https://www.hl7.org/fhir/async.html)"""
+    response = Response(status=202)
+    response.headers["Content-Location"] = url_for("api.job_status", job_id=job_id, _external=True)
+    return response
+
+
 @api.route("/<resource_type>/<id>", methods=["GET"])
 @auth_required
 def read(resource_type, id):
@@ -36,7 +57,25 @@ def read(resource_type, id):
 
     model = resources_models[resource_type](id=id)
 
-    return model.read().json()
+    # the generation of the resource is renewed by every write, the version
+    # check does not need to read the store
+    generation = resource_cache.generation(resource_type, id)
+    etag = str(generation)
+    if changes.is_not_modified(etag, generation):
+        # unknown ids have a generation too: check that the resource exists,
+        # from the resource cache if it is warm
+        model.read_raw()
+        return changes.not_modified(etag, generation)
+
+    # the stored document is sent as is, its model is only built on request
+    if request.args.get("_validate") == "true":
+        res = model.read()
+        if isinstance(res, OperationOutcome):
+            return jsonify(res), 404
+        response = model.json()
+    else:
+        response = Response(model.read_raw(), mimetype="application/json")
+    return changes.set_validators(response, etag, generation)
 
 
 @api.route("/<resource_type>/<id>", methods=["PUT"])
@@ -47,7 +86,9 @@ def update(resource_type, id):
 
     resource_data = request.get_json(force=True)
     model = resources_models[resource_type](id=id)
-    return model.update(resource_data).json()
+    response = model.update(resource_data).json()
+    outbox.wait_requested(model.outbox_entries)
+    return response
 
 
 @api.route("/<resource_type>/<id>", methods=["PATCH"])
@@ -58,7 +99,9 @@ def patch(resource_type, id):
 
     patch_data = request.get_json(force=True)
     model = resources_models[resource_type](id=id)
-    return model.patch(patch_data).json()
+    response = model.patch(patch_data).json()
+    outbox.wait_requested(model.outbox_entries)
+    return response
 
 
 @api.route("/<resource_type>", methods=["POST"])
@@ -70,7 +113,9 @@ def create(resource_type):
     resource_data = request.get_json(force=True)
 
     model = resources_models[resource_type](resource=resource_data)
-    return model.create().json()
+    response = model.create().json()
+    outbox.wait_requested(model.outbox_entries)
+    return response
 
 
 @api.route("/<resource_type>/<id>", methods=["DELETE"])
@@ -80,16 +125,81 @@ def delete(resource_type, id):
         raise OperationOutcome(f"Unknown resource type: {resource_type}")
 
     model = resources_models[resource_type](id=id)
-    return model.delete().json()
+    response = model.delete().json()
+    outbox.wait_requested(model.outbox_entries)
+    return response
 
 
 @api.route("/", methods=["GET"])
 @api.route("/<resource_type>", methods=["GET"])
 @auth_required
 def search(resource_type=None):
-    return get_store().search(
-        resource_type, query_string=request.query_string.decode("utf-8"), as_json=True
-    )
+    query_string = request.query_string.decode("utf-8")
+    output_format = request.args.get("_format") or request.accept_mimetypes.best
+    if "_format" in request.args:
+        query_string = url_encode(
+            [(key, value) for key, value in request.args.items(multi=True) if key != "_format"]
+        )
+
+    search_documents = getattr(resources_models.get(resource_type), "search_documents", None)
+    if "$search" in request.args and search_documents:
+        return keyword_search(search_documents, output_format)
+
+    generations = changes.search_generations(resource_type, request.args)
+    etag = changes.search_etag(resource_type, request.args, generations)
+    if changes.is_not_modified(etag, max(generations)):
+        return changes.not_modified(etag, max(generations))
+
+    # the generations are read before the search: the results of a search run
+    # during a write are cached under an outdated key
+    key = (etag, output_format)
+    cached = search_cache.get(resource_type, key)
+    if cached is not None:
+        mimetype, data = cached
+        return changes.set_validators(Response(data, mimetype=mimetype), etag, max(generations))
+
+    bundle = get_store().search(resource_type, query_string=query_string, as_json=True)
+    if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
+        return bundle
+    chunks, mimetype = streaming.serialize_bundle(bundle, output_format=output_format)
+    chunks = search_cache.caching(key, chunks, mimetype)
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    return changes.set_validators(response, etag, max(generations))
+
+
+def int_arg(name, default):
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise BadRequest(f"{name} must be a positive integer")
+    return value
+
+
+def keyword_search(search_documents, output_format):
+    """Returns a page of the results of a $search operation. The page token
+    of the next page is given by the `next` link of the Bundle."""
+    count = int_arg("_count", settings.DOCUMENTS_SEARCH_COUNT)
+    offset = int_arg("_page_token", 0)
+    bundle = search_documents(request.args["$search"], count=count, offset=offset)
+
+    args = [(key, value) for key, value in request.args.items(multi=True) if key != "_page_token"]
+    bundle["link"] = [{"relation": "self", "url": request.url}]
+    if count and offset + count < bundle["total"]:
+        next_url = f"{request.base_url}?{url_encode(args + [('_page_token', offset + count)])}"
+        bundle["link"].append({"relation": "next", "url": next_url})
+    return streaming.stream_bundle(bundle, output_format=output_format)
+
+
+@api.route("/", methods=["POST"])
+@auth_required
+def batch():
+    bundle = request.get_json(force=True)
+    processor = BatchProcessor(get_store(), resources_models)
+    response, status = processor.process(bundle)
+    outbox.wait_requested(processor.outbox_entries)
+    return jsonify(response), status
 
 
 @api.route("/list-collections", methods=["GET"])
@@ -101,20 +211,102 @@ def list_collections():
 @api.route("/upload-bundle", methods=["POST"])
 @auth_required
 def upload_bundle():
-    # TODO methodology to avoid/process huge bundles
-    bundle_data = request.get_json(force=True)
+    if prefers_async():
+        job_id = jobs.create_job("upload-bundle", request_url=request.url)
+        jobs.save_upload(job_id, request.stream)
+        jobs.submit(job_id)
+        return accepted(job_id)
 
-    if "resourceType" not in bundle_data or bundle_data["resourceType"] != "Bundle":
-        raise OperationOutcome("input must be a FHIR Bundle resource")
+    # the bundle is parsed incrementally from the request body and its entries
+    # are written by batches, so that huge bundles are never loaded at once.
+    loader = BundleLoader(get_store(), resources_models)
+    loader.load(iter_bundle_entries(request.stream))
+    return jsonify(loader.operation_outcome())
+
+
+@api.route("/job-status/<job_id>", methods=["GET"])
+@auth_required
+def job_status(job_id):
+    jobs.fail_stale_jobs()
+    job = jobs.get_job(job_id)
+    if not job:
+        raise NotFound(f"Unknown job: {job_id}")
+
+    if job["status"] in [jobs.QUEUED, jobs.RUNNING]:
+        response = jsonify(jobs.job_status(job))
+        response.status_code = 202
+    elif job["status"] == jobs.FAILED:
+        operation_outcome = OperationOutcome(
+            issue=[{"severity": "error", "code": "exception", "diagnostics": job["error"]}]
+        )
+        response = jsonify(operation_outcome.dict())
+        response.status_code = 500
+    elif job["status"] == jobs.COMPLETED:
+        # a completed job answers what the original request would have
+        response = jsonify(job["result"])
+    else:
+        response = jsonify(jobs.job_status(job))
+
+    progress = [f"{key}: {value}" for key, value in job["progress"].items()]
+    response.headers["X-Progress"] = ", ".join(progress) or job["status"]
+    return response
+
+
+@api.route("/job-status/<job_id>", methods=["DELETE"])
+@auth_required
+def cancel_job(job_id):
+    """Cancels a running job or deletes a finished one and its files."""
+    if not jobs.cancel_job(job_id) and not jobs.delete_job(job_id):
+        raise NotFound(f"Unknown job: {job_id}")
+    return Response(status=202)
+
+
+@api.route("/$export", methods=["GET"])
+@api.route("/Patient/$export", methods=["GET"], defaults={"level": export.PATIENT})
+@api.route("/Group/<group_id>/$export", methods=["GET"], defaults={"level": export.GROUP})
+@auth_required
+def bulk_export(level=export.SYSTEM, group_id=None):
+    output_format = request.args.get("_outputFormat", "application/fhir+ndjson")
+    if output_format not in ["application/fhir+ndjson", "application/ndjson", "ndjson"]:
+        raise BadRequest(f"Unsupported output format: {output_format}")
+    if level == export.GROUP:
+        # raises NotFound at kickoff rather than failing the job
+        export.get_group_patients(group_id)
+
+    job_id = jobs.create_job(
+        "export",
+        request_url=request.url,
+        kickoff_url=request.url,
+        level=level,
+        group_id=group_id,
+        types=export.parse_types(request.args.get("_type"), resources_models),
+        since=export.parse_since(request.args.get("_since")),
+        files_url=f"{request.url_root}export-file",
+    )
+    jobs.submit(job_id)
+    return accepted(job_id)
+
+
+@api.route("/export-file/<job_id>/<filename>", methods=["GET"])
+@auth_required
+def export_file(job_id, filename):
+    directory = export.get_output_directory(job_id, filename)
+    if directory is None:
+        raise NotFound(f"Unknown export file: {job_id}/{filename}")
+    return send_from_directory(directory, filename, mimetype="application/fhir+ndjson")
+
+
+@api.route("/$ecrf", methods=["POST"])
+@auth_required
+def ecrf_export():
+    output_format = ecrf.output_format(request.args.get("_format"), request.accept_mimetypes)
+    return ecrf.export(request.get_json(force=True), output_format)
 
-    store = get_store()
-    try:
-        store.upload_bundle(bundle_data)
-    except Exception as e:
-        logging.error(f"Error while uploading bundle: {e}")
-        return jsonify(success=False)
 
-    return jsonify(success=True)
+@api.route("/stats", methods=["GET"])
+@auth_required
+def stats():
+    return jsonify(pid=os.getpid(), caches=cache.get_stats(), changes=change_stream.get_counters())
 
 
 @api.route("/metadata", methods=["GET"])
@@ -131,6 +323,14 @@ def handle_bad_request(e):
     return jsonify(operation_outcome.dict()), 400
 
 
+@api.errorhandler(NotFound)
+def handle_not_found(e):
+    operation_outcome = OperationOutcome(
+        issue=[{"severity": "error", "code": "not-found", "diagnostics": str(e)}]
+    )
+    return jsonify(operation_outcome.dict()), 404
+
+
 @api.errorhandler(AuthenticationError)
 def handle_not_authorized(e):
     return str(e), 401
@@ -1,23 +1,26 @@
-import glob
 import logging
+import os
 
 import click
-from bson import ObjectId
 from fhirpath.enums import FHIR_VERSION
-from flask import Flask, json
-
-from fhir_api import db, models
+from flask import Flask
+
+from fhir_api import (  # noqa: F401 (registers the jobs)
+    change_stream,
+    db,
+    documents,
+    jobs,
+    loader,
+    models,
+    outbox,
+    reindex,
+    settings,
+)
 from fhir_api.api import api
+from fhir_api.serialization import JSONEncoder
 from fhir_api.utils import write_es_mappings
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, ObjectId):
-            return str(o)
-        return json.JSONEncoder.default(self, o)
-
-
 def create_app():
     app = Flask(__name__)
     app.register_blueprint(api)
@@ -28,6 +31,14 @@ def create_app():
     # initialize models
     models.init()
 
+    if settings.ES_WRITE_BEHIND and not (
+        settings.CHANGE_STREAM_ENABLED and settings.CHANGE_STREAM_ES_SYNC
+    ):
+        logging.warning(
+            "The writes made without the API are not indexed in write-behind mode, "
+            "unless CHANGE_STREAM_ENABLED and CHANGE_STREAM_ES_SYNC are set"
+        )
+
     return app
 
 
@@ -37,6 +48,8 @@ app = create_app()
 @app.cli.command()
 def bootstrap():
     """Bootstrap mongo collections and elasticsearch indices"""
+    jobs.create_indexes()
+
     store = db.get_store()
     if not store.initialized:
         logging.info("Bootstrapping store...")
@@ -48,16 +61,27 @@ def bootstrap():
 
 @app.cli.command()
 @click.argument("src-dir", type=click.Path(exists=True))
-def load_defs(src_dir):
+@click.option("--workers", type=int, help="Number of processes parsing the bundles.")
+@click.option("--batch-size", type=int, help="Number of resources written at once.")
+@click.option("--force", is_flag=True, help="Load the files which have already been loaded.")
+def load_defs(src_dir, workers, batch_size, force):
     """Load FHIR definitions.
 
     SRC_DIR is a path to the definitions directory.
+    The progress of the loading can be followed with the /job-status endpoint.
     """
-    store = db.get_store()
+    job_id = jobs.create_job(
+        "load-definitions",
+        src_dir=os.path.abspath(src_dir),
+        workers=workers,
+        batch_size=batch_size,
+        force=force,
+    )
+    click.echo(f"Loading definitions (job {job_id})...")
+    jobs.run_job(job_id)
 
-    for bundle in glob.glob(f"{src_dir}/*.json"):
-        with open(bundle, "r") as raw_data:
-            store.upload_bundle(json.load(raw_data))
+    job = jobs.get_job(job_id)
+    click.echo(f"Done! ({job['status']}: {job['progress']})")
 
 
 @app.cli.command()
@@ -74,7 +98,7 @@ def disable_json_validator():
 def rebuild_es_index():
     """
     Deletes the elasticsearch index and re-creates it.
-    Warning: all the documents in the index will be lost.
+    Warning: all the documents in the index will be lost (see reindex-es).
     """
     store = db.get_store()
 
@@ -86,6 +110,87 @@ def rebuild_es_index():
     store.search_engine.create_es_index()
 
 
+@app.cli.command()
+@click.option("--es-sync", is_flag=True, help="Index the changed resources in elasticsearch.")
+def watch_changes(es_sync):
+    """
+    Processes the changes of the resources collections in the foreground,
+    resuming after the last change processed (see change_stream.py). The
+    caches of the API workers are only invalidated by the subscriber of their
+    uwsgi instance (CHANGE_STREAM_ENABLED).
+    """
+    subscriber = change_stream.Subscriber(es_sync=es_sync or None)
+    try:
+        subscriber.run()
+    except KeyboardInterrupt:
+        subscriber.stop()
+        subscriber.flush()
+    click.echo(f"Stopped. ({change_stream.get_counters()})")
+
+
+@app.cli.command()
+def flush_es_outbox():
+    """
+    Indexes the writes queued by the write-behind indexing (see outbox.py),
+    unless another process is indexing them.
+    """
+    flushed = outbox.Flusher().flush()
+    click.echo(f"Done! ({len(flushed)} writes indexed)")
+
+
+@app.cli.command()
+@click.option("--workers", type=int, help="Number of collections loaded at once.")
+@click.option("--threads", type=int, help="Number of threads indexing a collection.")
+@click.option("--chunk-size", type=int, help="Number of documents per bulk request.")
+@click.option("--restart", is_flag=True, help="Start again instead of resuming a reindex.")
+@click.option("--keep-old", is_flag=True, help="Keep the previous index after the swap.")
+def reindex_es(workers, threads, chunk_size, restart, keep_old):
+    """
+    Rebuilds the elasticsearch index from mongo in a new index, then swaps
+    the alias searched by the store to it. The searches keep working during
+    the reindex. An interrupted reindex is resumed.
+    """
+    job_id = jobs.create_job(
+        "reindex-es",
+        workers=workers,
+        threads=threads,
+        chunk_size=chunk_size,
+        restart=restart,
+        keep_old=keep_old,
+    )
+    click.echo(f"Reindexing elasticsearch (job {job_id})...")
+    jobs.run_job(job_id)
+
+    job = jobs.get_job(job_id)
+    click.echo(f"Done! ({job['status']}: {job['progress']})")
+
+
+@app.cli.command()
+@click.option("--workers", type=int, help="Number of processes extracting the documents text.")
+@click.option("--rebuild", is_flag=True, help="Index all the documents again.")
+@click.option("--if-empty", is_flag=True, help="Only index the documents if the index is empty.")
+def index_documents(workers, rebuild, if_empty):
+    """
+    Indexes the documents (PDF files) of DOCUMENTS_PATH for the
+    DocumentReference $search operation.
+    The texts already extracted are reused, even with --rebuild.
+    """
+    if if_empty and not documents.get_document_index().is_empty():
+        click.echo("The documents index is not empty, skipping.")
+        return
+    job_id = jobs.create_job(
+        "index-documents",
+        documents_path=settings.DOCUMENTS_PATH,
+        workers=workers,
+        rebuild=rebuild,
+    )
+    click.echo(f"Indexing documents of {settings.DOCUMENTS_PATH} (job {job_id})...")
+    jobs.run_job(job_id)
+
+    job = jobs.get_job(job_id)
+    click.echo(f"Done! ({job['status']}: {job['progress']})")
+
+
 @app.cli.command()
 @click.argument("dest-dir", type=click.Path(exists=True))
 def generate_es_mappings(dest_dir):
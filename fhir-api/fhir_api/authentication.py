@@ -1,20 +1,214 @@
+import hashlib
+import logging
+import threading
+import time
 from functools import wraps
 
+import jwt
 import requests
 from flask import request
+from requests.adapters import HTTPAdapter
 
 from fhir_api import settings
+from fhir_api.cache import SharedCache
 from fhir_api.errors import AuthenticationError
 
+logger = logging.getLogger(__name__)
 
-def validate_token(token, scope=None):
+session = None
+token_cache = SharedCache(
+    "auth-tokens", max_items=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL
+)
+
+
+def reset_session():
+    global session
+    session = None
+
+
+def get_session():
+    """
+    get_session returns a requests session keeping its connections
+    to the token introspection endpoint alive
+    """
+    global session
+    if not session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=settings.TOKEN_INTROSPECTION_POOL_SIZE
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
+
+
+def introspect_token(token, scope=None):
     payload = {"token": token}
     if scope is not None:
         payload["scope"] = scope
 
-    response = requests.post(settings.TOKEN_INTROSPECTION_URL, data=payload)
+    response = get_session().post(
+        settings.TOKEN_INTROSPECTION_URL,
+        data=payload,
+        timeout=settings.TOKEN_INTROSPECTION_TIMEOUT,
+    )
+
+    return response.json()
+
+
+def get_cache_ttl(validation):
+    """Computes how long an introspection result can be cached.
+
+    Rejected tokens are cached for a short time only, active tokens are cached
+    until they expire (if the introspection response tells when).
+    """
+    if not validation.get("active"):
+        return settings.TOKEN_CACHE_NEGATIVE_TTL
+
+    ttl = settings.TOKEN_CACHE_TTL
+    if validation.get("exp") is not None:
+        ttl = min(ttl, validation["exp"] - time.time())
+    return ttl
+
+
+class JWKSKeys:
+    """Signing keys published by the authorization server.
+
+    The key set is fetched on first use, then refreshed in a background thread
+    when a token is signed with an unknown key id (the keys have been rotated).
+    Fetches are rate-limited to one every JWKS_MIN_REFRESH_INTERVAL seconds,
+    failed ones included: until the key set is fetched, the tokens are
+    validated by the introspection endpoint.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.keys = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._last_refresh = None
+
+    def get(self, kid):
+        """Returns the key identified by kid, or None if it is unknown."""
+        if self.keys is None and not self._load():
+            return None
+
+        if kid is None and len(self.keys) == 1:
+            return next(iter(self.keys.values()))
+        key = self.keys.get(kid)
+        if key is None:
+            self.refresh_in_background()
+        return key
+
+    def refresh(self):
+        self._last_refresh = time.monotonic()
+        if not self.url:
+            raise ValueError("JWKS_URL is not set")
+        jwks = get_session().get(self.url, timeout=settings.TOKEN_INTROSPECTION_TIMEOUT).json()
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK(jwk).key
+            except jwt.PyJWTError as e:
+                logger.warning(f"Ignoring JWKS key {jwk.get('kid')}: {e}")
+        self.keys = keys
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or self._recently_refreshed():
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _load(self) -> bool:
+        """Fetches the key set on first use, returns whether it is known."""
+        with self._lock:
+            if self.keys is not None:
+                return True
+            if self._recently_refreshed():
+                return False
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error while fetching the JWKS: {e}")
+                return False
+        return True
+
+    def _recently_refreshed(self):
+        if self._last_refresh is None:
+            return False
+        return time.monotonic() - self._last_refresh < settings.JWKS_MIN_REFRESH_INTERVAL
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Error while refreshing the JWKS: {e}")
+        finally:
+            self._refreshing = False
+
+
+jwks_keys = JWKSKeys(settings.JWKS_URL)
+
+
+def verify_jwt(token, scope=None):
+    """Verifies a JWT signature, expiration, audience and scope in-process.
+
+    Returns None when the token cannot be verified locally: it is not a JWT
+    (opaque token) or it is signed with a key which is not known yet.
+    """
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.DecodeError:
+        return None
+
+    key = jwks_keys.get(header.get("kid"))
+    if key is None:
+        return None
+
+    try:
+        claims = jwt.decode(
+            token,
+            key,
+            algorithms=settings.TOKEN_ALGORITHMS,
+            audience=settings.TOKEN_AUDIENCE,
+            issuer=settings.TOKEN_ISSUER,
+            options={"require": ["exp"], "verify_aud": settings.TOKEN_AUDIENCE is not None},
+        )
+    except jwt.InvalidTokenError as e:
+        logger.info(f"Invalid JWT: {e}")
+        return False
+
+    if scope is not None and scope not in claims.get("scope", "").split():
+        return False
+    return True
+
+
+def validate_token(token, scope=None):
+    if settings.TOKEN_VALIDATION_MODE == "jwt":
+        valid = verify_jwt(token, scope=scope)
+        if valid is not None:
+            return valid
+
+    return validate_token_introspection(token, scope=scope)
+
+
+def validate_token_introspection(token, scope=None):
+    # tokens are never used as cache keys as is
+    key = hashlib.sha256(f"{token}:{scope or ''}".encode()).hexdigest()
+
+    validation = token_cache.get(key)
+    if validation is None:
+        validation = introspect_token(token, scope=scope)
+        token_cache.set(
+            key,
+            {"active": validation["active"], "exp": validation.get("exp")},
+            ttl=get_cache_ttl(validation),
+        )
 
-    validation = response.json()
+    if validation.get("exp") is not None and validation["exp"] <= time.time():
+        # the cache expirations are not precise enough to rely on them only
+        return False
 
     return validation["active"]
 
@@ -29,7 +223,7 @@ def auth_required(f):
 
         token = auth_header[len(prefix) :]
 
-        if not validate_token(token):
+        if not validate_token(token, scope=settings.TOKEN_SCOPE):
             raise AuthenticationError("Failed to verify token.")
 
         return f(*args, **kwargs)
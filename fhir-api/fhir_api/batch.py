@@ -0,0 +1,269 @@
+"""
+Batch and transaction Bundles
+(see https://www.hl7.org/fhir/http.html#transaction).
+
+The entries are validated, then grouped by operation and resource type and
+written with a single bulk_write per group. Elasticsearch is synced from the
+mongo change streams (monstache), or by the indexing outbox in write-behind
+mode (see outbox.py), so the bulk writes are indexed in bulk too.
+"""
+import logging
+import uuid
+from collections import defaultdict
+
+from pymongo import DeleteOne, InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from fhir_api import changes, outbox
+from fhir_api.errors import BadRequest
+from fhir_api.models.base import resource_cache
+
+logger = logging.getLogger(__name__)
+
+BATCH = "batch"
+TRANSACTION = "transaction"
+
+# processing order of the operations (the transactions must process the
+# deletions first, then the creations and the updates)
+METHODS = ["DELETE", "POST", "PUT"]
+# operations which may be requested but are not supported in bundles
+UNSUPPORTED_METHODS = ["GET", "HEAD", "PATCH"]
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class BundleEntry:
+    """Operation requested by a Bundle entry, and its outcome."""
+
+    def __init__(self, index, method, resource_type, id=None, resource=None, full_url=None):
+        self.index = index
+        self.method = method
+        self.resource_type = resource_type
+        self.id = id
+        self.resource = resource
+        self.full_url = full_url
+        self.response = None
+
+    def bulk_request(self):
+        if self.method == "POST":
+            return InsertOne(self.resource)
+        if self.method == "PUT":
+            return ReplaceOne({"id": self.id}, self.resource, upsert=True)
+        return DeleteOne({"id": self.id})
+
+    def succeed(self, created=False):
+        status = {"POST": "201 Created", "PUT": "200 OK", "DELETE": "204 No Content"}[self.method]
+        self.response = {"status": "201 Created" if created else status}
+        if self.method != "DELETE":
+            self.response["location"] = f"{self.resource_type}/{self.id}"
+
+    def fail(self, status, code, diagnostics):
+        self.response = {"status": status, "outcome": operation_outcome(code, diagnostics)}
+
+
+def operation_outcome(code, diagnostics):
+    issue = {"severity": "error", "code": code, "diagnostics": diagnostics}
+    return {"resourceType": "OperationOutcome", "issue": [issue]}
+
+
+def replace_references(value, references):
+    """Replaces in place the references to the entries of a transaction
+    (by their fullUrl) by references to the created resources."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "reference" and item in references:
+                value[key] = references[item]
+            else:
+                replace_references(item, references)
+    elif isinstance(value, list):
+        for item in value:
+            replace_references(item, references)
+
+
+class BatchProcessor:
+    """Processes the entries of a batch or transaction Bundle.
+
+    The entries of a batch are independent: each entry succeeds or fails on
+    its own. A transaction is written in a mongo transaction, and nothing is
+    written if any of its entries is invalid or fails.
+    """
+
+    def __init__(self, store, resource_types):
+        self.store = store
+        self.resource_types = resource_types
+        self.type = None
+        self.entries = []
+        # resources written by the bulk writes, by type
+        self.written = defaultdict(set)
+        # outbox entries of the indexing of the writes (see outbox.py)
+        self.outbox_entries = []
+
+    def process(self, bundle):
+        """Returns the response Bundle (or OperationOutcome), and its status
+        code."""
+        if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
+            raise BadRequest("input must be a FHIR Bundle resource")
+        self.type = bundle.get("type")
+        if self.type not in (BATCH, TRANSACTION):
+            raise BadRequest("the Bundle type must be batch or transaction")
+
+        self.entries = [
+            self.parse_entry(i, entry) for i, entry in enumerate(bundle.get("entry") or [])
+        ]
+        if self.type == BATCH:
+            try:
+                self.write_all()
+            finally:
+                self.changed()
+            return self.response_bundle(), 200
+
+        failed = [entry for entry in self.entries if entry.response]
+        if failed:
+            return self.transaction_outcome(failed), 400
+
+        self.resolve_references()
+        try:
+            with self.store.db.client.start_session() as session:
+                session.with_transaction(lambda session: self.write_all(session=session))
+        except BulkWriteError as e:
+            error = e.details["writeErrors"][0]
+            conflict = error["code"] == DUPLICATE_KEY_ERROR
+            return self.transaction_error(error["errmsg"], conflict), 409 if conflict else 400
+        except PyMongoError as e:
+            logger.exception(f"Transaction failed: {e}")
+            return self.transaction_error(str(e), False), 500
+        finally:
+            # once the transaction is committed (or rolled back), so that
+            # its previous state is not cached again by concurrent reads
+            self.changed()
+        return self.response_bundle(), 200
+
+    def parse_entry(self, index, entry):
+        """Parses and validates a Bundle entry. The invalid entries are
+        returned with an error response."""
+        entry = entry if isinstance(entry, dict) else {}
+        request = entry.get("request") if isinstance(entry.get("request"), dict) else {}
+        method = request.get("method")
+        resource = entry.get("resource")
+        url = request.get("url") if isinstance(request.get("url"), str) else ""
+        parts = url.split("?")[0].strip("/").split("/")
+
+        if method == "POST" and isinstance(resource, dict):
+            resource_type, id = resource.get("resourceType"), resource.get("id")
+        elif method in ("PUT", "DELETE") and len(parts) == 2:
+            resource_type, id = parts
+        else:
+            bundle_entry = BundleEntry(index, method, None)
+            if method in UNSUPPORTED_METHODS:
+                diagnostics = f"{method} entries are not supported: {request.get('url')}"
+                bundle_entry.fail("405 Method Not Allowed", "not-supported", diagnostics)
+            else:
+                diagnostics = f"Invalid request: {method} {request.get('url')}"
+                bundle_entry.fail("400 Bad Request", "invalid", diagnostics)
+            return bundle_entry
+
+        bundle_entry = BundleEntry(index, method, resource_type, id, resource, entry.get("fullUrl"))
+        if resource_type not in self.resource_types:
+            diagnostics = f"Unknown resource type: {resource_type}"
+            bundle_entry.fail("404 Not Found", "not-supported", diagnostics)
+        elif method != "DELETE":
+            self.validate(bundle_entry)
+        return bundle_entry
+
+    def validate(self, entry):
+        if entry.method == "PUT":
+            if not entry.resource:
+                entry.fail("400 Bad Request", "required", "Bundle entry is missing a resource.")
+                return
+            if entry.resource.setdefault("id", entry.id) != entry.id:
+                entry.fail("400 Bad Request", "invalid", "Resource id and url do not match")
+                return
+
+        try:
+            self.store.normalize_resource(entry.resource)
+        except Exception as e:
+            entry.fail("400 Bad Request", "invalid", str(e))
+            return
+        entry.id = entry.resource.setdefault("id", entry.id or str(uuid.uuid4()))
+        changes.stamp(entry.resource)
+
+    def resolve_references(self):
+        references = {
+            entry.full_url: f"{entry.resource_type}/{entry.id}"
+            for entry in self.entries
+            if entry.method == "POST" and entry.full_url
+        }
+        if not references:
+            return
+        for entry in self.entries:
+            if entry.resource:
+                replace_references(entry.resource, references)
+
+    def write_all(self, session=None):
+        groups = defaultdict(list)
+        for entry in self.entries:
+            if not entry.response:
+                groups[entry.method, entry.resource_type].append(entry)
+
+        for method in METHODS:
+            for (method_, resource_type), entries in groups.items():
+                if method_ == method:
+                    self.write(resource_type, entries, session=session)
+
+    def write(self, resource_type, entries, session=None):
+        failed = {}
+        try:
+            result = self.store.db[resource_type].bulk_write(
+                [entry.bulk_request() for entry in entries],
+                ordered=self.type == TRANSACTION,
+                session=session,
+            )
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            if self.type == TRANSACTION:
+                raise
+            details = e.details
+            failed = {error["index"]: error for error in details["writeErrors"]}
+        finally:
+            self.written[resource_type].update(entry.id for entry in entries)
+
+        upserted = {upsert["index"] for upsert in details.get("upserted", [])}
+        for i, entry in enumerate(entries):
+            if i not in failed:
+                entry.succeed(created=i in upserted)
+            elif failed[i]["code"] == DUPLICATE_KEY_ERROR:
+                entry.fail("409 Conflict", "duplicate", failed[i]["errmsg"])
+            else:
+                entry.fail("400 Bad Request", "exception", failed[i]["errmsg"])
+
+    def changed(self):
+        """Invalidates the caches of the written resources and queues their
+        indexing, once their writes are committed. The resources of a rolled
+        back transaction are indexed in their current state."""
+        for resource_type, ids in self.written.items():
+            for id in ids:
+                resource_cache.invalidate(resource_type, id)
+            changes.type_changed(resource_type)
+            self.outbox_entries += outbox.enqueue(resource_type, sorted(ids))
+        self.written.clear()
+
+    def response_bundle(self):
+        return {
+            "resourceType": "Bundle",
+            "type": f"{self.type}-response",
+            "entry": [{"response": entry.response} for entry in self.entries],
+        }
+
+    def transaction_outcome(self, failed):
+        issues = [
+            {
+                **entry.response["outcome"]["issue"][0],
+                "expression": [f"Bundle.entry[{entry.index}]"],
+            }
+            for entry in failed
+        ]
+        return {"resourceType": "OperationOutcome", "issue": issues}
+
+    def transaction_error(self, diagnostics, conflict):
+        code = "conflict" if conflict else "exception"
+        return operation_outcome(code, f"The transaction was rolled back: {diagnostics}")
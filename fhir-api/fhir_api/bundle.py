@@ -0,0 +1,196 @@
+import logging
+import os
+import shutil
+import uuid
+from collections import defaultdict
+
+import ijson
+from pymongo.errors import BulkWriteError
+
+from fhir_api import changes, jobs, settings
+from fhir_api.db import get_store
+from fhir_api.errors import BadRequest
+from fhir_api.models import resources_models
+from fhir_api.models.base import resource_cache
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def iter_bundle_entries(stream):
+    """Yields the entries of a Bundle read incrementally from a file object.
+
+    Only one entry is held in memory at a time. The Bundle resourceType must
+    come before its entries (which is the case of the bundles serialized by
+    FHIR libraries and servers).
+    """
+    resource_type = None
+    builder = None
+    try:
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+            if prefix == "resourceType":
+                resource_type = value
+            elif prefix == "entry.item" and event == "start_map":
+                if resource_type != "Bundle":
+                    raise BadRequest("input must be a FHIR Bundle resource")
+                builder = ijson.ObjectBuilder()
+
+            if builder is None:
+                continue
+            builder.event(event, value)
+            if prefix == "entry.item" and event == "end_map":
+                yield builder.value
+                builder = None
+    except ijson.JSONError as e:
+        raise BadRequest(f"invalid JSON: {e}")
+
+    if resource_type != "Bundle":
+        raise BadRequest("input must be a FHIR Bundle resource")
+
+
+class BundleLoader:
+    """Validates Bundle entries one by one and writes them to the store in
+    batches of `batch_size` resources.
+
+    The errors are collected per entry and summarized in an OperationOutcome.
+    """
+
+    def __init__(self, store, resource_types, batch_size: int = None):
+        self.store = store
+        self.resource_types = resource_types
+        self.batch_size = batch_size or settings.BUNDLE_BATCH_SIZE
+
+        self.batch = []
+        self.issues = []
+        self.dropped_issues = 0
+        self.entries = 0
+        self.created = 0
+        self.duplicates = 0
+        # write errors other than the duplicate keys
+        self.write_errors = 0
+
+    def load(self, entries, report=None):
+        """Loads the entries, calling `report(loader)` after each of them.
+
+        The entries read before an invalid JSON are still written: the
+        BadRequest then tells how many of them were.
+        """
+        try:
+            for entry in entries:
+                self.add(entry)
+                if report:
+                    report(self)
+        except BadRequest as e:
+            self.flush()
+            raise BadRequest(f"{e} ({self.summary()})")
+        self.flush()
+        return self
+
+    def add(self, entry):
+        index = self.entries
+        self.entries += 1
+
+        resource = entry.get("resource")
+        if not resource:
+            self.add_issue(index, "required", "Bundle entry is missing a resource.")
+            return
+
+        resource_type = resource.get("resourceType")
+        if resource_type not in self.resource_types:
+            self.add_issue(index, "not-supported", f"Unknown resource type: {resource_type}")
+            return
+
+        try:
+            self.store.normalize_resource(resource)
+        except Exception as e:
+            self.add_issue(index, "invalid", str(e))
+            return
+
+        resource.setdefault("id", str(uuid.uuid4()))
+        changes.stamp(resource)
+        self.batch.append((index, resource))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batches = defaultdict(list)
+        for index, resource in self.batch:
+            batches[resource["resourceType"]].append((index, resource))
+        self.batch = []
+
+        for resource_type, batch in batches.items():
+            self.write(resource_type, batch)
+
+    def write(self, resource_type, batch):
+        failed = set()
+        try:
+            res = self.store.db[resource_type].insert_many(
+                [resource for _, resource in batch], ordered=False
+            )
+            self.created += len(res.inserted_ids)
+        except BulkWriteError as e:
+            self.created += e.details["nInserted"]
+            for error in e.details["writeErrors"]:
+                failed.add(error["index"])
+                index = batch[error["index"]][0]
+                if error["code"] == DUPLICATE_KEY_ERROR:
+                    # documents which already exist are skipped
+                    self.duplicates += 1
+                    self.add_issue(index, "duplicate", error["errmsg"], severity="warning")
+                else:
+                    self.write_errors += 1
+                    self.add_issue(index, "exception", error["errmsg"])
+        finally:
+            for i, (_, resource) in enumerate(batch):
+                if i not in failed:
+                    resource_cache.invalidate(resource_type, resource["id"])
+            changes.type_changed(resource_type)
+
+    def add_issue(self, index, code, diagnostics, severity="error"):
+        logger.warning(f"Bundle entry {index}: {diagnostics}")
+        if len(self.issues) >= settings.BUNDLE_MAX_ISSUES:
+            self.dropped_issues += 1
+            return
+        self.issues.append(
+            {
+                "severity": severity,
+                "code": code,
+                "diagnostics": diagnostics,
+                "expression": [f"Bundle.entry[{index}]"],
+            }
+        )
+
+    def summary(self) -> str:
+        failed = self.entries - self.created - self.duplicates
+        return (
+            f"{self.entries} entries processed: {self.created} resources created, "
+            f"{self.duplicates} already existing, {failed} failed"
+        )
+
+    def operation_outcome(self) -> dict:
+        diagnostics = self.summary()
+        if self.dropped_issues:
+            diagnostics += f" ({self.dropped_issues} issues omitted)"
+
+        summary = {"severity": "information", "code": "informational", "diagnostics": diagnostics}
+        return {"resourceType": "OperationOutcome", "issue": [summary, *self.issues]}
+
+
+@jobs.task("upload-bundle")
+def upload_bundle_task(progress):
+    path = jobs.get_upload_path(progress.job_id)
+    loader = BundleLoader(get_store(), resources_models)
+    try:
+        with open(path, "rb") as f:
+            loader.load(
+                iter_bundle_entries(f),
+                report=lambda loader: progress.report(
+                    processed=loader.entries, created=loader.created
+                ),
+            )
+        progress.report(processed=loader.entries, created=loader.created)
+    finally:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    return loader.operation_outcome()
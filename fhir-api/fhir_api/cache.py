@@ -0,0 +1,348 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+try:
+    import uwsgi
+except ImportError:
+    # not running under uwsgi (flask development server, CLI, tests...)
+    uwsgi = None
+
+logger = logging.getLogger(__name__)
+
+# every cache created in the process, used to expose their statistics
+caches = {}
+
+
+class LRUCache:
+    """In-process LRU cache with optional TTL and size bounds.
+
+    Entries are evicted in least-recently-used order as soon as the cache
+    holds more than `max_items` entries or more than `max_bytes` bytes (when a
+    size is provided for the entries).
+    """
+
+    def __init__(self, name: str, max_items: int = 1024, max_bytes: int = None, ttl: float = None):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None, size: int = 0):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            # the entry would evict the whole cache, do not store it
+            return
+
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "items": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+    def _pop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _is_full(self):
+        if len(self._entries) > self.max_items:
+            return True
+        return self.max_bytes is not None and self._bytes > self.max_bytes
+
+    def _evict(self):
+        while self._entries and self._is_full():
+            key = next(iter(self._entries))
+            self._pop(key)
+            self.evictions += 1
+
+
+class SharedCache:
+    """Cache shared by all the workers of a uwsgi instance.
+
+    The entries are stored in a uwsgi cache (see the `cache2` options in
+    uwsgi.ini), which handles expiration and LRU eviction. Values must be
+    JSON-serializable. When the application does not run under uwsgi or when
+    the uwsgi cache is not configured, an in-process LRUCache is used instead.
+    """
+
+    def __init__(self, name: str, max_items: int = 1024, ttl: float = None):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._local = None
+        if uwsgi is None or not self._uwsgi_cache_exists():
+            self._local = LRUCache(f"{name}.local", max_items=max_items, ttl=ttl)
+            # the local cache statistics are exposed through the shared cache
+            del caches[self._local.name]
+
+        caches[name] = self
+
+    def get(self, key, default=None):
+        if self._local is not None:
+            return self._local.get(key, default)
+
+        value = uwsgi.cache_get(key, self.name)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if self._local is not None:
+            return self._local.set(key, value, ttl=ttl)
+
+        if ttl is not None and ttl <= 0:
+            return
+        # uwsgi expirations are expressed in whole seconds, 0 meaning "never"
+        expires = max(int(ttl), 1) if ttl is not None else 0
+        uwsgi.cache_update(key, json.dumps(value).encode(), expires, self.name)
+
+    def delete(self, key):
+        if self._local is not None:
+            return self._local.delete(key)
+        uwsgi.cache_del(key, self.name)
+
+    def clear(self):
+        if self._local is not None:
+            return self._local.clear()
+        uwsgi.cache_clear(self.name)
+
+    def stats(self) -> dict:
+        if self._local is not None:
+            return {**self._local.stats(), "shared": False}
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "shared": True,
+        }
+
+    def _uwsgi_cache_exists(self):
+        options = uwsgi.opt.get("cache2", [])
+        if not isinstance(options, list):
+            options = [options]
+        for option in options:
+            if f"name={self.name}," in f"{option.decode()},":
+                return True
+        logger.warning(f"uwsgi cache {self.name} is not configured, using a local cache")
+        return False
+
+
+class Generations:
+    """Generations of cached data, shared by all the workers.
+
+    A generation is the time (in nanoseconds) of the last change of the data
+    it tracks, or of the first time it was requested if it is unknown (new or
+    evicted). It is renewed by every change, whatever the worker, so that the
+    data cached (or the ETags computed) under an older generation are never
+    served again.
+    """
+
+    def __init__(self, name: str, max_items: int = 1024, ttl: float = None):
+        self.tokens = SharedCache(name, max_items=max_items, ttl=ttl)
+
+    def get(self, key) -> int:
+        generation = self.tokens.get(key)
+        if generation is None:
+            generation = self.renew(key)
+        return generation
+
+    def renew(self, key) -> int:
+        generation = time.time_ns()
+        self.tokens.set(key, generation)
+        return generation
+
+    def clear(self):
+        self.tokens.clear()
+
+
+class ResourceCache:
+    """Read-through cache of resources, kept coherent across workers.
+
+    The resources are cached in each process, keyed by (resource type, id,
+    generation), the generation of a resource being renewed by every write.
+    The generation is read before the resource is fetched from the store: a
+    resource written concurrently is cached under an outdated generation.
+
+    The generations are also the ETags of the resources: they are sized
+    separately (`generations_max_items`), and kept when the cache is disabled.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_items: int = 1024,
+        ttl: float = None,
+        generations_max_items: int = 1024,
+        generations_ttl: float = None,
+    ):
+        self.enabled = max_items > 0
+        self.resources = LRUCache(name, max_items=max_items, ttl=ttl)
+        self.generations = Generations(
+            f"{name}-generations", max_items=generations_max_items, ttl=generations_ttl
+        )
+
+    def generation(self, resource_type, id) -> int:
+        return self.generations.get(f"{resource_type}/{id}")
+
+    def get(self, resource_type, id):
+        """Returns the cached resource and the key to cache it under when it
+        is missing."""
+        if not self.enabled:
+            return None, None
+
+        key = (resource_type, id, self.generation(resource_type, id))
+        return self.resources.get(key), key
+
+    def set(self, key, resource):
+        if self.enabled and key is not None:
+            self.resources.set(key, resource)
+
+    def invalidate(self, resource_type, id):
+        """Renews the generation of a resource, in every worker."""
+        self.generations.renew(f"{resource_type}/{id}")
+
+    def clear(self):
+        self.resources.clear()
+        self.generations.clear()
+
+
+class SearchCache:
+    """Cache of the serialized search results, in each process.
+
+    The results are keyed by the ETag of the search (see changes.search_etag),
+    computed from its normalized parameters and from the generations of the
+    resource types it may return, and by their output format: a search is not
+    served from the cache anymore as soon as one of its types is written. The
+    hits and misses are counted by searched resource type.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_items: int = 1024,
+        max_bytes: int = None,
+        max_entry_bytes: int = None,
+        ttl: float = None,
+    ):
+        self.name = name
+        self.enabled = max_items > 0
+        self.max_entry_bytes = max_entry_bytes
+        self.results = LRUCache(f"{name}.results", max_items, max_bytes=max_bytes, ttl=ttl)
+        # the results statistics are exposed through the search cache
+        del caches[self.results.name]
+
+        self._lock = threading.Lock()
+        self.types = defaultdict(Counter)
+
+        caches[name] = self
+
+    def get(self, resource_type, key):
+        """Returns the cached (mimetype, serialized results), or None."""
+        if not self.enabled:
+            return None
+        value = self.results.get(key)
+        with self._lock:
+            self.types[resource_type or "*"]["hits" if value is not None else "misses"] += 1
+        return value
+
+    def caching(self, key, chunks, mimetype):
+        """Yields the chunks of serialized results, and caches them once they
+        have all been consumed (unless they exceed `max_entry_bytes`)."""
+        if not self.enabled:
+            yield from chunks
+            return
+
+        data, size = [], 0
+        for chunk in chunks:
+            if data is not None:
+                size += len(chunk)
+                if self.max_entry_bytes is not None and size > self.max_entry_bytes:
+                    data = None
+                else:
+                    data.append(chunk)
+            yield chunk
+        if data is not None:
+            self.results.set(key, (mimetype, b"".join(data)), size=size)
+
+    def clear(self):
+        self.results.clear()
+        with self._lock:
+            self.types.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            types = {
+                resource_type: {
+                    "hits": counters["hits"],
+                    "misses": counters["misses"],
+                    "hit_ratio": counters["hits"] / (counters["hits"] + counters["misses"]),
+                }
+                for resource_type, counters in sorted(self.types.items())
+            }
+        return {**self.results.stats(), "types": types}
+
+
+def get_stats() -> dict:
+    """Returns the statistics of every cache of the current process."""
+    return {name: cache.stats() for name, cache in caches.items()}
@@ -0,0 +1,209 @@
+"""
+Subscriber of the mongo change streams of the resources collections.
+
+The writes made through the API invalidate the caches as they are made (see
+BaseResource.changed). The subscriber catches up with all the other writes
+(other services, loaders, CLI...): it tails the changes of the collections of
+the resources models and, for each change:
+
+- invalidates the cached resource (see models.base.resource_cache) and the
+  generation and version of its type (see changes.py), on which the ETags of
+  the searches and the cached eCRF results depend;
+- counts the changes of its type, in the internal database;
+- queues its indexing in the Elasticsearch outbox (see outbox.py), if
+  CHANGE_STREAM_ES_SYNC is set.
+
+The generations are shared by the workers of a uwsgi instance: the subscriber
+runs in its mule (see uwsgi.ini), or in the foreground with the `flask
+watch-changes` command. Its resume token is saved in the internal database
+with the counters, so that a restarted subscriber resumes after the last
+change it processed.
+
+The deleted documents are only known by their mongo _id: their deletion
+renews the generation of their type, but not the one of the cached resource
+(which expires after RESOURCE_CACHE_TTL), and is not synced to Elasticsearch.
+"""
+import datetime
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from fhir_api import changes, db, outbox, settings
+from fhir_api.models import resources_models
+from fhir_api.models.base import resource_cache
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+logger = logging.getLogger(__name__)
+
+STREAM_ID = "resources"
+
+OPERATIONS = ["insert", "update", "replace", "delete"]
+
+# error codes of a resume token which is not in the oplog anymore
+HISTORY_LOST = {136, 280, 286}
+
+
+def get_streams_collection():
+    return db.get_internal_db()["change_streams"]
+
+
+def get_counters_collection():
+    return db.get_internal_db()["change_counters"]
+
+
+def get_counters() -> dict:
+    """Returns the number of changes of each resource type, by operation."""
+    return {
+        counters.pop("_id"): counters for counters in get_counters_collection().find().sort("_id")
+    }
+
+
+def pipeline() -> list:
+    """Returns the pipeline of the change streams of the resources
+    collections."""
+    return [
+        {
+            "$match": {
+                "ns.coll": {"$in": sorted(resources_models)},
+                "operationType": {"$in": OPERATIONS},
+            }
+        },
+        # only the id of the resource is needed
+        {"$project": {"ns": 1, "operationType": 1, "fullDocument.id": 1}},
+    ]
+
+
+def changed_id(change):
+    """Returns the id of the resource of a change, if it still exists."""
+    return (change.get("fullDocument") or {}).get("id")
+
+
+class Subscriber:
+    """Processes the changes of the resources collections, by batches of at
+    most CHANGE_STREAM_BATCH_SIZE changes or CHANGE_STREAM_FLUSH_INTERVAL
+    seconds."""
+
+    def __init__(self, batch_size=None, flush_interval=None, es_sync=None):
+        self.batch_size = batch_size or settings.CHANGE_STREAM_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.CHANGE_STREAM_FLUSH_INTERVAL
+        self.es_sync = settings.CHANGE_STREAM_ES_SYNC if es_sync is None else es_sync
+        self.stopped = threading.Event()
+
+        self.counters = defaultdict(Counter)
+        self.written = defaultdict(set)
+        self.pending = 0
+        self.resume_token = None
+        self.failures = 0
+
+    def run(self):
+        """Processes the changes until the subscriber is stopped."""
+        state = get_streams_collection().find_one({"_id": STREAM_ID}) or {}
+        self.resume_token = state.get("resume_token")
+        while not self.stopped.is_set():
+            try:
+                self.watch()
+            except OperationFailure as e:
+                if e.code not in HISTORY_LOST or self.resume_token is None:
+                    self.back_off(e)
+                    continue
+                logger.warning(f"Could not resume the change stream ({e}), restarting it")
+                self.resume_token = None
+                # the changes which were missed may be of any type
+                changes.type_changed(changes.ALL_TYPES)
+                resource_cache.clear()
+            except PyMongoError as e:
+                self.back_off(e)
+
+    def back_off(self, error):
+        """Waits before watching the changes again after an error, twice as
+        long after each consecutive failure, and at most
+        CHANGE_STREAM_MAX_BACKOFF seconds."""
+        delay = min(self.flush_interval * 2**self.failures, settings.CHANGE_STREAM_MAX_BACKOFF)
+        self.failures += 1
+        logger.exception(f"Change stream interrupted ({error}), retrying in {delay}s")
+        self.stopped.wait(delay)
+
+    def watch(self):
+        stream = db.get_store().db.watch(
+            pipeline(),
+            full_document="updateLookup",
+            resume_after=self.resume_token,
+            max_await_time_ms=int(self.flush_interval * 1000),
+        )
+        with stream:
+            logger.info("Watching the changes of the resources collections...")
+            flushed_at = time.monotonic()
+            while stream.alive and not self.stopped.is_set():
+                change = stream.try_next()
+                self.failures = 0
+                if change is not None:
+                    self.process(change)
+                self.resume_token = stream.resume_token
+                due = time.monotonic() - flushed_at >= self.flush_interval
+                if due or self.pending >= self.batch_size:
+                    self.flush()
+                    flushed_at = time.monotonic()
+            self.flush()
+
+    def process(self, change):
+        resource_type = change["ns"]["coll"]
+        id = changed_id(change)
+        if id is not None:
+            # the cached resources are invalidated right away
+            resource_cache.invalidate(resource_type, id)
+            self.written[resource_type].add(id)
+        self.counters[resource_type][change["operationType"]] += 1
+        self.pending += 1
+
+    def flush(self):
+        """Renews the generations of the changed types, saves the counters
+        and the resume token. The token is saved last, so that the changes
+        are processed again if the subscriber stops before."""
+        for resource_type, counters in self.counters.items():
+            changes.type_changed(resource_type)
+            get_counters_collection().update_one(
+                {"_id": resource_type},
+                {
+                    "$inc": dict(counters),
+                    "$set": {"last_change_at": datetime.datetime.utcnow()},
+                },
+                upsert=True,
+            )
+        if self.es_sync:
+            for resource_type, ids in self.written.items():
+                outbox.queue(resource_type, sorted(ids))
+        if self.resume_token is not None:
+            get_streams_collection().update_one(
+                {"_id": STREAM_ID},
+                {
+                    "$set": {
+                        "resume_token": self.resume_token,
+                        "updated_at": datetime.datetime.utcnow(),
+                    }
+                },
+                upsert=True,
+            )
+        self.counters.clear()
+        self.written.clear()
+        self.pending = 0
+
+    def stop(self):
+        self.stopped.set()
+
+
+def is_subscriber_process() -> bool:
+    """The subscriber runs in the first mule of the uwsgi instance."""
+    return uwsgi is not None and uwsgi.mule_id() == 1
+
+
+def start_subscriber() -> Subscriber:
+    subscriber = Subscriber()
+    threading.Thread(target=subscriber.run, name="change-stream", daemon=True).start()
+    return subscriber
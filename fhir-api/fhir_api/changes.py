@@ -0,0 +1,145 @@
+"""
+Change tracking of the resource types and conditional requests.
+
+Every write of a resource through the API renews the generation of its type
+(see cache.Generations). The ETag of a search is derived from the generations
+of the types its results may contain, so that it changes as soon as one of
+them is written. The writes which bypass the API (other services, CLI...)
+are taken into account once the generations expire (GENERATIONS_TTL).
+
+The resources written through the API are also stamped with their
+meta.lastUpdated (see stamp), which the bulk exports filter on.
+"""
+import calendar
+import datetime
+import hashlib
+
+from flask import Response, request
+
+from fhir_api import settings
+from fhir_api.cache import Generations
+
+# generation of the whole store, renewed by the writes of any type
+ALL_TYPES = "*"
+
+# modifiers of the search parameters, which are case-insensitive (the other
+# modifiers are resource types)
+MODIFIERS = {
+    "above",
+    "below",
+    "contains",
+    "exact",
+    "identifier",
+    "in",
+    "iterate",
+    "missing",
+    "not",
+    "not-in",
+    "of-type",
+    "text",
+}
+# search parameters whose values are ordered
+ORDERED_PARAMS = {"_sort"}
+
+type_generations = Generations("type-generations", max_items=4096, ttl=settings.GENERATIONS_TTL)
+# versions of the resource types, renewed with their generations, which do not
+# expire: they only change with the writes seen by the API or by the change
+# stream subscriber (they key the cached eCRF results)
+type_versions = Generations("type-versions", max_items=4096)
+
+
+def type_changed(resource_type):
+    type_generations.renew(resource_type)
+    type_generations.renew(ALL_TYPES)
+    if resource_type == ALL_TYPES:
+        type_versions.clear()
+    else:
+        type_versions.renew(resource_type)
+
+
+def format_instant(value: datetime.datetime) -> str:
+    """Formats a datetime as a FHIR instant, in UTC and with milliseconds, so
+    that the instants formatted by the API compare as strings."""
+    value = value.astimezone(datetime.timezone.utc)
+    return value.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def last_updated() -> str:
+    return format_instant(datetime.datetime.now(datetime.timezone.utc))
+
+
+def stamp(resource: dict):
+    """Sets the meta.lastUpdated of a resource about to be written."""
+    resource["meta"] = {**(resource.get("meta") or {}), "lastUpdated": last_updated()}
+
+
+def search_types(resource_type, args):
+    """Returns the resource types on which the results of a search depend, or
+    None if they can not be determined."""
+    types = {resource_type} if resource_type else set()
+    for key, value in args.items(multi=True):
+        if key == "_type":
+            types.update(value.split(","))
+        elif key.startswith("_has:"):
+            types.update(part for part in key.split(":") if part[:1].isupper())
+        elif key in ("_include", "_revinclude"):
+            parts = value.split(":")
+            if key == "_include" and len(parts) < 3:
+                # the type of the included resources is not specified
+                return None
+            types.update(part for part in parts if part[:1].isupper())
+    return types or None
+
+
+def normalize_param(key, value) -> tuple:
+    """Returns the canonical form of a search parameter: lowercase modifier,
+    and sorted alternative values (a,b is b,a)."""
+    name, _, modifier = key.partition(":")
+    if modifier.lower() in MODIFIERS:
+        key = f"{name}:{modifier.lower()}"
+    if name not in ORDERED_PARAMS and "," in value and "\\" not in value:
+        value = ",".join(sorted(value.split(",")))
+    return key, value
+
+
+def normalize_search(args) -> list:
+    """Returns the normalized parameters of a search, so that equivalent
+    searches have the same parameters. The repeated ordered parameters
+    (_sort) keep their order."""
+    params = [normalize_param(key, value) for key, value in args.items(multi=True)]
+    return sorted(params, key=lambda param: (param[0], "") if param[0] in ORDERED_PARAMS else param)
+
+
+def search_generations(resource_type, args) -> list:
+    types = search_types(resource_type, args)
+    if types is None:
+        return [type_generations.get(ALL_TYPES)]
+    return [type_generations.get(type_) for type_ in sorted(types)]
+
+
+def search_etag(resource_type, args, generations) -> str:
+    """Returns the ETag of a search, computed from its normalized parameters
+    and from the generations of the resource types it depends on."""
+    key = f"{resource_type}?{normalize_search(args)}:{generations}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def is_not_modified(etag, last_modified) -> bool:
+    """Checks the validators of a conditional GET request. `last_modified` is
+    a generation (time in nanoseconds)."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        return last_modified // 1_000_000_000 <= since
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified / 1_000_000_000
+    return response
+
+
+def not_modified(etag, last_modified):
+    return set_validators(Response(status=304), etag, last_modified)
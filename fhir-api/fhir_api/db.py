@@ -32,6 +32,14 @@ def get_db_connection():
     return connection
 
 
+def get_internal_db():
+    """
+    get_internal_db returns the database where the API stores its own data
+    (jobs...), apart from the FHIR resources collections
+    """
+    return get_db_connection()[settings.INTERNAL_DB_NAME]
+
+
 def get_es_connection():
 
     global connection_es
@@ -0,0 +1,391 @@
+"""
+Full-text index of the documents (PDF files) of DOCUMENTS_PATH, used by the
+DocumentReference $search operation.
+
+The index is a SQLite FTS5 table stored on disk and memory-mapped. It keeps
+the positions of the terms, from which the context snippets are built, and
+ranks the results by relevance (bm25). It is updated incrementally: only the
+files added or changed since the last update (by mtime and size, then by
+content hash) are extracted again.
+
+The index is only updated by the index-documents job (run periodically by the
+uwsgi master, see uwsgi.ini, and at startup when it is empty, see
+docker-entrypoint.sh): the searches only read it.
+
+The extraction (pdftotext) is the dominant cost of the indexing: it is run by
+a pool of processes, and the extracted texts are cached, compressed, by
+content hash, so that a document is never extracted twice (renamed or copied
+files, rebuilds of the index).
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+from typing import List, NamedTuple
+
+import click
+
+from fhir_api import jobs, settings
+from fhir_api.errors import BadRequest
+
+try:
+    import pdftotext
+except ImportError:
+    # poppler is not available (see the Dockerfile and requirements/base.txt)
+    pdftotext = None
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY,
+        path TEXT UNIQUE,
+        name TEXT,
+        mtime REAL,
+        size INTEGER,
+        hash TEXT
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS contents
+    USING fts5(content, tokenize='unicode61 remove_diacritics 2')""",
+    # zlib-compressed extracted texts, by content hash
+    """CREATE TABLE IF NOT EXISTS texts (
+        hash TEXT PRIMARY KEY,
+        text BLOB
+    )""",
+]
+
+# terms of a search query: words or "quoted expressions", optionally
+# prefixed by + (mandatory) or - (forbidden)
+QUERY_TERM = re.compile(r'([+-]?)(?:"([^"]*)"|(\S+))')
+
+index = None
+
+
+class Hit(NamedTuple):
+    name: str
+    snippet: str
+    score: float
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def extract_text(path) -> str:
+    if pdftotext is None:
+        raise RuntimeError("pdftotext is required to extract the text of the documents")
+    with open(path, "rb") as f:
+        try:
+            return "\n\n".join(pdftotext.PDF(f))
+        except pdftotext.Error as e:
+            logger.warning(f"Could not extract the text of {path}: {e}")
+            return ""
+
+
+def _extract_text(args):
+    """Extracts the text of a document in a worker process. Returns None
+    instead of the text if the extraction failed."""
+    extract, hash_, path = args
+    try:
+        return hash_, extract(path)
+    except Exception as e:
+        logger.warning(f"Could not extract the text of {path}: {e}")
+        return hash_, None
+
+
+def list_documents(documents_path) -> dict:
+    """Returns the stat of the PDF files of a directory and its
+    subdirectories, by path relative to the directory."""
+    documents = {}
+    for root, _, names in os.walk(documents_path):
+        for name in names:
+            if name.lower().endswith(".pdf"):
+                path = os.path.join(root, name)
+                documents[os.path.relpath(path, documents_path)] = os.stat(path)
+    return documents
+
+
+def match_expression(query) -> str:
+    """Translates a search query to a FTS5 query.
+
+    Words are matched as prefixes and quoted expressions as phrases. The
+    words prefixed by + are mandatory, the ones prefixed by - forbidden, and
+    at least one of the other words must be found.
+    """
+    mandatory, forbidden, optional = [], [], []
+    for prefix, phrase, word in QUERY_TERM.findall(query):
+        term = (phrase or word).replace('"', '""')
+        if not term.strip():
+            continue
+        term = f'"{term}"' if phrase else f'"{term}"*'
+        {"+": mandatory, "-": forbidden, "": optional}[prefix].append(term)
+
+    if optional:
+        mandatory.append(f"({' OR '.join(optional)})")
+    if not mandatory:
+        raise BadRequest("the search query must contain at least one term which is not excluded")
+
+    expression = " AND ".join(mandatory)
+    for term in forbidden:
+        expression += f" NOT {term}"
+    return expression
+
+
+class IndexingStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.outcomes = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "failed": 0}
+        self.total_files = 0
+        self.total_bytes = 0
+        self.files = 0
+        self.bytes = 0
+        self.extracted = 0
+
+    def file_done(self, outcome, size):
+        self.outcomes[outcome] += 1
+        self.files += 1
+        self.bytes += size
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            **self.outcomes,
+            "files": f"{self.files}/{self.total_files}",
+            "processed": self.files,
+            "extracted": self.extracted,
+            "megabytes": round(self.bytes / 1e6, 3),
+            "files_per_second": round(self.files / elapsed, 1),
+            "megabytes_per_second": round(self.bytes / 1e6 / elapsed, 3),
+            "elapsed": round(elapsed, 3),
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        return (
+            f"{summary['files']} files, {self.extracted} extracted "
+            f"({summary['files_per_second']} files/s, "
+            f"{summary['megabytes_per_second']} MB/s) in {summary['elapsed']}s"
+        )
+
+
+class DocumentIndex:
+    """On-disk full-text index of the documents.
+
+    A SQLite connection is opened per thread, the index can be shared by the
+    threads and the processes (SQLite serializes the updates, the readers are
+    not blocked by the writer).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA mmap_size={settings.DOCUMENTS_INDEX_MMAP_SIZE}")
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+            self._local.connection = connection
+        return connection
+
+    def update(self, documents_path, workers=1, extract=extract_text, progress=None):
+        """Indexes the documents added or changed since the last update and
+        removes the deleted ones.
+
+        Args:
+            documents_path: directory of the documents
+            workers: number of processes extracting the texts
+            extract: function returning the text of a document
+            progress: function called with the statistics after each file
+
+        Returns:
+            the IndexingStats of the update
+        """
+        stats = IndexingStats()
+        indexed = {
+            path: (id, mtime, size, hash_)
+            for id, path, mtime, size, hash_ in self.connection.execute(
+                "SELECT id, path, mtime, size, hash FROM files"
+            )
+        }
+
+        # changed documents, by content hash
+        pending = defaultdict(list)
+        for path, stat in list_documents(documents_path).items():
+            id, mtime, size, hash_ = indexed.pop(path, (None, None, None, None))
+            if (mtime, size) == (stat.st_mtime, stat.st_size):
+                stats.outcomes["unchanged"] += 1
+                continue
+
+            new_hash = file_hash(os.path.join(documents_path, path))
+            if new_hash == hash_:
+                # the file was touched, its content did not change
+                self.index_file(id, path, stat, new_hash)
+                stats.outcomes["unchanged"] += 1
+                continue
+            pending[new_hash].append((id, path, stat))
+            stats.total_files += 1
+            stats.total_bytes += stat.st_size
+
+        with self.connection:
+            for id, *_ in indexed.values():
+                self.connection.execute("DELETE FROM files WHERE id = ?", (id,))
+                self.connection.execute("DELETE FROM contents WHERE rowid = ?", (id,))
+                stats.outcomes["removed"] += 1
+
+        for hash_, text in self.texts(pending, documents_path, workers, extract, stats):
+            for id, path, stat in pending[hash_]:
+                if text is None:
+                    # not indexed, so that it is extracted again on next update
+                    stats.file_done("failed", stat.st_size)
+                else:
+                    self.index_file(id, path, stat, hash_, text)
+                    stats.file_done("added" if id is None else "updated", stat.st_size)
+                if progress is not None:
+                    progress(stats)
+
+        self.prune_texts()
+        return stats
+
+    def texts(self, pending, documents_path, workers, extract, stats):
+        """Yields the texts of the pending documents by content hash, from the
+        cache or extracted by a pool of processes."""
+        to_extract = []
+        for hash_, documents in pending.items():
+            row = self.connection.execute(
+                "SELECT text FROM texts WHERE hash = ?", (hash_,)
+            ).fetchone()
+            if row is not None:
+                yield hash_, zlib.decompress(row[0]).decode()
+            else:
+                path = os.path.join(documents_path, documents[0][1])
+                to_extract.append((extract, hash_, path))
+        if not to_extract:
+            return
+
+        if workers > 1 and len(to_extract) > 1:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(min(workers, len(to_extract))) as pool:
+                yield from self.cache_texts(pool.imap_unordered(_extract_text, to_extract), stats)
+        else:
+            yield from self.cache_texts(map(_extract_text, to_extract), stats)
+
+    def cache_texts(self, extracted, stats):
+        for hash_, text in extracted:
+            if text is not None:
+                stats.extracted += 1
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO texts (hash, text) VALUES (?, ?)",
+                        (hash_, zlib.compress(text.encode())),
+                    )
+            yield hash_, text
+
+    def prune_texts(self):
+        """Removes the cached texts of the documents which no longer exist."""
+        with self.connection:
+            self.connection.execute("DELETE FROM texts WHERE hash NOT IN (SELECT hash FROM files)")
+
+    def is_empty(self) -> bool:
+        return self.connection.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def clear(self):
+        """Removes all the documents from the index. The cached texts are
+        kept until the next update."""
+        with self.connection:
+            self.connection.execute("DELETE FROM files")
+            self.connection.execute("DELETE FROM contents")
+
+    def index_file(self, id, path, stat, hash_, text=None):
+        """Stores a document. Its content is only replaced when a text is
+        provided.
+
+        A file keeps its id (the rowid of its content) when it is updated,
+        even if it was indexed meanwhile by another update: the file and its
+        content are written in a single transaction, so that no content is
+        left without its file.
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO files (id, path, name, mtime, size, hash) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET "
+                "mtime = excluded.mtime, size = excluded.size, hash = excluded.hash",
+                (id, path, os.path.basename(path), stat.st_mtime, stat.st_size, hash_),
+            )
+            if text is not None:
+                (id,) = self.connection.execute(
+                    "SELECT id FROM files WHERE path = ?", (path,)
+                ).fetchone()
+                self.connection.execute("DELETE FROM contents WHERE rowid = ?", (id,))
+                self.connection.execute(
+                    "INSERT INTO contents (rowid, content) VALUES (?, ?)", (id, text)
+                )
+
+    def search(self, query, count=None, offset=0) -> (List[Hit], int):
+        """Returns the documents matching a query, by relevance, with a
+        context snippet, and the total number of matching documents."""
+        expression = match_expression(query)
+        try:
+            (total,) = self.connection.execute(
+                "SELECT count(*) FROM contents JOIN files ON files.id = contents.rowid "
+                "WHERE contents MATCH ?",
+                (expression,),
+            ).fetchone()
+            rows = self.connection.execute(
+                "SELECT files.name, snippet(contents, 0, '', '', '...', 24), bm25(contents) "
+                "FROM contents JOIN files ON files.id = contents.rowid "
+                "WHERE contents MATCH ? ORDER BY bm25(contents) LIMIT ? OFFSET ?",
+                (expression, -1 if count is None else count, offset),
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            raise BadRequest(f"invalid search query: {e}")
+        return [Hit(*row) for row in rows], total
+
+
+def get_document_index():
+    global index
+    if index is None:
+        index = DocumentIndex(settings.DOCUMENTS_INDEX_PATH)
+    return index
+
+
+def reset_document_index():
+    global index
+    index = None
+
+
+@jobs.task("index-documents")
+def index_documents_task(progress, documents_path, workers=None, rebuild=False, echo=click.echo):
+    index = get_document_index()
+    if rebuild:
+        index.clear()
+
+    last_echo = time.monotonic()
+
+    def report(stats):
+        nonlocal last_echo
+        progress.report(**stats.summary())
+        if time.monotonic() - last_echo > settings.JOBS_PROGRESS_INTERVAL:
+            last_echo = time.monotonic()
+            echo(str(stats))
+
+    workers = workers or settings.DOCUMENTS_INDEX_WORKERS or os.cpu_count()
+    stats = index.update(documents_path, workers=workers, progress=report)
+    echo(f"Done! {stats}")
+    return stats.summary()
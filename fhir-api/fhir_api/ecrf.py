@@ -0,0 +1,162 @@
+"""
+eCRF export: the results of a FHIR2eCRF configuration, streamed as CSV,
+Parquet or Arrow IPC (stream format), chosen by content negotiation.
+
+The results are queried directly from the collections of the store, chunk of
+patients by chunk of patients (see FHIR2eCRF.query_batches). Each chunk is
+serialized, sent and released: neither the whole results nor their
+serialization are held in memory.
+
+The Parquet and Arrow outputs need pyarrow. Their schema is fixed before the
+first chunk is queried: the columns of the "bool" attributes are integers,
+the other ones strings (the type of their values may differ from one chunk of
+patients to another).
+"""
+import io
+
+from flask import Response, stream_with_context
+
+from fhir_api.db import get_store
+from fhir_api.errors import BadRequest
+from fhir_api.fhir2ecrf.fhir2ecrf import FHIR2eCRF
+from fhir_api.fhir2ecrf.result_cache import get_result_cache
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    # the Parquet and Arrow outputs are not available
+    pyarrow = None
+
+CSV = "text/csv"
+PARQUET = "application/vnd.apache.parquet"
+ARROW = "application/vnd.apache.arrow.stream"
+
+# values of the _format parameter
+FORMATS = {"csv": CSV, "parquet": PARQUET, "arrow": ARROW}
+EXTENSIONS = {CSV: "csv", PARQUET: "parquet", ARROW: "arrows"}
+
+fhir2ecrf = None
+
+
+def get_fhir2ecrf() -> FHIR2eCRF:
+    global fhir2ecrf
+    if fhir2ecrf is None:
+        fhir2ecrf = FHIR2eCRF(db=get_store().db, result_cache=get_result_cache())
+    return fhir2ecrf
+
+
+def output_formats() -> list:
+    return [CSV, PARQUET, ARROW] if pyarrow is not None else [CSV]
+
+
+def output_format(format_arg, accept_mimetypes) -> str:
+    """Returns the output format requested by the _format parameter, or else
+    the one preferred by the Accept header (CSV by default)."""
+    if format_arg:
+        requested = FORMATS.get(format_arg, format_arg)
+        if requested not in output_formats():
+            raise BadRequest(f"Unsupported output format: {format_arg}")
+        return requested
+    return accept_mimetypes.best_match(output_formats(), default=CSV)
+
+
+def validate(config_front):
+    if not isinstance(config_front, dict):
+        raise BadRequest("the eCRF configuration must be a JSON object")
+    attributes = config_front.get("attributes")
+    if not attributes or not isinstance(attributes, list):
+        raise BadRequest("the eCRF configuration must have attributes")
+    for attribute in attributes:
+        if not isinstance(attribute, dict) or not {"officialName", "customName"} <= set(attribute):
+            raise BadRequest(f"invalid eCRF attribute: {attribute}")
+    if not config_front.get("idPatient") or not isinstance(config_front["idPatient"], list):
+        raise BadRequest("the eCRF configuration must have patients (idPatient)")
+
+
+def csv_chunks(batches):
+    for i, batch in enumerate(batches):
+        yield batch.to_csv(index=False, header=i == 0).encode()
+
+
+class ChunksSink(io.RawIOBase):
+    """Write-only file keeping the data written since it was last drained.
+    Unlike BytesIO, its position is kept when it is drained (the Parquet
+    metadata records the offsets of the row groups)."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema(columns, integer_columns):
+    return pyarrow.schema(
+        [
+            (name, pyarrow.int64() if name in integer_columns else pyarrow.string())
+            for name in columns
+        ]
+    )
+
+
+def arrow_table(batch, schema):
+    arrays = []
+    for i, field in enumerate(schema):
+        values = batch.iloc[:, i].to_numpy(dtype=object)
+        if field.type != pyarrow.int64():
+            values = [None if value is None or value != value else str(value) for value in values]
+        arrays.append(pyarrow.array(values, type=field.type, from_pandas=True))
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def arrow_chunks(batches, schema, output_format):
+    sink = ChunksSink()
+    if output_format == PARQUET:
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    for batch in batches:
+        writer.write_table(arrow_table(batch, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export(config_front, output_format) -> Response:
+    """Returns the streamed response of the results of a configuration."""
+    validate(config_front)
+    query = get_fhir2ecrf()
+    try:
+        post_treatments = query.column_post_treatments(config_front)
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+    batches = query.query_batches(config_front)
+    if output_format == CSV:
+        chunks = csv_chunks(batches)
+    else:
+        columns = [attribute["customName"] for attribute in config_front["attributes"]]
+        integer_columns = {name for name, type_ in post_treatments.items() if type_ == "bool"}
+        chunks = arrow_chunks(batches, arrow_schema(columns, integer_columns), output_format)
+
+    response = Response(stream_with_context(chunks), mimetype=output_format)
+    filename = f"ecrf.{EXTENSIONS[output_format]}"
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
@@ -4,3 +4,7 @@ class BadRequest(Exception):
 
 class AuthenticationError(Exception):
     pass
+
+
+class NotFound(Exception):
+    pass
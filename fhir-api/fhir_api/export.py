@@ -0,0 +1,180 @@
+"""
+FHIR Bulk Data export (see https://hl7.org/fhir/uv/bulkdata/export/index.html).
+
+Resources are streamed from the mongo collections, one cursor batch at a time,
+to NDJSON files capped to EXPORT_MAX_FILE_SIZE bytes. The exports run as
+background jobs, whose result is the export manifest.
+
+The `_since` parameter filters on the meta.lastUpdated stamped by the writes of
+the API (see changes.stamp). The resources written by other services, without
+one, are always exported: when they last changed is unknown.
+"""
+import datetime
+import os
+import re
+
+from fhir_api import changes, jobs, settings
+from fhir_api.db import get_store
+from fhir_api.errors import BadRequest, NotFound
+from fhir_api.serialization import dumps
+
+SYSTEM = "system"
+PATIENT = "patient"
+GROUP = "group"
+
+INSTANT = re.compile(
+    r"(?P<datetime>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2})"
+    r"(\.(?P<fraction>[0-9]+))?(?P<timezone>Z|[+-][0-9]{2}:[0-9]{2})"
+)
+
+# references to the patient of the resources of the patient compartment
+PATIENT_REFERENCES = ["subject.reference", "patient.reference"]
+
+
+class NDJSONWriter:
+    """Writes resources to NDJSON files, one file per resource type and per
+    `max_file_size` bytes."""
+
+    def __init__(self, directory, max_file_size):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        # list of (resource type, file name, count)
+        self.outputs = []
+        self._file = None
+        self._file_type = None
+        self._file_size = 0
+
+    def write(self, resource_type, resource):
+        line = dumps(resource) + b"\n"
+        if resource_type != self._file_type or self._file_size + len(line) > self.max_file_size:
+            self._open(resource_type)
+
+        self._file.write(line)
+        self._file_size += len(line)
+        type_, name, count = self.outputs[-1]
+        self.outputs[-1] = (type_, name, count + 1)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _open(self, resource_type):
+        self.close()
+        index = sum(1 for type_, _, _ in self.outputs if type_ == resource_type) + 1
+        name = f"{resource_type}.{index}.ndjson"
+        self._file = open(os.path.join(self.directory, name), "wb")
+        self._file_type = resource_type
+        self._file_size = 0
+        self.outputs.append((resource_type, name, 0))
+
+
+def parse_types(types, resource_types):
+    if not types:
+        return list(resource_types)
+
+    types = types.split(",")
+    unknown = [t for t in types if t not in resource_types]
+    if unknown:
+        raise BadRequest(f"Unknown resource types: {', '.join(unknown)}")
+    return types
+
+
+def parse_since(since):
+    """Validates the `_since` parameter, a FHIR instant, and returns it in
+    the format of the stamped meta.lastUpdated."""
+    if not since:
+        return None
+    match = INSTANT.fullmatch(since)
+    try:
+        if not match:
+            raise ValueError("not an instant")
+        value = datetime.datetime.strptime(
+            match["datetime"] + match["timezone"], "%Y-%m-%dT%H:%M:%S%z"
+        )
+    except ValueError:
+        raise BadRequest(f"Invalid _since, a FHIR instant is expected: {since}")
+    microseconds = int((match["fraction"] or "")[:6].ljust(6, "0"))
+    return changes.format_instant(value.replace(microsecond=microseconds))
+
+
+def get_group_patients(group_id):
+    """Returns the references to the patients who are members of a Group."""
+    group = get_store().db["Group"].find_one({"id": group_id}, {"member.entity.reference": 1})
+    if not group:
+        raise NotFound(f"Unknown group: {group_id}")
+
+    references = [member.get("entity", {}).get("reference") for member in group.get("member", [])]
+    return [ref for ref in references if ref and ref.startswith("Patient/")]
+
+
+def build_query(level, resource_type, since=None, patients=None):
+    """Builds the mongo query selecting the resources to export.
+
+    `since` is an instant formatted by parse_since. For the patient and group
+    levels, only the resources of the patient compartment are exported: the
+    patients themselves and the resources referencing them as subject or
+    patient. `patients` holds the references to the patients of the group.
+    """
+    query = {}
+    if since:
+        updated = [{"meta.lastUpdated": {"$gte": since}}, {"meta.lastUpdated": {"$exists": False}}]
+        query["$and"] = [{"$or": updated}]
+    if level == SYSTEM:
+        return query
+
+    if resource_type == "Patient":
+        if patients is not None:
+            query["id"] = {"$in": [ref[len("Patient/") :] for ref in patients]}
+        return query
+
+    match = {"$in": patients} if patients is not None else {"$regex": "^Patient/"}
+    query["$or"] = [{reference: match} for reference in PATIENT_REFERENCES]
+    return query
+
+
+def get_output_directory(job_id, filename):
+    """Returns the directory of an output file of a completed export job, or
+    None if the job did not output this file."""
+    job = jobs.get_job(job_id)
+    if not job or job["kind"] != "export" or job["status"] != jobs.COMPLETED:
+        return None
+    urls = {output["url"] for output in job["result"]["output"]}
+    if f"{job['params']['files_url']}/{job_id}/{filename}" not in urls:
+        return None
+    return jobs.job_path(job_id)
+
+
+@jobs.task("export")
+def export_task(progress, level, types, files_url, kickoff_url, since=None, group_id=None):
+    transaction_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    store = get_store()
+    patients = get_group_patients(group_id) if level == GROUP else None
+
+    writer = NDJSONWriter(jobs.get_job_path(progress.job_id), settings.EXPORT_MAX_FILE_SIZE)
+    processed = 0
+    try:
+        for i, resource_type in enumerate(types):
+            cursor = store.db[resource_type].find(
+                build_query(level, resource_type, since=since, patients=patients),
+                {"_id": 0},
+                batch_size=settings.EXPORT_BATCH_SIZE,
+            )
+            for resource in cursor:
+                writer.write(resource_type, resource)
+                processed += 1
+                progress.report(processed=processed, types=f"{i}/{len(types)}")
+    finally:
+        writer.close()
+
+    progress.report(processed=processed, types=f"{len(types)}/{len(types)}")
+    return {
+        "transactionTime": transaction_time,
+        "request": kickoff_url,
+        "requiresAccessToken": not settings.AUTH_DISABLED,
+        "output": [
+            {"type": type_, "url": f"{files_url}/{progress.job_id}/{name}", "count": count}
+            for type_, name, count in writer.outputs
+        ],
+        "error": [],
+    }
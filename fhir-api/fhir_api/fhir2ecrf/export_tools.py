@@ -1,8 +1,12 @@
 """
 Module providing tools for post-processing configuration files and dataframes
 """
+import re
 from collections import defaultdict
 
+import numpy as np
+import pandas as pd
+
 from fhir2dataset import timing
 
 CONFIG_MAPPING = {
@@ -20,116 +24,53 @@ CONFIG_MAPPING = {
 
 @timing
 def create_config(df_keep, patients_id):
-    from_dict = defaultdict()
-    select_dict = defaultdict(list)
+    """Builds the fhir2dataset configuration from the metadata rows of the
+    requested attributes, grouped by alias."""
+    df = df_keep.rename(columns={col_name: key for key, col_name in CONFIG_MAPPING.items()})
+    ids_values = get_id_patients(patients_id)
+
+    aliases = df.drop_duplicates(["alias", "resource_type"])
+    assert not aliases["alias"].duplicated().any(), "There is a probleme of alias compabilities"
+    from_dict = dict(zip(aliases["alias"], aliases["resource_type"]))
+
+    selects = df[df["select_expression"].notna()]
+    select_dict = selects.groupby("alias", sort=False)["select_expression"].agg(list).to_dict()
+
     join_dict = defaultdict(dict)
     where_dict = defaultdict(dict)
-
-    for i in range(len(df_keep.index)):
-        data_line = df_keep.iloc[i]
-        infos = {key: data_line[col_name] for key, col_name in CONFIG_MAPPING.items()}
-
-        jsonpath_search = "id"
-        ids_values = get_id_patients(patients_id)
-        where_dict["patient"][jsonpath_search] = ids_values
-
-        from_dict = update_from_data_line(from_dict, infos["alias"], infos["resource_type"])
-
-        select_dict = update_select_data_line(
-            select_dict, infos["select_expression"], infos["alias"]
-        )
-
-        where_dict = update_where_data_line(
-            where_dict,
-            infos["how"],
-            infos["alias_child"],
-            infos["alias"],
-            infos["searchparam"],
-            infos["prefix"],
-            infos["jsonpath"],
-            infos["value"],
-            ids_values,
-        )
-
-        join_dict = update_join_data_line(
-            join_dict,
-            infos["how"],
-            infos["alias"],
-            infos["alias_child"],
-            infos["searchparam"],
-        )
+    where_dict["patient"]["id"] = ids_values
+    rows = df[df["how"].notna() | df["jsonpath"].notna()]
+    for row in rows[list(CONFIG_MAPPING)].itertuples(index=False):
+        if not isNaN(row.how):
+            join_dict[row.how].setdefault(row.alias, {})[row.searchparam] = row.alias_child
+            if row.alias_child == "patient":
+                where_dict[row.alias][f"{row.searchparam}.reference"] = ids_values
+        if not isNaN(row.jsonpath):
+            if isNaN(row.prefix):
+                where_dict[row.alias][row.jsonpath] = row.value
+            else:
+                where_dict[row.alias].setdefault(row.jsonpath, {})[row.prefix] = row.value
 
     config = {
-        "from": dict(from_dict),
-        "select": dict(select_dict),
+        "from": from_dict,
+        "select": select_dict,
         "join": dict(join_dict),
         "where": dict(where_dict),
     }
     return config
 
 
-def update_join_data_line(join_dict, how, alias, alias_child, searchparam):
-    if not isNaN(how):
-        if alias not in list(join_dict[how].keys()):
-            join_dict[how][alias] = dict()
-        join_dict[how][alias][searchparam] = alias_child
-    return join_dict
-
-
-def update_where_data_line(
-    where_dict,
-    how,
-    alias_child,
-    alias,
-    searchparam,
-    prefix,
-    jsonpath,
-    value,
-    ids_values,
-):
-    if not isNaN(how):
-        if alias_child == "patient":
-            where_dict[alias][f"{searchparam}.reference"] = ids_values
-
-    if not isNaN(jsonpath):
-        if jsonpath not in list(where_dict[alias].keys()):
-            where_dict[alias][jsonpath] = dict()
-        if not isNaN(prefix):
-            where_dict[alias][jsonpath][prefix] = value
-        else:
-            where_dict[alias][jsonpath] = value
-    return where_dict
-
-
-def update_select_data_line(select_dict, select_expression, alias):
-    if not isNaN(select_expression):
-        select_dict[alias].append(select_expression)
-    return select_dict
-
-
-def update_from_data_line(from_dict, alias, resource_type):
-    if alias in list(from_dict.keys()):
-        assert from_dict[alias] == resource_type, "There is a probleme of alias compabilities"
-    else:
-        from_dict[alias] = resource_type
-    return from_dict
-
-
 def get_id_patients(patients_id):
-    ids_val = patients_id[0]
-    for id in patients_id[1:]:
-        ids_val = f"{ids_val},{id}"
-    return ids_val
+    return ",".join(str(id) for id in patients_id)
 
 
 def isNaN(num):
     return num != num
 
 
-def change_alias(string, alias_old, alias_new):
-    if isinstance(string, str):
-        string = string.replace(alias_old, alias_new)
-    return string
+def change_alias(df, alias_old, alias_new):
+    """Replaces an alias in the string cells of a dataframe."""
+    return df.replace(re.escape(alias_old), alias_new.replace("\\", "\\\\"), regex=True)
 
 
 def treatment_first(x):
@@ -157,3 +98,45 @@ def treatment_list(x):
         return result
     else:
         return x
+
+
+def _first_value(values):
+    for value in values:
+        if value == value:
+            return value
+    return values[0]
+
+
+def _first_cell(x):
+    return _first_value(x) if isinstance(x, list) else x
+
+
+def _list_cell(x):
+    if isinstance(x, list):
+        return "; ".join(map(format, x)) if len(x) > 1 else x[0]
+    return x
+
+
+# The list treatments are mapped over the object columns with Series.map, which
+# infers the result dtype as DataFrame.applymap. Exploding the lists to work on
+# flat arrays is slower: the cells are Python objects either way.
+
+
+def treatment_first_column(column):
+    """treatment_first on each cell of a column"""
+    if column.dtype.kind in "biuf":
+        return column.copy()
+    return column.map(_first_cell)
+
+
+def treatment_bool_column(column):
+    """treatment_bool on each cell of a column"""
+    values = column.to_numpy(dtype=object)
+    return pd.Series(np.where(values != values, 0, 1), index=column.index, name=column.name)
+
+
+def treatment_list_column(column):
+    """treatment_list on each cell of a column"""
+    if column.dtype.kind in "biuf":
+        return column.copy()
+    return column.map(_list_cell)
@@ -1,19 +1,27 @@
 import logging
 import os
-from collections import defaultdict
+import resource
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 
 import pandas as pd
 
 from fhir2dataset import FHIRRules, Query, timing
 
+from fhir_api import settings
+
 from .export_tools import (
     change_alias,
     create_config,
-    treatment_bool,
-    treatment_first,
-    treatment_list,
+    treatment_bool_column,
+    treatment_first_column,
+    treatment_list_column,
 )
+from .mongo_query import MongoQuery
+from .result_cache import config_key
 
 logger = logging.getLogger(__name__)
 
@@ -32,10 +40,11 @@ MODIFIERS_POSS = [
     "not-in",
 ]
 
+# applied column by column (see export_tools.treatment_*)
 POST_TREAMENTS = {
-    "bool": treatment_bool,
-    "first": treatment_first,
-    "list": treatment_list,
+    "bool": treatment_bool_column,
+    "first": treatment_first_column,
+    "list": treatment_list_column,
 }
 
 
@@ -78,7 +87,11 @@ class FHIR2eCRF:
     Attributes:
         token (str): bearer token authentication if necessary (default: {None})
         fhir_api_url (str): The Service Base URL (e.g. http://hapi.fhir.org/baseR4/)
-        fhir_rules (type(FHIRRules)): an instance of a FHIRRules-type object
+        db (pymongo.database.Database): database of the store, queried directly instead of the FHIR API when provided (default: {None})
+        chunk_size (int): number of patients queried at once, the idPatient list is split in chunks (default: {settings.ECRF_CHUNK_SIZE})
+        max_workers (int): number of chunks queried concurrently, which bounds the memory used by the queries (default: {settings.ECRF_MAX_WORKERS})
+        result_cache (ResultCache): cache of the results, by configuration (default: {None})
+        fhir_rules (type(FHIRRules)): an instance of a FHIRRules-type object (only used by the FHIR API queries)
         df_crf_attributes (pd.DataFrame): dataframe containing the configurations related to each crf attribute
 
     Example:
@@ -88,23 +101,49 @@ class FHIR2eCRF:
         logging.basicConfig()
         fhir2ecrf = FHIR2eCRF(token=token, fhir_api_url=fhir_api_url)
         df = fhir2ecrf.query(config_front)
+
+        # or, in the FHIR API process, without the HTTP round trips:
+        fhir2ecrf = FHIR2eCRF(db=get_store().db, result_cache=get_result_cache())
     """  # noqa
 
     @timing
-    def __init__(self, token: str = None, fhir_api_url: str = None):
+    def __init__(
+        self,
+        token: str = None,
+        fhir_api_url: str = None,
+        db=None,
+        chunk_size: int = None,
+        max_workers: int = None,
+        result_cache=None,
+    ):
         """Metadata loading
 
         Args:
             token (str, optional): bearer token authentication if necessary. Defaults to None.
             fhir_api_url (str, optional): The Service Base URL (e.g. http://hapi.fhir.org/baseR4/). Defaults to None.
+            db (pymongo.database.Database, optional): database of the store, queried directly (see MongoQuery) instead of the FHIR API. Defaults to None.
+            chunk_size (int, optional): number of patients queried at once. Defaults to settings.ECRF_CHUNK_SIZE.
+            max_workers (int, optional): number of chunks of patients queried concurrently. Defaults to settings.ECRF_MAX_WORKERS.
+            result_cache (ResultCache, optional): cache of the results, invalidated by the changes of the resource types they depend on. Defaults to None.
         """  # noqa
         self.token = token
         self.fhir_api_url = fhir_api_url
+        self.db = db
+        self.chunk_size = chunk_size or settings.ECRF_CHUNK_SIZE
+        self.max_workers = max_workers or settings.ECRF_MAX_WORKERS
+        self.result_cache = result_cache
+        # the metadata dataframes are not safe to read from several threads
+        self._config_lock = threading.Lock()
         self.df_crf_attributes = self._load_crf_attributes()
-        self.fhir_rules = FHIRRules(fhir_api_url=self.fhir_api_url)
+        # metadata rows by officialName, and the attributes filtered by text
+        self.crf_attributes = self._index_crf_attributes()
+        self.crf_text_attributes = set(
+            self.df_crf_attributes[self.df_crf_attributes["type"] == "text"]["officialName"]
+        )
+        self.fhir_rules = FHIRRules(fhir_api_url=self.fhir_api_url) if db is None else None
 
     @timing
-    def query(self, config_front: dict) -> pd.DataFrame:
+    def query(self, config_front: dict, stats: list = None) -> pd.DataFrame:
         """Perform the query on the FHIR Api according to the config_front of the following form:
             {
             "attributes":[
@@ -140,31 +179,153 @@ class FHIR2eCRF:
 
             Args:
                 config_front (dict): json instance of the previous configuration file
+                stats (list, optional): list receiving the statistics of the queried chunks (see query_batches)
 
             Returns:
                 pd.DataFrame: pandas dataframe containing the correspondant data
         """  # noqa
-        post_treatements, columns_renaming, config = self._create_config_fhir2dataset(config_front)
+        df = pd.concat(list(self.query_batches(config_front, stats=stats)), ignore_index=True)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Main dataframe after after rearranging the columns\n{df.to_string()}")
+        return df
+
+    def query_batches(self, config_front: dict, stats: list = None):
+        """Yields the results of the query (see query) chunk of patients by
+        chunk of patients, in the order of the patients, with the columns in
+        the order of the attributes. Only the chunks being queried and the
+        one being consumed are held in memory.
+
+        The size, number of rows and duration of each queried chunk are
+        appended to `stats`, if provided (nothing is queried on cache hits).
+        """
+        patients_id = config_front["idPatient"]
+        assert len(patients_id) > 0, "At least one patient ID must be filled in the config_front"
+
+        if self.result_cache is None:
+            yield from self._query_chunks(config_front, stats)
+            return
+
+        cache_key = config_key(config_front)
+        batches = self.result_cache.get_batches(cache_key)
+        if batches is not None:
+            logger.info(f"{len(patients_id)} patients results found in the cache")
+            yield from batches
+            return
+        # read before the query (see ResultCache.types_generations)
+        generations = self.result_cache.types_generations(self.resource_types(config_front))
+        yield from self.result_cache.store_batches(
+            cache_key, self._query_chunks(config_front, stats), generations
+        )
+
+    def _query_chunks(self, config_front: dict, stats: list = None):
+        """Queries the chunks of patients concurrently, at most max_workers
+        chunks ahead of the one consumed"""
+        patients_id = config_front["idPatient"]
         cols_order = [attribute["customName"] for attribute in config_front["attributes"]]
+        chunks_config = [
+            (index, {**config_front, "idPatient": patients_id[i : i + self.chunk_size]})
+            for index, i in enumerate(range(0, len(patients_id), self.chunk_size))
+        ]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks_config))) as executor:
+            futures = deque()
+            for index, chunk_config in chunks_config:
+                futures.append(executor.submit(self._query_chunk, index, chunk_config, stats))
+                if len(futures) >= self.max_workers:
+                    yield futures.popleft().result()[cols_order]
+            while futures:
+                yield futures.popleft().result()[cols_order]
+
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        logger.info(
+            f"{len(patients_id)} patients queried in {len(chunks_config)} chunks "
+            f"(at most {self.max_workers} concurrently), peak memory: {peak_memory:.1f} MB"
+        )
+
+    def resource_types(self, config_front: dict) -> set:
+        """Returns the resource types queried for a configuration"""
+        _, _, config = self._patient_config(config_front)
+        return set(config["from"].values())
 
-        query = Query(fhir_api_url=self.fhir_api_url, fhir_rules=self.fhir_rules, token=self.token)
+    def column_post_treatments(self, config_front: dict) -> dict:
+        """Returns the post-treatment (see POST_TREAMENTS) of each column"""
+        post_treatments, _, _ = self._patient_config(config_front)
+        return {
+            column: post_treatment
+            for post_treatment, columns in post_treatments.items()
+            for column in columns
+        }
+
+    def _patient_config(self, config_front: dict):
+        """Returns the configuration of the query of the first patient"""
+        config_patient = {**config_front, "idPatient": config_front["idPatient"][:1]}
+        with self._config_lock:
+            return self._create_config_fhir2dataset(config_patient)
+
+    def _query_chunk(self, index: int, config_front: dict, stats: list = None) -> pd.DataFrame:
+        """Performs the query of a chunk of the patients, renames the columns
+        and applies the post-treatments"""
+        started_at = time.perf_counter()
+        with self._config_lock:
+            post_treatements, columns_renaming, config = self._create_config_fhir2dataset(
+                config_front
+            )
+
+        if self.db is not None:
+            query = MongoQuery(self.db)
+        else:
+            query = Query(
+                fhir_api_url=self.fhir_api_url, fhir_rules=self.fhir_rules, token=self.token
+            )
         query.from_config(config)
         query.execute()
         df = query.main_dataframe
 
         df.rename(columns=columns_renaming, inplace=True)
-        logger.debug(f"Main dataframe after columns renaming\n{df.to_string()}")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"Main dataframe after columns renaming\n{df.to_string()}")
         for post_treatement_type, list_cols in post_treatements.items():
-            df[list_cols] = df[list_cols].applymap(POST_TREAMENTS[post_treatement_type])
-        logger.debug(f"Main dataframe after post-treaments\n{df.to_string()}")
-        df = df[cols_order]
-        logger.debug(f"Main dataframe after after rearranging the columns\n{df.to_string()}")
+            df[list_cols] = df[list_cols].apply(POST_TREAMENTS[post_treatement_type])
+        if debug:
+            logger.debug(f"Main dataframe after post-treaments\n{df.to_string()}")
+
+        chunk_stats = {
+            "chunk": index,
+            "patients": len(config_front["idPatient"]),
+            "rows": len(df),
+            "megabytes": round(df.memory_usage(deep=True).sum() / 1e6, 3),
+            "elapsed": round(time.perf_counter() - started_at, 3),
+        }
+        if stats is not None:
+            stats.append(chunk_stats)
+        logger.info(f"Chunk queried: {chunk_stats}")
         return df
 
     @timing
     def _load_crf_attributes(self):
         return pd.read_csv(PATH_CRF_ATTRIBUTES)
 
+    @timing
+    def _index_crf_attributes(self) -> dict:
+        """Groups the metadata rows by officialName"""
+        return {
+            official_name: df
+            for official_name, df in self.df_crf_attributes.groupby("officialName", sort=False)
+        }
+
+    def _check_attributes(self, attributes) -> set:
+        """Returns the official names of the attributes, raises a ValueError
+        if one is unknown, or if a text attribute has no text"""
+        official_names = set()
+        for attribute in attributes:
+            official_name = attribute["officialName"].lower()
+            if official_name not in self.crf_attributes:
+                raise ValueError(f"Unknown officialName: {official_name}")
+            if official_name in self.crf_text_attributes and not attribute.get("text"):
+                raise ValueError(f"Missing text of the attribute: {attribute['officialName']}")
+            official_names.add(official_name)
+        return official_names
+
     @timing
     def _create_config_fhir2dataset(self, config_front):
         df = self.df_crf_attributes
@@ -172,48 +333,33 @@ class FHIR2eCRF:
         patients_id = config_front["idPatient"]
         assert len(patients_id) > 0, "At least one patient ID must be filled in the config_front"
 
-        attributes_keep = [
-            attribute["officialName"].lower() for attribute in config_front["attributes"]
-        ]
-        attributes_keep += ["id"]
-        df_infos = df[df["officialName"].isin(attributes_keep)]
-        list_text_attribute = df_infos[df_infos["type"] == "text"]["officialName"].to_list()
-
-        df_keep = df_infos[~df_infos["officialName"].isin(list_text_attribute)]
+        attributes_keep = self._check_attributes(config_front["attributes"])
+        attributes_keep.add("id")
+        df_keep = df[df["officialName"].isin(attributes_keep - self.crf_text_attributes)]
 
+        df_texts = []
         columns_renaming = {}
         for attribute in config_front["attributes"]:
             official_name = attribute["officialName"].lower()
             col_name_export = attribute["customName"]
-            if official_name in list_text_attribute:
+            df_infos = self.crf_attributes[official_name]
+            if official_name in self.crf_text_attributes:
                 text = attribute["text"]
-                df_temp = df_infos[df_infos["officialName"] == official_name]
-                idx_change = df_temp.index[df_temp["type"] == "text"].to_list()
-                alias_old = df_temp.loc[idx_change[0], "from:alias"]
-                df_temp.loc[idx_change[0], "where:value"] = text
+                idx_change = df_infos.index[df_infos["type"] == "text"][0]
+                alias_old = df_infos.loc[idx_change, "from:alias"]
+                df_temp = df_infos.copy()
+                df_temp.loc[idx_change, "where:value"] = text
                 alias_new = f"{alias_old}_{text}"
-                df_temp = df_temp.applymap(lambda x: change_alias(x, alias_old, alias_new))
-                select = df_temp.loc[idx_change[0], "select:jsonpath"]
+                df_temp = change_alias(df_temp, alias_old, alias_new)
+                select = df_temp.loc[idx_change, "select:jsonpath"]
                 modifier = select.split(":")[-1]
                 if modifier in MODIFIERS_POSS:
                     select = ":".join(select.split(":")[:-1])
                 col_name_internal = f"{alias_new}:{select}"
-                df_keep = pd.concat([df_keep, df_temp])
+                df_texts.append(df_temp)
             else:
-                try:
-                    col_name_internal = df_infos[df_infos["officialName"] == official_name][
-                        "internal_column_name"
-                    ].iloc[0]
-                except IndexError:
-                    logger.info(f"officialName: {official_name}")
-                    logger.info("df_crf_attributes:")
-                    logger.info(pformat(df))
-                    logger.info("df_infos:")
-                    logger.info(pformat(df_infos))
-                    raise
-            post_treatment_type = df_infos[df_infos["officialName"] == official_name][
-                "column_post_treatment"
-            ].iloc[0]
+                col_name_internal = df_infos["internal_column_name"].iloc[0]
+            post_treatment_type = df_infos["column_post_treatment"].iloc[0]
             post_treatement[post_treatment_type].append(col_name_export)
             assert post_treatment_type in list(
                 POST_TREAMENTS.keys()
@@ -221,9 +367,12 @@ class FHIR2eCRF:
             if col_name_internal not in list(columns_renaming.keys()):
                 columns_renaming[col_name_internal] = col_name_export
 
+        df_keep = pd.concat([df_keep, *df_texts])
         config = create_config(df_keep, patients_id)
-        logger.info("config created:")
-        logger.info(pformat(config))
+        if logger.isEnabledFor(logging.DEBUG):
+            # without the "where" part, which lists the ids of the patients
+            logger.debug("config created:")
+            logger.debug(pformat({key: config[key] for key in ("from", "select", "join")}))
         logger.debug("columns renaming")
         logger.debug(pformat(columns_renaming))
         logger.debug("post-treaments to be performed")
@@ -0,0 +1,270 @@
+"""
+Execution of fhir2dataset configurations directly against the mongo
+collections of the store, instead of going through the FHIR API.
+
+The aliases are fetched one after the other, starting from the alias which is
+only referenced by the others (the patients). The resources of the joined
+aliases are fetched with batched `$in` queries on the ids (or references) of
+the resources already fetched, with a projection on the selected elements.
+The tables of the aliases are built column-wise, then joined with the same
+semantics as fhir2dataset.Query.
+"""
+import logging
+import re
+from collections import deque
+from itertools import product
+
+import pandas as pd
+
+from fhir2dataset import timing
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# pandas merge of the parent (referencing) and child (referenced) tables
+JOIN_HOW = {"child": "right", "parent": "left", "inner": "inner", "one": "inner"}
+
+PREFIXES = {"eq": "$eq", "ne": "$ne", "gt": "$gt", "lt": "$lt", "ge": "$gte", "le": "$lte"}
+
+
+def path_values(resource, path) -> list:
+    """Returns the values of a dotted path (simple fhirpath) in a resource,
+    flattening the lists."""
+    values = [resource]
+    for key in path.split("."):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict) and key in value:
+                item = value[key]
+                next_values.extend(item if isinstance(item, list) else [item])
+        values = next_values
+    return values
+
+
+def element_path(resource_type, path):
+    """Removes the resource type from a fhirpath (Patient.name -> name)."""
+    return path[len(resource_type) + 1 :] if path.startswith(f"{resource_type}.") else path
+
+
+def parse_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def where_condition(key, value) -> (str, dict):
+    """Translates a where condition of the configuration to a mongo query on
+    the element path."""
+    path, _, modifier = key.partition(":")
+    prefix = None
+    if isinstance(value, dict):
+        # {"ge": "1970"}
+        prefix, value = list(value.items())[-1]
+    values = str(value).split(",")
+
+    if modifier in ("contains", "text"):
+        pattern = "|".join(re.escape(value) for value in values)
+        return path, {"$regex": pattern, "$options": "i"}
+    if modifier == "missing":
+        return path, {"$exists": values[0] != "true"}
+    if modifier not in ("", "exact"):
+        raise ValueError(f"the {modifier} modifier is not supported")
+    if prefix is not None:
+        return path, {PREFIXES[prefix]: parse_value(values[0])}
+    return path, {"$in": values}
+
+
+def projection(paths) -> dict:
+    """Returns a projection on paths, without the paths included in others
+    (which mongo rejects)."""
+    paths = sorted(set(paths))
+    kept = [
+        path
+        for path in paths
+        if not any(path.startswith(f"{other}.") for other in paths if other != path)
+    ]
+    return {"_id": 0, **{path: 1 for path in kept}}
+
+
+class Join:
+    def __init__(self, how, parent, searchparam, child):
+        self.how = JOIN_HOW.get(how.lower(), "inner")
+        self.parent = parent
+        self.searchparam = searchparam
+        self.child = child
+
+    @property
+    def parent_on(self):
+        return f"{self.parent}:join_{self.searchparam}"
+
+    @property
+    def child_on(self):
+        return f"{self.child}:from_id"
+
+    def other(self, alias):
+        return self.child if alias == self.parent else self.parent
+
+
+class MongoQuery:
+    """Runs a fhir2dataset configuration against the collections of a mongo
+    database. It has the same interface as fhir2dataset.Query.
+
+    The select elements, the where conditions and the join search parameters
+    must be element paths (e.g. `valueQuantity.value`, `subject`); the where
+    values are matched exactly, or as case insensitive substrings with the
+    :contains modifier.
+
+    Attributes:
+        db (pymongo.database.Database): database of the store
+        batch_size (int): number of ids of a batched $in join
+        dataframes (dict): table of each alias
+        main_dataframe (pd.DataFrame): result table
+
+    Example:
+        query = MongoQuery(get_store().db)
+        query.from_config(config)
+        query.execute()
+        df = query.main_dataframe
+    """
+
+    def __init__(self, db, batch_size=BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.config = None
+        self.joins = []
+        self.dataframes = {}
+        self.main_dataframe = None
+
+    def from_config(self, config: dict):
+        self.config = {
+            "from": config.get("from") or {},
+            "select": config.get("select") or {},
+            "where": config.get("where") or {},
+        }
+        self.joins = [
+            Join(how, parent, searchparam, child)
+            for how, relationships in (config.get("join") or {}).items()
+            for parent, searchparams in relationships.items()
+            for searchparam, child in searchparams.items()
+        ]
+
+    @timing
+    def execute(self):
+        """Fetches the aliases along the joins, then joins their tables."""
+        root = self._root_alias()
+        self.dataframes = {root: self._fetch(root)}
+        main_df = self.dataframes[root]
+
+        queue = deque([root])
+        done = {root}
+        while queue:
+            alias = queue.popleft()
+            for join in self.joins:
+                if alias not in (join.parent, join.child) or join.other(alias) in done:
+                    continue
+                other = join.other(alias)
+                df = self._fetch(other, self._join_filter(join, other))
+                self.dataframes[other] = df
+                if other == join.parent:
+                    main_df = pd.merge(
+                        df, main_df, left_on=join.parent_on, right_on=join.child_on, how=join.how
+                    )
+                else:
+                    main_df = pd.merge(
+                        main_df, df, left_on=join.parent_on, right_on=join.child_on, how=join.how
+                    )
+                done.add(other)
+                queue.append(other)
+
+        columns = [
+            f"{alias}:{select}"
+            for alias in self.config["from"]
+            for select in self.config["select"].get(alias, [])
+        ]
+        self.main_dataframe = main_df[columns].reset_index(drop=True)
+
+    def _root_alias(self):
+        """Returns the alias which does not reference the others, if any."""
+        parents = {join.parent for join in self.joins}
+        aliases = list(self.config["from"])
+        return next((alias for alias in aliases if alias not in parents), aliases[0])
+
+    def _join_filter(self, join, alias):
+        """Returns the (path, values) restricting the resources of an alias to
+        the ones joined with the table already fetched, or None if the join
+        keeps all of them."""
+        if alias == join.parent:
+            if join.how not in ("right", "inner"):
+                return None
+            references = self.dataframes[join.child][join.child_on].dropna().unique()
+            return f"{join.searchparam}.reference", list(references)
+        if join.how not in ("left", "inner"):
+            return None
+        references = self.dataframes[join.parent][join.parent_on].dropna().unique()
+        return "id", [reference.split("/")[-1] for reference in references]
+
+    def _query(self, alias) -> dict:
+        resource_type = self.config["from"][alias]
+        references = self._references(alias)
+        query = {}
+        for key, value in self.config["where"].get(alias, {}).items():
+            # the conditions on the references of the joins are implied
+            if key not in references:
+                path, condition = where_condition(key, value)
+                query[element_path(resource_type, path)] = condition
+        return query
+
+    def _fetch(self, alias, join_filter=None) -> pd.DataFrame:
+        resource_type = self.config["from"][alias]
+        query = self._query(alias)
+        paths = ["id"] + self._references(alias) + self._selects(alias)
+        collection = self.db[resource_type]
+        if join_filter is None:
+            return self._table(alias, collection.find(query, projection(paths)))
+
+        path, values = join_filter
+        documents, found = [], set()
+        for i in range(0, len(values), self.batch_size):
+            batch = {path: {"$in": values[i : i + self.batch_size]}}
+            for document in collection.find({"$and": [query, batch]}, projection(paths)):
+                # a resource may reference resources of several batches
+                if document["id"] not in found:
+                    found.add(document["id"])
+                    documents.append(document)
+        return self._table(alias, documents)
+
+    def _references(self, alias) -> list:
+        return [f"{join.searchparam}.reference" for join in self.joins if join.parent == alias]
+
+    def _selects(self, alias) -> list:
+        resource_type = self.config["from"][alias]
+        return [element_path(resource_type, path) for path in self.config["select"].get(alias, [])]
+
+    def _table(self, alias, documents) -> pd.DataFrame:
+        """Builds the table of an alias column by column, with a row per
+        reference of the joins (as fhir2dataset)."""
+        resource_type = self.config["from"][alias]
+        references = self._references(alias)
+        selects = self._selects(alias)
+        names = [
+            "from_id",
+            *(f"join_{join.searchparam}" for join in self.joins if join.parent == alias),
+            *self.config["select"].get(alias, []),
+        ]
+        columns = [[] for _ in names]
+
+        for document in documents:
+            from_id = f"{resource_type}/{document['id']}"
+            cells = [path_values(document, path) for path in selects]
+            for row_references in product(*(path_values(document, path) for path in references)):
+                for column, value in zip(columns, [from_id, *row_references, *cells]):
+                    column.append(value)
+
+        return pd.DataFrame(
+            {
+                f"{alias}:{name}": pd.Series(column, dtype=object)
+                for name, column in zip(names, columns)
+            }
+        )
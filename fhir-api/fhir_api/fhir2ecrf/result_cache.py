@@ -0,0 +1,318 @@
+"""
+Cache of the eCRF results on local disk, shared by the workers.
+
+The results are keyed by a canonical hash of the configuration sent by the
+front-end (attributes and patients), and stored column by column (numpy .npz
+archives, one array per column of each batch of results), so that the dtypes
+of the columns are kept as is. The object columns (strings, lists...) are
+stored as JSON: the entries are read back without unpickling anything. The
+results are written and read back batch by batch, without holding all of them
+in memory.
+
+Each entry records the versions (see changes.type_versions) of the resource
+types of its query: it is dropped as soon as one of them changes. The versions
+only see the writes of the API, and the ones of the other services when the
+change stream subscriber runs: without it, the entries also expire after
+ECRF_RESULTS_MAX_AGE seconds. The least recently used entries are evicted when
+the cache exceeds its size.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from fhir_api import cache, changes, settings
+
+logger = logging.getLogger(__name__)
+
+# version of the format of the entries, part of their key
+FORMAT_VERSION = 3
+
+SUFFIX = ".npz"
+
+result_cache = None
+
+
+def config_key(config_front: dict) -> str:
+    """Returns the key of the results of a configuration. The order of the
+    attributes (order of the columns) and of the patients (order of the rows)
+    is kept, the keys of the attributes are sorted."""
+    canonical = json.dumps(
+        {
+            "version": FORMAT_VERSION,
+            "attributes": config_front["attributes"],
+            "idPatient": [str(id) for id in config_front["idPatient"]],
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """LRU cache of dataframes on disk, invalidated by generations.
+
+    Attributes:
+        path (str): directory of the entries, only accessible to its owner
+        max_bytes (int): size of the entries above which the least recently
+            used ones are evicted
+        generations (cache.Generations): versions of the resource types
+        max_age (float): lifetime of the entries in seconds, None if they
+            are only invalidated by the generations
+    """
+
+    def __init__(self, path: str, max_bytes: int, generations, max_age: float = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.generations = generations
+        self.max_age = max_age
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # the statistics are updated by the threads of the workers
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def types_generations(self, resource_types) -> dict:
+        """Returns the current generations of resource types. They must be
+        read before the query, so that the results of a query run during a
+        write are cached under an outdated generation."""
+        return {type_: self.generations.get(type_) for type_ in sorted(set(resource_types))}
+
+    def get(self, key) -> pd.DataFrame:
+        """Returns the cached dataframe, or None if it is missing or if one
+        of its resource types changed since it was cached."""
+        batches = self.get_batches(key)
+        if batches is None:
+            return None
+        return pd.concat(list(batches), ignore_index=True)
+
+    def get_batches(self, key):
+        """Returns an iterator over the batches of the cached results (see
+        store_batches), or None if they are missing or outdated."""
+        path = self._entry_path(key)
+        try:
+            entry = np.load(path)
+        except OSError:
+            # missing, or removed (evicted) concurrently
+            self._count("misses")
+            return None
+        try:
+            meta = json.loads(entry["meta"].item())
+            valid = meta["generations"] == self.types_generations(meta["generations"])
+            if self.max_age is not None:
+                valid = valid and time.time() - meta["created_at"] <= self.max_age
+        except (OSError, ValueError, KeyError):
+            valid = False
+        if not valid:
+            entry.close()
+            self._remove(path)
+            self._count("invalidations", "misses")
+            return None
+
+        self._touch(path)
+        self._count("hits")
+        return self._read_batches(entry, meta)
+
+    def set(self, key, df: pd.DataFrame, generations: dict):
+        """Stores a dataframe, with the generations of the resource types it
+        depends on (see types_generations)."""
+        for _ in self.store_batches(key, [df], generations):
+            pass
+
+    def store_batches(self, key, batches, generations: dict):
+        """Stores the batches of results (dataframes with the same columns)
+        as they are consumed: yields them once written. The entry is only
+        stored if all the batches are consumed."""
+        meta = {
+            "columns": None,
+            "generations": generations,
+            "rows": [],
+            "created_at": int(time.time()),
+        }
+        archive, tmp_path = self._create_archive()
+        try:
+            for batch in batches:
+                if archive is not None:
+                    archive = self._write_batch(archive, tmp_path, meta, batch)
+                yield batch
+            if archive is not None:
+                self._write_array(archive, "meta", np.array(json.dumps(meta)))
+                archive.close()
+                # the entries are never read partially written
+                os.replace(tmp_path, self._entry_path(key))
+                archive = None
+                self._touch(self._entry_path(key))
+                self._evict()
+        except OSError:
+            logger.exception("could not cache the eCRF results")
+        finally:
+            if archive is not None:
+                archive.close()
+                self._remove(tmp_path)
+
+    def clear(self):
+        for entry in self._entries():
+            self._remove(entry.path)
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "items": len(entries),
+            "bytes": sum(entry.stat().st_size for entry in entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+    def _count(self, *counters):
+        with self._stats_lock:
+            for counter in counters:
+                setattr(self, counter, getattr(self, counter) + 1)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, f"{key}{SUFFIX}")
+
+    def _entries(self) -> list:
+        return [
+            entry
+            for entry in os.scandir(self.path)
+            if entry.name.endswith(SUFFIX) and not entry.name.startswith(".")
+        ]
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in self._entries():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            size = sum(entry_size for _, entry_size, _ in entries)
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_bytes:
+                    break
+                self._remove(path)
+                size -= entry_size
+                self.evictions += 1
+
+    def _create_archive(self):
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix=SUFFIX, dir=self.path, prefix=".tmp-")
+        except OSError:
+            logger.exception("could not cache the eCRF results")
+            return None, None
+        return zipfile.ZipFile(os.fdopen(fd, "wb"), "w"), tmp_path
+
+    def _write_batch(self, archive, tmp_path, meta, batch):
+        """Writes the columns of a batch, returns the archive, or None if the
+        entry is too large to be stored."""
+        batch_index = len(meta["rows"])
+        meta["columns"] = batch.columns.to_list()
+        meta["rows"].append(len(batch))
+        try:
+            for i, dtype in enumerate(batch.dtypes):
+                column = batch.iloc[:, i].to_numpy(dtype=self._dtype(dtype))
+                if column.dtype == object:
+                    values = json.dumps(column.tolist(), default=self._json_value)
+                    self._write_array(archive, f"batch_{batch_index}_json_{i}", np.array(values))
+                else:
+                    self._write_array(archive, f"batch_{batch_index}_column_{i}", column)
+        except TypeError as e:
+            logger.warning(f"could not cache the eCRF results: {e}")
+            archive.close()
+            self._remove(tmp_path)
+            return None
+        if archive.fp.tell() > self.max_bytes:
+            # the entry would evict the whole cache, do not store it
+            archive.close()
+            self._remove(tmp_path)
+            return None
+        return archive
+
+    @staticmethod
+    def _write_array(archive, name, array):
+        # as numpy.savez, so that the archive is read by numpy.load
+        with archive.open(f"{name}.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    @staticmethod
+    def _read_column(entry, batch_index, i, rows):
+        name = f"batch_{batch_index}_column_{i}"
+        if name in entry.files:
+            return entry[name]
+        column = np.empty(rows, dtype=object)
+        column[:] = json.loads(entry[f"batch_{batch_index}_json_{i}"].item())
+        return column
+
+    @classmethod
+    def _read_batches(cls, entry, meta):
+        with entry:
+            for batch_index, rows in enumerate(meta["rows"]):
+                columns = {
+                    i: cls._read_column(entry, batch_index, i, rows)
+                    for i in range(len(meta["columns"]))
+                }
+                batch = pd.DataFrame(columns, index=range(rows))
+                batch.columns = meta["columns"]
+                yield batch
+
+    @staticmethod
+    def _dtype(dtype):
+        # the extension dtypes (categories...) are stored as objects
+        return dtype if isinstance(dtype, np.dtype) else object
+
+    @staticmethod
+    def _json_value(value):
+        """Encodes the values of the object columns which are not JSON types.
+        The entries with other values are not stored."""
+        if isinstance(value, np.generic):
+            return value.item()
+        if value is pd.NA or value is pd.NaT:
+            return None
+        raise TypeError(f"{type(value).__name__} values can not be cached")
+
+    @staticmethod
+    def _touch(path):
+        """Sets the modification time, used as the last access time by the
+        eviction (the file system clock may be too coarse to order them)."""
+        now = time.time_ns()
+        try:
+            os.utime(path, ns=(now, now))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_result_cache() -> ResultCache:
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache(
+            settings.ECRF_RESULTS_PATH,
+            settings.ECRF_RESULTS_MAX_BYTES,
+            changes.type_versions,
+            max_age=settings.ECRF_RESULTS_MAX_AGE or None,
+        )
+        # exposes the statistics with the ones of the other caches
+        cache.caches["ecrf-results"] = result_cache
+    return result_cache
@@ -0,0 +1,302 @@
+"""
+Background jobs (bundle uploads, definitions loading...).
+
+The state of the jobs is stored in mongo, so that any worker can report it.
+Under uwsgi, jobs are run by the spooler processes (see uwsgi.ini), outside of
+the request workers. Otherwise (flask development server), they are run by a
+thread pool.
+"""
+import datetime
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo.errors import PyMongoError
+
+from fhir_api import db, settings
+
+try:
+    import uwsgi
+    from uwsgidecorators import spool
+except ImportError:
+    uwsgi = None
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# jobs implementations, by kind
+tasks = {}
+
+executor = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def task(kind):
+    """Registers the implementation of a kind of job.
+
+    The decorated function receives the job progress reporter and the job
+    parameters as keyword arguments. Its return value is stored as the job
+    result.
+    """
+
+    def decorator(f):
+        tasks[kind] = f
+        return f
+
+    return decorator
+
+
+def get_jobs_collection():
+    return db.get_internal_db()["jobs"]
+
+
+def create_indexes():
+    # finished jobs are removed after JOBS_TTL seconds
+    get_jobs_collection().create_index("finished_at", expireAfterSeconds=settings.JOBS_TTL)
+
+
+def create_job(kind, request_url=None, **params):
+    job_id = str(uuid.uuid4())
+    get_jobs_collection().insert_one(
+        {
+            "_id": job_id,
+            "kind": kind,
+            "status": QUEUED,
+            "request": request_url,
+            "params": params,
+            "progress": {},
+            "created_at": datetime.datetime.utcnow(),
+        }
+    )
+    return job_id
+
+
+def get_job(job_id):
+    return get_jobs_collection().find_one({"_id": job_id})
+
+
+def cancel_job(job_id):
+    """Cancels a job. Running jobs stop the next time they report progress."""
+    res = get_jobs_collection().update_one(
+        {"_id": job_id, "status": {"$in": [QUEUED, RUNNING]}},
+        {"$set": {"status": CANCELLED, "finished_at": datetime.datetime.utcnow()}},
+    )
+    return res.modified_count > 0
+
+
+def delete_job(job_id):
+    """Deletes a finished job and its files."""
+    res = get_jobs_collection().delete_one({"_id": job_id, "status": {"$nin": [QUEUED, RUNNING]}})
+    shutil.rmtree(job_path(job_id), ignore_errors=True)
+    return res.deleted_count > 0
+
+
+def fail_stale_jobs():
+    """Fails the running jobs which stopped recording their heartbeat (the
+    process running them died)."""
+    now = datetime.datetime.utcnow()
+    res = get_jobs_collection().update_many(
+        {
+            "status": RUNNING,
+            "heartbeat_at": {"$lt": now - datetime.timedelta(seconds=settings.JOBS_STALE_TIMEOUT)},
+        },
+        {
+            "$set": {
+                "status": FAILED,
+                "error": "the job was interrupted: its worker stopped",
+                "finished_at": now,
+            }
+        },
+    )
+    if res.modified_count:
+        logger.warning(f"{res.modified_count} interrupted jobs have been failed")
+
+
+def remove_expired_files():
+    """Removes the directories of the jobs which do not exist anymore (the
+    TTL index removes the finished jobs, but not their files)."""
+    if not os.path.isdir(settings.JOBS_DATA_PATH):
+        return
+    job_ids = os.listdir(settings.JOBS_DATA_PATH)
+    existing = {job["_id"] for job in get_jobs_collection().find({"_id": {"$in": job_ids}}, {})}
+    for job_id in set(job_ids) - existing:
+        logger.info(f"Removing the files of the expired job {job_id}")
+        shutil.rmtree(job_path(job_id), ignore_errors=True)
+
+
+def job_path(job_id):
+    """Returns the directory of the files of a job, without creating it."""
+    return os.path.join(settings.JOBS_DATA_PATH, job_id)
+
+
+def get_job_path(job_id):
+    """Returns a directory where a job can store its input and output files."""
+    path = job_path(job_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_upload_path(job_id):
+    return os.path.join(get_job_path(job_id), "input.json")
+
+
+def save_upload(job_id, stream):
+    """Copies a request body to the job directory, without loading it."""
+    path = get_upload_path(job_id)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, settings.JOBS_UPLOAD_CHUNK_SIZE)
+    return path
+
+
+class JobProgress:
+    """Reports the progress of a running job.
+
+    Progress updates are written to mongo at most every
+    JOBS_PROGRESS_INTERVAL seconds, along with the job throughput.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.started_at = time.monotonic()
+        self.last_report = self.started_at
+        self.counters = {}
+
+    def report(self, force=False, **counters):
+        """Updates the job progress counters. The `processed` counter is used
+        to compute the throughput of the job."""
+        self.counters.update(counters)
+        now = time.monotonic()
+        if not force and now - self.last_report < settings.JOBS_PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+
+        res = get_jobs_collection().update_one(
+            {"_id": self.job_id, "status": RUNNING}, {"$set": {"progress": self.summary()}}
+        )
+        if res.matched_count == 0:
+            raise JobCancelled(f"job {self.job_id} has been cancelled")
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        summary = {**self.counters, "elapsed": round(elapsed, 3)}
+        if "processed" in self.counters and elapsed > 0:
+            summary["throughput"] = round(self.counters["processed"] / elapsed, 3)
+        return summary
+
+
+class Heartbeat(threading.Thread):
+    """Records that a job is still running, every JOBS_HEARTBEAT_INTERVAL
+    seconds, until it is stopped."""
+
+    def __init__(self, job_id):
+        super().__init__(name=f"heartbeat-{job_id}", daemon=True)
+        self.job_id = job_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(settings.JOBS_HEARTBEAT_INTERVAL):
+            try:
+                get_jobs_collection().update_one(
+                    {"_id": self.job_id, "status": RUNNING},
+                    {"$set": {"heartbeat_at": datetime.datetime.utcnow()}},
+                )
+            except PyMongoError as e:
+                logger.warning(f"Could not record the heartbeat of job {self.job_id}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_job(job_id):
+    """Runs a job and stores its result (or error) in mongo."""
+    remove_expired_files()
+    fail_stale_jobs()
+    jobs = get_jobs_collection()
+    now = datetime.datetime.utcnow()
+    job = jobs.find_one_and_update(
+        {"_id": job_id, "status": QUEUED},
+        {"$set": {"status": RUNNING, "started_at": now, "heartbeat_at": now}},
+    )
+    if not job:
+        logger.info(f"Job {job_id} is not queued anymore, skipping.")
+        return
+
+    progress = JobProgress(job_id)
+    heartbeat = Heartbeat(job_id)
+    heartbeat.start()
+    try:
+        result = tasks[job["kind"]](progress, **job["params"])
+    except JobCancelled:
+        logger.info(f"Job {job_id} has been cancelled.")
+        return
+    except Exception as e:
+        logger.exception(f"Job {job_id} failed: {e}")
+        status, update = FAILED, {"error": str(e)}
+    else:
+        status, update = COMPLETED, {"result": result}
+    finally:
+        heartbeat.stop()
+
+    jobs.update_one(
+        {"_id": job_id, "status": RUNNING},
+        {
+            "$set": {
+                "status": status,
+                "progress": progress.summary(),
+                "finished_at": datetime.datetime.utcnow(),
+                **update,
+            }
+        },
+    )
+
+
+def _run_spooled_job(job_id):
+    # the spooler processes are forked from the uwsgi master
+    db.reset_db_connection()
+    run_job(job_id)
+
+
+def submit(job_id):
+    """Runs a job in the background."""
+    global executor
+    if uwsgi is not None and "spooler" in uwsgi.opt:
+        spooled_job(job_id)
+        return
+
+    if not executor:
+        executor = ThreadPoolExecutor(max_workers=settings.JOBS_WORKERS)
+    executor.submit(run_job, job_id)
+
+
+if uwsgi is not None and "spooler" in uwsgi.opt:
+    spooled_job = spool(pass_arguments=True)(_run_spooled_job)
+
+
+def job_status(job):
+    """Returns the representation of a job exposed by the API."""
+    status = {
+        "id": job["_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "request": job["request"],
+        "progress": job["progress"],
+    }
+    for date in ("created_at", "started_at", "finished_at"):
+        if job.get(date):
+            status[date] = job[date].isoformat()
+    for key in ("result", "error"):
+        if key in job:
+            status[key] = job[key]
+    return status
@@ -0,0 +1,240 @@
+"""
+Parallel loading of FHIR definitions bundles.
+
+Bundle files are parsed and validated by a pool of processes, which send the
+validated resources by batches to a bounded queue. The main process consumes
+the queue and writes the batches to mongo. The files which have already been
+loaded (identified by their content hash) are skipped. A file whose worker
+fails (or dies) is reported as failed, the other ones are loaded.
+"""
+import datetime
+import functools
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import click
+
+from fhir_api import db, jobs, settings
+from fhir_api.bundle import BundleLoader, iter_bundle_entries
+from fhir_api.models import resources_models
+
+logger = logging.getLogger(__name__)
+
+# queues shared by the worker processes, set by _init_worker
+batches_queue = None
+started_queue = None
+
+
+def get_loaded_files_collection():
+    return db.get_internal_db()["loaded_files"]
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class QueuedBundleLoader(BundleLoader):
+    """Validates bundle entries and sends them to the writer process instead
+    of writing them to the store."""
+
+    def __init__(self, path, batch_size):
+        super().__init__(db.get_store(), resources_models, batch_size=batch_size)
+        self.path = path
+
+    def write(self, resource_type, batch):
+        batches_queue.put((self.path, resource_type, batch))
+
+
+def _init_worker(queue_, started_queue_):
+    global batches_queue, started_queue
+    batches_queue = queue_
+    started_queue = started_queue_
+    # the worker processes must not share the connections of their parent
+    db.reset_db_connection()
+
+
+def _parse_file(path, batch_size):
+    """Parses and validates a bundle file in a worker process. Its last
+    message to the writer is a (path, None, summary) tuple."""
+    # sent at once (unbuffered), so that the writer knows which process died
+    started_queue.put((path, os.getpid()))
+    try:
+        loader = QueuedBundleLoader(path, batch_size)
+        with open(path, "rb") as f:
+            loader.load(iter_bundle_entries(f))
+    except Exception as e:
+        batches_queue.put((path, None, {"error": str(e)}))
+        return
+    batches_queue.put((path, None, {"entries": loader.entries, "issues": loader.issues}))
+
+
+class LoadingStats:
+    def __init__(self, total_files, total_bytes):
+        self.started_at = time.monotonic()
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.resources = 0
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "files": f"{self.files}/{self.total_files}",
+            "processed": self.resources,
+            "megabytes": round(self.bytes / 1e6, 3),
+            "resources_per_second": round(self.resources / elapsed, 1),
+            "megabytes_per_second": round(self.bytes / 1e6 / elapsed, 3),
+            "elapsed": round(elapsed, 3),
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        return (
+            f"{summary['files']} files, {summary['processed']} resources "
+            f"({summary['resources_per_second']} resources/s, "
+            f"{summary['megabytes_per_second']} MB/s) in {summary['elapsed']}s"
+        )
+
+
+class DefinitionsLoader:
+    """Loads the bundle files of a directory in parallel.
+
+    Args:
+        workers: number of processes parsing and validating the bundles
+        batch_size: number of resources written at once
+        force: load the files even if they have already been loaded
+        echo: function called with the loading statistics
+    """
+
+    def __init__(self, workers=None, batch_size=None, force=False, echo=click.echo):
+        self.workers = workers or settings.LOAD_DEFS_WORKERS or os.cpu_count()
+        self.batch_size = batch_size or settings.BUNDLE_BATCH_SIZE
+        self.force = force
+        self.echo = echo
+        self.results = {}
+
+    def pending_files(self, src_dir):
+        """Returns the files of src_dir which have not been loaded yet, with
+        their content hash."""
+        files = {path: file_hash(path) for path in sorted(glob.glob(f"{src_dir}/*.json"))}
+        if self.force:
+            return files
+
+        loaded = get_loaded_files_collection().find({"_id": {"$in": list(files.values())}})
+        loaded = {doc["_id"] for doc in loaded}
+        for path, hash_ in list(files.items()):
+            if hash_ in loaded:
+                self.echo(f"Skipping {path}, which has already been loaded.")
+                del files[path]
+        return files
+
+    def load(self, src_dir, progress=None):
+        files = self.pending_files(src_dir)
+        stats = LoadingStats(len(files), sum(os.path.getsize(path) for path in files))
+        writers = {path: BundleLoader(db.get_store(), resources_models) for path in files}
+
+        context = multiprocessing.get_context("fork")
+        queue_ = context.Queue(maxsize=settings.LOAD_DEFS_QUEUE_SIZE)
+        started_queue_ = context.SimpleQueue()
+        # errors raised by the workers, by file
+        errors = {}
+        # the pool is terminated when leaving the block, even on errors
+        initargs = (queue_, started_queue_)
+        with context.Pool(self.workers, initializer=_init_worker, initargs=initargs) as pool:
+            for path in files:
+                pool.apply_async(
+                    _parse_file,
+                    (path, self.batch_size),
+                    error_callback=functools.partial(errors.__setitem__, path),
+                )
+
+            pending = set(files)
+            workers = {}
+            last_echo = time.monotonic()
+            while pending:
+                for path in set(errors) & pending:
+                    self.file_failed(path, str(errors[path]), writers, pending, stats)
+                try:
+                    path, resource_type, payload = queue_.get(timeout=1)
+                except queue.Empty:
+                    # all the messages of the dead workers have been consumed
+                    self.check_workers(started_queue_, workers, writers, pending, stats)
+                    continue
+                if path not in pending:
+                    # the file already failed
+                    continue
+
+                if resource_type is not None:
+                    writers[path].write(resource_type, payload)
+                    stats.resources += len(payload)
+                else:
+                    pending.remove(path)
+                    self.file_done(path, files[path], writers.pop(path), payload, stats)
+
+                if progress is not None:
+                    progress.report(**stats.summary())
+                if time.monotonic() - last_echo > settings.JOBS_PROGRESS_INTERVAL:
+                    last_echo = time.monotonic()
+                    self.echo(str(stats))
+
+        self.echo(f"Done! {stats}")
+        return self.results
+
+    def check_workers(self, started_queue_, workers, writers, pending, stats):
+        """Fails the pending files whose worker process died."""
+        while not started_queue_.empty():
+            path, pid = started_queue_.get()
+            workers[path] = pid
+        alive = {process.pid for process in multiprocessing.active_children()}
+        for path in sorted(pending):
+            if path in workers and workers[path] not in alive:
+                self.file_failed(path, "the worker process died", writers, pending, stats)
+
+    def file_failed(self, path, error, writers, pending, stats):
+        pending.remove(path)
+        writers.pop(path)
+        self.file_done(path, None, None, {"error": error}, stats)
+
+    def file_done(self, path, hash_, writer, summary, stats):
+        name = os.path.basename(path)
+        stats.files += 1
+        stats.bytes += os.path.getsize(path)
+
+        if "error" in summary:
+            self.echo(f"Failed to load {path}: {summary['error']}")
+            self.results[name] = {"error": summary["error"]}
+            return
+
+        writer.entries = summary["entries"]
+        writer.issues = summary["issues"] + writer.issues
+        self.results[name] = writer.operation_outcome()
+        if writer.write_errors:
+            # the file is loaded again next time, to retry the failed writes
+            self.echo(f"{writer.write_errors} resources of {path} could not be written.")
+            return
+        get_loaded_files_collection().replace_one(
+            {"_id": hash_},
+            {
+                "_id": hash_,
+                "name": name,
+                "entries": writer.entries,
+                "created": writer.created,
+                "loaded_at": datetime.datetime.utcnow(),
+            },
+            upsert=True,
+        )
+
+
+@jobs.task("load-definitions")
+def load_definitions_task(progress, src_dir, **options):
+    return DefinitionsLoader(**options).load(src_dir, progress=progress)
@@ -4,16 +4,29 @@ from typing import Dict, Union
 from fhir.resources import FHIRAbstractModel
 from fhir.resources.bundle import Bundle
 from fhir.resources.operationoutcome import OperationOutcome
-from flask import jsonify
 
 import fhirstore
 
+from fhir_api import changes, outbox, settings
+from fhir_api.cache import ResourceCache
 from fhir_api.db import get_store
-from fhir_api.errors import BadRequest
+from fhir_api.errors import BadRequest, NotFound
+from fhir_api.serialization import dumps, jsonify
+
+# serialized resources read by id, invalidated by the writes of every worker
+resource_cache = ResourceCache(
+    "resources",
+    max_items=settings.RESOURCE_CACHE_SIZE,
+    ttl=settings.RESOURCE_CACHE_TTL,
+    generations_max_items=settings.RESOURCE_GENERATIONS_SIZE,
+    generations_ttl=settings.GENERATIONS_TTL,
+)
 
 
 class BaseResource:
     resource: Union[None, FHIRAbstractModel] = None
+    # outbox entries of the indexing of the last write (see outbox.py)
+    outbox_entries: list = []
 
     def __init__(self, id=None, resource: Union[None, Dict, FHIRAbstractModel] = None):
         """Initializes a Resource resource instance.
@@ -34,7 +47,7 @@ class BaseResource:
     def json(self) -> str:
         """Returns the JSON serialization of the Resource resource"""
         if self.resource:
-            return jsonify(self.resource.dict())
+            return jsonify(self.resource)
         return jsonify({"id": self.id})
 
     def create(self) -> Union[FHIRAbstractModel, OperationOutcome]:
@@ -49,11 +62,14 @@ class BaseResource:
 
         res = self.db.create(self.resource)
         if not isinstance(res, OperationOutcome):
+            self.touch()
             self.resource = res
+        self.changed()
         return res
 
     def read(self) -> Union[FHIRAbstractModel, OperationOutcome]:
-        """Returns a Resource instance filled with the fhirstore data."""
+        """Returns a Resource instance filled with the fhirstore data,
+        validated against its FHIR model."""
         if not self.id:
             raise BadRequest("Resource ID is required")
 
@@ -62,6 +78,21 @@ class BaseResource:
             self.resource = res
         return res
 
+    def read_raw(self) -> bytes:
+        """Returns the JSON serialization of the stored resource, without
+        building its model."""
+        if not self.id:
+            raise BadRequest("Resource ID is required")
+
+        data, key = resource_cache.get(self.resource_type, self.id)
+        if data is None:
+            document = self.db.db[self.resource_type].find_one({"id": self.id}, {"_id": 0})
+            if document is None:
+                raise NotFound(f"{self.resource_type}/{self.id} was not found")
+            data = dumps(document)
+            resource_cache.set(key, data)
+        return data
+
     def update(self, resource) -> Union[FHIRAbstractModel, OperationOutcome]:
         """Updates a Resource instance in fhirstore.
         If provided, resource.id must match self.id"""
@@ -74,7 +105,9 @@ class BaseResource:
 
         res = self.db.update(self.id, resource)
         if not isinstance(res, OperationOutcome):
+            self.touch()
             self.resource = res
+        self.changed()
         return res
 
     def patch(self, patch) -> Union[FHIRAbstractModel, OperationOutcome]:
@@ -89,7 +122,9 @@ class BaseResource:
 
         res = self.db.patch(self.resource_type, self.id, patch)
         if not isinstance(res, OperationOutcome):
+            self.touch()
             self.resource = res
+        self.changed()
         return res
 
     def delete(self) -> OperationOutcome:
@@ -101,11 +136,27 @@ class BaseResource:
             res = self.db.delete(self.resource_type, self.id)
         except fhirstore.BadRequestError as e:
             raise BadRequest(str(e))
+        self.changed()
 
         self.resource = None
         self.id = None
         return res
 
+    def touch(self):
+        """Stamps the meta.lastUpdated of the stored resource, which the
+        writes of fhirstore do not maintain."""
+        self.db.db[self.resource_type].update_one(
+            {"id": self.id}, {"$set": {"meta.lastUpdated": changes.last_updated()}}
+        )
+
+    def changed(self):
+        """Invalidates the cached resource and the ETags of the searches on
+        its type, in every worker, and queues its indexing in write-behind
+        mode."""
+        resource_cache.invalidate(self.resource_type, self.id)
+        changes.type_changed(self.resource_type)
+        self.outbox_entries = outbox.enqueue(self.resource_type, [self.id])
+
     def search(
         self, query_string=None, params=None, as_json=True
     ) -> Union[Bundle, OperationOutcome]:
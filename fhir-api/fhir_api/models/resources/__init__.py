@@ -0,0 +1,3 @@
+# specific implementations of the resources, by resource type (see models.init)
+from .document_reference import DocumentReference  # noqa: F401
+from .patient import Patient  # noqa: F401
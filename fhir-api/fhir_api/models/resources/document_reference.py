@@ -1,46 +1,43 @@
-import os
-import re
-
-from flask import jsonify
-
-from fhirstore.search import Bundle
-from pysin import search as document_search
+from collections import defaultdict
 
+from fhir_api import settings
 from fhir_api.db import get_store
+from fhir_api.documents import get_document_index
 from fhir_api.models.base import BaseResource
 
 
 class DocumentReference(BaseResource):
     resource = None
 
-    def search(self, query_string=None, params=None):
-        """Searchs a resource by calling fhirstore search function"""
-        # FIXME cleanup
-        if params.get("$search"):
-            bundle = Bundle()
-            key_word = params.get("$search")
-            results, count_dict = document_search(key_word, os.environ.get("DOCUMENTS_PATH"))
-            document_names = []
-            contexts = []
-            for result in results[1:]:  # remove the header
-                path, _, context = result
-                document_name = re.search(r"\d+\.pdf", path).group(0)
-                document_names.append(document_name)
-                contexts.append(context)
-
-            store = get_store()
-            document_references = store.db[self.resource_type].find(
-                {"content.attachment.url": {"$in": document_names}}
-            )
-
-            entries = []
-            for document_reference, context in zip(document_references, contexts):
-                del document_reference["_id"]
-                document_reference["description"] = context
+    @classmethod
+    def search_documents(cls, keywords, count=None, offset=0) -> dict:
+        """Searches the documents by keywords ($search operation).
+
+        Returns a page of the DocumentReferences of the matching documents, by
+        relevance, with the context of the match as description. Only the
+        DocumentReferences of the page are read.
+        """
+        index = get_document_index()
+        count = settings.DOCUMENTS_SEARCH_COUNT if count is None else count
+        hits, total = index.search(keywords, count=count, offset=offset)
+
+        names = {hit.name for hit in hits}
+        by_name = defaultdict(list)
+        collection = get_store().db[cls.__name__]
+        query = {"content.attachment.url": {"$in": list(names)}}
+        for document_reference in collection.find(query, {"_id": 0}):
+            contents = document_reference.get("content", [])
+            urls = {content.get("attachment", {}).get("url") for content in contents}
+            for url in urls & names:
+                by_name[url].append(document_reference)
+
+        entries, found = [], set()
+        for hit in hits:
+            for document_reference in by_name[hit.name]:
+                if document_reference["id"] in found:
+                    continue
+                found.add(document_reference["id"])
+                document_reference["description"] = hit.snippet
                 entries.append({"resource": document_reference, "search": {"mode": "match"}})
-            bundle.content["entry"] = entries
-            bundle.content["total"] = count_dict["nb"]
 
-            return jsonify(bundle.content)
-        else:
-            return super().search(query_string=query_string, params=params)
+        return {"resourceType": "Bundle", "type": "searchset", "total": total, "entry": entries}
@@ -0,0 +1,283 @@
+"""
+Write-behind Elasticsearch indexing of the API writes (ES_WRITE_BEHIND).
+
+The writes of the API return as soon as they are committed in mongo: the
+indexing of the written resources is queued in an outbox collection of the
+internal database, and flushed in bulk requests by a background worker. The
+outbox entries only name the written resources: their current state is
+indexed when the entries are flushed (or they are removed from the index if
+they do not exist anymore), so that the successive writes of a resource are
+indexed once, and an entry flushed twice is harmless.
+
+The outbox is durable: the entries left by a stopped process are flushed by
+the worker of another one, started after the fork by uwsgi. A single worker
+flushes at a time (it holds a lease in the internal database), so that the
+states of a resource are indexed in order.
+
+The entries are inserted once the writes are committed though, not in the
+same transaction: the writes of a process stopped in between are not
+queued, and are not indexed until the next reindex (flask reindex-es). The
+change stream subscriber with CHANGE_STREAM_ES_SYNC closes this window, as
+it queues all the writes read from the oplog, those of the API included,
+from its saved resume token.
+
+The requests with the `X-Refresh: wait_for` header return once their writes
+are indexed and visible to the searches, as with the refresh=wait_for
+parameter of Elasticsearch.
+
+The write-behind mode replaces the sync of Elasticsearch by monstache, which
+must not run along with it (the two would index the same resources
+concurrently, in any order). Both key the documents by type-qualified ids
+(see es_id, and monstache.toml). The writes made without the API are then
+indexed through the outbox by the change stream subscriber (see
+CHANGE_STREAM_ES_SYNC in change_stream.py).
+"""
+import datetime
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from elasticsearch.helpers import streaming_bulk
+from flask import request
+from pymongo.errors import DuplicateKeyError
+
+from fhir_api import db, settings
+
+logger = logging.getLogger(__name__)
+
+REFRESH_HEADER = "X-Refresh"
+WAIT_FOR = "wait_for"
+
+LEASE_ID = "flusher"
+
+worker = None
+worker_lock = threading.Lock()
+
+
+def get_outbox_collection():
+    return db.get_internal_db()["es_outbox"]
+
+
+def get_lease_collection():
+    return db.get_internal_db()["es_outbox_lease"]
+
+
+def es_id(resource_type, id) -> str:
+    """Returns the id of the document of a resource. The resources of all the
+    types share the index, and their ids are only unique by type."""
+    return f"{resource_type}/{id}"
+
+
+def es_action(index, resource_type, resource) -> dict:
+    """Returns the bulk action indexing a resource, in the layout of the
+    documents of the store search engine (the resource under its type)."""
+    return {
+        "_index": index,
+        "_id": es_id(resource_type, resource["id"]),
+        "_source": {resource_type: resource},
+    }
+
+
+def es_delete_action(index, resource_type, id) -> dict:
+    return {"_op_type": "delete", "_index": index, "_id": es_id(resource_type, id)}
+
+
+def enqueue(resource_type, ids) -> list:
+    """Queues the indexing of resources written by the API, in write-behind
+    mode only. Returns the ids of the outbox entries."""
+    if not settings.ES_WRITE_BEHIND:
+        return []
+    return queue(resource_type, ids)
+
+
+def queue(resource_type, ids) -> list:
+    """Queues the indexing of written resources, returns the ids of the
+    outbox entries."""
+    if not ids:
+        return []
+    now = datetime.datetime.utcnow()
+    entries = [
+        {"resource_type": resource_type, "id": id, "enqueued_at": now, "attempts": 0} for id in ids
+    ]
+    entry_ids = get_outbox_collection().insert_many(entries).inserted_ids
+    start_worker()
+    return entry_ids
+
+
+class Lease:
+    """Exclusive right to flush the outbox, among all the processes, renewed
+    by its holder and taken over once it expires."""
+
+    def __init__(self, duration=None):
+        self.duration = duration or settings.ES_OUTBOX_LEASE
+        self.owner = uuid.uuid4().hex
+
+    def acquire(self) -> bool:
+        now = datetime.datetime.utcnow()
+        try:
+            get_lease_collection().find_one_and_update(
+                {"_id": LEASE_ID, "$or": [{"owner": self.owner}, {"until": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "until": now + self._duration()}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # held by another process
+            return False
+        return True
+
+    def release(self):
+        get_lease_collection().delete_one({"_id": LEASE_ID, "owner": self.owner})
+
+    def _duration(self):
+        return datetime.timedelta(seconds=self.duration)
+
+
+class Flusher:
+    """Indexes the queued resources, by batches of ES_OUTBOX_BATCH_SIZE."""
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.ES_OUTBOX_BATCH_SIZE
+        self.lease = Lease()
+
+    def flush(self, refresh=False) -> set:
+        """Flushes the outbox if no other process does, returns the ids of
+        the flushed entries. The entries which could not be indexed are left
+        for the next flush."""
+        if not self.lease.acquire():
+            return set()
+        flushed = set()
+        try:
+            while True:
+                batch = self.flush_batch(refresh)
+                flushed |= batch
+                if len(batch) < self.batch_size or not self.lease.acquire():
+                    break
+        finally:
+            self.lease.release()
+        return flushed
+
+    def flush_batch(self, refresh=False) -> set:
+        outbox = get_outbox_collection()
+        entries = list(outbox.find().sort("_id").limit(self.batch_size))
+        if not entries:
+            return set()
+
+        store = db.get_store()
+        index = store.search_engine.get_index_name()
+        written = defaultdict(set)
+        for entry in entries:
+            written[entry["resource_type"]].add(entry["id"])
+        actions = []
+        for resource_type, ids in written.items():
+            resources = store.db[resource_type].find({"id": {"$in": list(ids)}}, {"_id": 0})
+            found = {resource["id"]: resource for resource in resources}
+            for id in sorted(ids):
+                if id in found:
+                    actions.append(es_action(index, resource_type, found[id]))
+                else:
+                    actions.append(es_delete_action(index, resource_type, id))
+
+        failed = self.bulk(actions, refresh)
+        done, retried = [], []
+        for entry in entries:
+            if es_id(entry["resource_type"], entry["id"]) in failed:
+                retried.append(entry)
+            else:
+                done.append(entry["_id"])
+        outbox.delete_many({"_id": {"$in": done}})
+        self.retry(retried)
+        return set(done)
+
+    def bulk(self, actions, refresh) -> set:
+        """Sends the actions, returns the document ids (see es_id) of the
+        resources which could not be indexed."""
+        failed = set()
+        results = streaming_bulk(
+            db.get_es_connection(),
+            actions,
+            chunk_size=self.batch_size,
+            raise_on_error=False,
+            refresh=WAIT_FOR if refresh else False,
+        )
+        for ok, info in results:
+            op_type, result = next(iter(info.items()))
+            if not ok and not (op_type == "delete" and result.get("status") == 404):
+                logger.warning(f"Could not index {result.get('_id')}: {result.get('error')}")
+                failed.add(result.get("_id"))
+        return failed
+
+    def retry(self, entries):
+        """Counts the failed attempts of the entries, drops the ones which
+        failed ES_OUTBOX_MAX_ATTEMPTS times."""
+        outbox = get_outbox_collection()
+        retried, dropped = [], []
+        for entry in entries:
+            if entry["attempts"] + 1 < settings.ES_OUTBOX_MAX_ATTEMPTS:
+                retried.append(entry["_id"])
+            else:
+                logger.error(f"Dropping the indexing of {entry['resource_type']}/{entry['id']}")
+                dropped.append(entry["_id"])
+        outbox.update_many({"_id": {"$in": retried}}, {"$inc": {"attempts": 1}})
+        outbox.delete_many({"_id": {"$in": dropped}})
+
+
+def run_worker(flusher, interval):
+    while True:
+        try:
+            flusher.flush()
+        except Exception as e:
+            # the entries are kept, and flushed again after the interval
+            logger.exception(f"Could not flush the indexing outbox: {e}")
+        time.sleep(interval)
+
+
+def start_worker():
+    """Starts the background worker of the process, if it is not running."""
+    global worker
+    with worker_lock:
+        if worker is None or not worker.is_alive():
+            worker = threading.Thread(
+                target=run_worker,
+                args=(Flusher(), settings.ES_OUTBOX_FLUSH_INTERVAL),
+                name="es-outbox",
+                daemon=True,
+            )
+            worker.start()
+
+
+def wait(entry_ids, timeout=None) -> bool:
+    """Waits until outbox entries are indexed and visible to the searches.
+    Returns False if they are still queued after the timeout."""
+    timeout = timeout or settings.ES_OUTBOX_WAIT_TIMEOUT
+    deadline = time.monotonic() + timeout
+    pending = set(entry_ids)
+    flusher = Flusher()
+    # the entries flushed by the worker are not refreshed
+    flushed_by_worker = False
+    while pending:
+        pending -= flusher.flush(refresh=True)
+        if not pending:
+            break
+        queued = get_outbox_collection().find({"_id": {"$in": list(pending)}}, {"_id": 1})
+        queued = {entry["_id"] for entry in queued}
+        flushed_by_worker |= queued != pending
+        pending = queued
+        if pending and time.monotonic() > deadline:
+            logger.warning(f"{len(pending)} writes are not indexed yet after {timeout}s")
+            return False
+        if pending:
+            time.sleep(0.05)
+
+    if flushed_by_worker:
+        es = db.get_es_connection()
+        es.indices.refresh(index=db.get_store().search_engine.get_index_name())
+    return True
+
+
+def wait_requested(entry_ids):
+    """Waits for the indexing of the writes of the current request, if it
+    has the header `X-Refresh: wait_for`."""
+    if request.headers.get(REFRESH_HEADER) == WAIT_FOR:
+        wait(entry_ids)
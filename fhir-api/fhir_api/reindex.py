@@ -0,0 +1,294 @@
+"""
+Rebuild of the Elasticsearch index from the mongo collections, without
+interrupting the searches.
+
+The store searches an index named after its search engine (the alias). The
+reindex creates a new versioned index with the settings and mappings of the
+current one, bulk-loads the collections into it (several collections at
+once, each with parallel_bulk from a mongo cursor), then points the alias to
+the new index, atomically. The searches use the current index until then.
+
+The state of the reindex is stored in the internal database: an interrupted
+reindex is resumed with the same index, skipping the collections already
+loaded.
+
+The resources written during the reindex are read from the mongo change
+streams, from a resume token taken when the reindex starts: they are indexed
+again before the swap, then the ones written until the swap (which were only
+indexed in the previous index) are indexed again after it. If the changes are
+not in the oplog anymore, all the collections are loaded again instead. The
+resources deleted during the reindex are not removed from the new index.
+"""
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import click
+from elasticsearch.helpers import parallel_bulk
+from pymongo.errors import OperationFailure
+
+from fhir_api import change_stream, db, jobs, settings
+from fhir_api.models import resources_models
+from fhir_api.outbox import es_action
+
+logger = logging.getLogger(__name__)
+
+# settings of the new index while it is loaded (restored before the swap)
+LOADING_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
+# settings of the current index kept by the new one
+KEPT_SETTINGS = ["analysis", "mapping", "number_of_shards"]
+
+
+def get_reindex_collection():
+    return db.get_internal_db()["es_reindex"]
+
+
+def index_body(es, index) -> dict:
+    """Returns the settings and mappings of an index (or alias), to create a
+    new index like it."""
+    info = next(iter(es.indices.get(index=index).values()))
+    index_settings = info["settings"]["index"]
+    kept = {key: index_settings[key] for key in KEPT_SETTINGS if key in index_settings}
+    return {"settings": {"index": {**kept, **LOADING_SETTINGS}}, "mappings": info["mappings"]}
+
+
+class ReindexStats:
+    def __init__(self, total_collections):
+        self.started_at = time.monotonic()
+        self.total_collections = total_collections
+        self.collections = 0
+        self.documents = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, documents=0, errors=0):
+        with self._lock:
+            self.documents += documents
+            self.errors += errors
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "collections": f"{self.collections}/{self.total_collections}",
+            "processed": self.documents,
+            "errors": self.errors,
+            "documents_per_second": round(self.documents / elapsed, 1),
+            "elapsed": round(elapsed, 3),
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        return (
+            f"{summary['collections']} collections, {summary['processed']} documents "
+            f"({summary['documents_per_second']} documents/s, {summary['errors']} errors) "
+            f"in {summary['elapsed']}s"
+        )
+
+
+class Reindexer:
+    """Rebuilds the Elasticsearch index of the store from mongo.
+
+    Args:
+        workers: number of collections loaded at once
+        threads: number of threads sending the bulk requests of a collection
+        chunk_size: number of documents per bulk request
+        keep_old: keep the previous indices after the swap
+        echo: function called with the reindex statistics
+    """
+
+    def __init__(
+        self, workers=None, threads=None, chunk_size=None, keep_old=False, echo=click.echo
+    ):
+        self.workers = workers or settings.ES_REINDEX_WORKERS
+        self.threads = threads or settings.ES_REINDEX_THREADS
+        self.chunk_size = chunk_size or settings.ES_REINDEX_CHUNK_SIZE
+        self.keep_old = keep_old
+        self.echo = echo
+
+        self.store = db.get_store()
+        self.es = db.get_es_connection()
+        self.alias = self.store.search_engine.get_index_name()
+
+    def run(self, progress=None, restart=False) -> dict:
+        state = self.start(restart)
+        index = state["index"]
+        collections = sorted(set(resources_models) & set(self.store.db.list_collection_names()))
+        pending = [name for name in collections if name not in state["loaded"]]
+        if state["loaded"]:
+            self.echo(f"Skipping {', '.join(state['loaded'])}, already loaded in {index}.")
+
+        stats = ReindexStats(len(pending))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.load, index, name, stats): name for name in pending}
+            while futures:
+                done, _ = wait(futures, settings.JOBS_PROGRESS_INTERVAL, FIRST_COMPLETED)
+                for future in done:
+                    self.loaded(futures.pop(future), future.result())
+                    stats.collections += 1
+                if progress is not None:
+                    progress.report(**stats.summary())
+                self.echo(str(stats))
+
+        resume_token = self.catch_up(index, collections, state.get("resume_token"), stats)
+        previous = self.swap(index)
+        # the writes made until the swap were only in the previous index
+        self.catch_up(index, collections, resume_token, stats)
+        self.echo(f"Done! {self.alias} now points to {index} ({stats})")
+        return {"index": index, "previous": previous, **stats.summary()}
+
+    def start(self, restart=False) -> dict:
+        """Returns the state of the reindex in progress, or starts a new one
+        with a new index."""
+        reindexes = get_reindex_collection()
+        state = reindexes.find_one({"_id": self.alias})
+        if state is not None and not restart and self.es.indices.exists(index=state["index"]):
+            self.echo(f"Resuming the reindex in {state['index']}...")
+            return state
+        if state is not None and state["index"] not in self.current_indices():
+            self.es.indices.delete(index=state["index"], ignore=[404])
+
+        if not self.current_indices() and not self.es.indices.exists(index=self.alias):
+            # the mappings of the store search engine
+            self.store.search_engine.create_es_index()
+
+        now = datetime.datetime.utcnow()
+        index = f"{self.alias}-{now:%Y%m%d%H%M%S}"
+        self.echo(f"Creating the index {index}...")
+        self.es.indices.create(index=index, body=index_body(self.es, self.alias))
+        state = {
+            "_id": self.alias,
+            "index": index,
+            "loaded": {},
+            "started_at": now.isoformat(),
+            # the writes made from now on are indexed again (see catch_up)
+            "resume_token": self.resume_token(),
+        }
+        reindexes.replace_one({"_id": self.alias}, state, upsert=True)
+        return state
+
+    def load(self, index, resource_type, stats) -> dict:
+        """Loads a collection in the index, returns its counters."""
+        cursor = self.store.db[resource_type].find({}, {"_id": 0}, batch_size=self.chunk_size)
+        return self.bulk(index, resource_type, cursor, stats)
+
+    def bulk(self, index, resource_type, resources, stats) -> dict:
+        counters = {"documents": 0, "errors": 0}
+        actions = (es_action(index, resource_type, resource) for resource in resources)
+        results = parallel_bulk(
+            self.es,
+            actions,
+            thread_count=self.threads,
+            chunk_size=self.chunk_size,
+            raise_on_error=False,
+        )
+        reported = dict(counters)
+        for ok, info in results:
+            counters["documents" if ok else "errors"] += 1
+            if not ok and counters["errors"] <= 10:
+                logger.warning(f"Could not index a {resource_type}: {info}")
+            if sum(counters.values()) - sum(reported.values()) >= self.chunk_size:
+                stats.add(**{key: counters[key] - reported[key] for key in counters})
+                reported = dict(counters)
+        stats.add(**{key: counters[key] - reported[key] for key in counters})
+        return counters
+
+    def loaded(self, resource_type, counters):
+        get_reindex_collection().update_one(
+            {"_id": self.alias},
+            {
+                "$set": {
+                    f"loaded.{resource_type}": {
+                        **counters,
+                        "loaded_at": datetime.datetime.utcnow().isoformat(),
+                    }
+                }
+            },
+        )
+
+    def resume_token(self):
+        """Returns the resume token of the current position of the change
+        streams of the resources collections."""
+        with self.store.db.watch(change_stream.pipeline()) as stream:
+            return stream.resume_token
+
+    def catch_up(self, index, collections, resume_token, stats):
+        """Indexes again the resources written since a resume token, returns
+        the resume token of the last change."""
+        if resume_token is None:
+            return self.reload(index, collections, stats)
+
+        written = defaultdict(set)
+        try:
+            with self.store.db.watch(
+                change_stream.pipeline(), full_document="updateLookup", resume_after=resume_token
+            ) as stream:
+                # until the changes made so far are read
+                for change in iter(stream.try_next, None):
+                    id = change_stream.changed_id(change)
+                    if id is not None:
+                        written[change["ns"]["coll"]].add(id)
+                resume_token = stream.resume_token
+        except OperationFailure as e:
+            if e.code not in change_stream.HISTORY_LOST:
+                raise
+            return self.reload(index, collections, stats)
+
+        for resource_type in sorted(set(written) & set(collections)):
+            query = {"id": {"$in": sorted(written[resource_type])}}
+            resources = self.store.db[resource_type].find(query, {"_id": 0})
+            counters = self.bulk(index, resource_type, resources, stats)
+            self.echo(f"{counters['documents']} {resource_type} written during the reindex")
+        return resume_token
+
+    def reload(self, index, collections, stats):
+        """Loads all the collections again, when the writes made during the
+        reindex are unknown. Returns the resume token of the reload."""
+        self.echo("The writes made during the reindex are unknown, loading everything again...")
+        resume_token = self.resume_token()
+        for resource_type in collections:
+            self.load(index, resource_type, stats)
+        return resume_token
+
+    def current_indices(self) -> list:
+        """Returns the indices the alias points to."""
+        if not self.es.indices.exists_alias(name=self.alias):
+            return []
+        return list(self.es.indices.get_alias(name=self.alias))
+
+    def swap(self, index) -> list:
+        """Points the alias to the new index, atomically. The index of the
+        same name (before the first reindex) is replaced by the alias."""
+        self.es.indices.put_settings(
+            index=index,
+            body={"index": {"refresh_interval": None, "number_of_replicas": self.replicas()}},
+        )
+        self.es.indices.refresh(index=index)
+
+        previous = self.current_indices()
+        actions = [{"remove": {"index": old, "alias": self.alias}} for old in previous]
+        if not previous and self.es.indices.exists(index=self.alias):
+            actions.append({"remove_index": {"index": self.alias}})
+        actions.append({"add": {"index": index, "alias": self.alias}})
+        self.es.indices.update_aliases(body={"actions": actions})
+        get_reindex_collection().delete_one({"_id": self.alias})
+
+        if not self.keep_old:
+            for old in previous:
+                self.es.indices.delete(index=old, ignore=[404])
+        return previous
+
+    def replicas(self):
+        """Number of replicas of the current index"""
+        if not self.current_indices() and not self.es.indices.exists(index=self.alias):
+            return None
+        info = next(iter(self.es.indices.get_settings(index=self.alias).values()))
+        return info["settings"]["index"].get("number_of_replicas")
+
+
+@jobs.task("reindex-es")
+def reindex_es_task(progress, restart=False, **options):
+    return Reindexer(**options).run(progress=progress, restart=restart)
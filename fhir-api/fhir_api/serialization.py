@@ -0,0 +1,62 @@
+"""
+JSON serialization of the API responses, backed by orjson.
+
+orjson serializes natively the dicts, lists, strings, numbers, datetimes and
+dates. The other types found in the stored documents and in the FHIR models
+(ObjectId, Decimal, pydantic models) are converted by `default`. The pydantic
+models are serialized field by field, without building their `.dict()` copy.
+The decimals are written as they are (1.50 stays 1.50): the precision of the
+FHIR decimals is significant.
+"""
+from decimal import Decimal
+
+import orjson
+from bson import ObjectId
+from flask import Response, current_app
+from flask import json as flask_json
+from pydantic import BaseModel
+
+
+def model_fields(model: BaseModel) -> dict:
+    """Returns the fields of a pydantic model which are set, by alias (as the
+    `dict()` of the FHIR models)."""
+    data = {}
+    if getattr(model.__class__, "has_resource_base", lambda: False)():
+        data["resourceType"] = model.resource_type
+    for name, field in model.__fields__.items():
+        value = getattr(model, name)
+        if value is not None and name != "resource_type":
+            data[field.alias] = value
+    return data
+
+
+def default(o):
+    if isinstance(o, BaseModel):
+        return model_fields(o)
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, Decimal) and o.is_finite():
+        return orjson.Fragment(str(o))
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def dumps(data, indent=False) -> bytes:
+    return orjson.dumps(data, default=default, option=orjson.OPT_INDENT_2 if indent else None)
+
+
+def jsonify(*args, **kwargs) -> Response:
+    """Same as flask.jsonify, without the intermediate string."""
+    if args and kwargs:
+        raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+    data = args[0] if len(args) == 1 else args or kwargs
+    indent = current_app.config["JSONIFY_PRETTYPRINT_REGULAR"] or current_app.debug
+    mimetype = current_app.config["JSONIFY_MIMETYPE"]
+    return Response(dumps(data, indent=indent) + b"\n", mimetype=mimetype)
+
+
+class JSONEncoder(flask_json.JSONEncoder):
+    """Flask JSON encoder delegating to orjson, used by the flask helpers
+    (flask.jsonify, flask.json.dumps...)."""
+
+    def encode(self, o):
+        return dumps(o, indent=bool(self.indent)).decode()
@@ -9,6 +9,10 @@ DB_HOST = os.getenv("MONGO_HOST", "localhost")
 DB_PORT = int(os.getenv("MONGO_PORT", 27017))
 DB_USER = os.getenv("MONGO_USER")
 DB_PASSWORD = os.getenv("MONGO_PASSWORD")
+# database storing the API internal data (jobs...)
+INTERNAL_DB_NAME = os.getenv("MONGO_INTERNAL_DB", f"{DB_NAME}-internal")
+# directory of the files owned by the API (indexes, caches...)
+DATA_PATH = os.getenv("DATA_PATH", os.path.expanduser("~/.fhir-api"))
 
 ES_USERNAME = os.getenv("ES_USERNAME", "elastic")
 ES_PASSWORD = os.getenv("ES_PASSWORD")
@@ -18,7 +22,137 @@ ES_URL = f"http://{ES_USERNAME}{':'+ES_PASSWORD if ES_PASSWORD else ''}@{ES_HOST
 
 AUTH_DISABLED = os.getenv("AUTH_DISABLED", "").lower() in ["1", "true", "yes"]
 
+# Tokens are validated either by the introspection endpoint ("introspection")
+# or in-process when they are signed JWTs ("jwt"). In "jwt" mode, opaque
+# tokens are still validated by the introspection endpoint.
+TOKEN_VALIDATION_MODE = os.getenv("TOKEN_VALIDATION_MODE", "introspection")
+# scope required to access the API, if any
+TOKEN_SCOPE = os.getenv("TOKEN_SCOPE")
+
+JWKS_URL = os.getenv("JWKS_URL")
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", 60))
+TOKEN_ALGORITHMS = os.getenv("TOKEN_ALGORITHMS", "RS256").split(",")
+TOKEN_AUDIENCE = os.getenv("TOKEN_AUDIENCE")
+TOKEN_ISSUER = os.getenv("TOKEN_ISSUER")
+
 TOKEN_INTROSPECTION_URL = os.getenv("TOKEN_INTROSPECTION_URL")
+TOKEN_INTROSPECTION_TIMEOUT = float(os.getenv("TOKEN_INTROSPECTION_TIMEOUT", 5))
+TOKEN_INTROSPECTION_POOL_SIZE = int(os.getenv("TOKEN_INTROSPECTION_POOL_SIZE", 10))
+# Introspection results are cached at most TOKEN_CACHE_TTL seconds (and never
+# after the token expiration), rejected tokens TOKEN_CACHE_NEGATIVE_TTL
+# seconds.
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", 300))
+TOKEN_CACHE_NEGATIVE_TTL = float(os.getenv("TOKEN_CACHE_NEGATIVE_TTL", 5))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+
+# Resources read by id are cached by each worker (0 disables the cache) during
+# at most RESOURCE_CACHE_TTL seconds.
+RESOURCE_CACHE_SIZE = int(os.getenv("RESOURCE_CACHE_SIZE", 1024))
+RESOURCE_CACHE_TTL = float(os.getenv("RESOURCE_CACHE_TTL", 300))
+# The generations of the resources, from which their ETags are computed, are
+# kept even when the cache is disabled (the uwsgi cache resources-generations
+# is used instead under uwsgi).
+RESOURCE_GENERATIONS_SIZE = int(os.getenv("RESOURCE_GENERATIONS_SIZE", 20000))
+
+# Search results are cached by each worker (0 disables the cache), up to
+# SEARCH_CACHE_MAX_BYTES bytes, during at most SEARCH_CACHE_TTL seconds. The
+# results larger than SEARCH_CACHE_MAX_ENTRY_BYTES are not cached.
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+SEARCH_CACHE_MAX_ENTRY_BYTES = int(os.getenv("SEARCH_CACHE_MAX_ENTRY_BYTES", 8 * 1024 * 1024))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 300))
+
+# lifetime of the generations of the resource types, from which the ETags of
+# the searches are computed (see changes.py), and of the resources
+GENERATIONS_TTL = float(os.getenv("GENERATIONS_TTL", 300))
+
+# Bundles are written to the store by batches of BUNDLE_BATCH_SIZE resources.
+BUNDLE_BATCH_SIZE = int(os.getenv("BUNDLE_BATCH_SIZE", 500))
+# maximum number of entry issues reported when uploading a bundle
+BUNDLE_MAX_ISSUES = int(os.getenv("BUNDLE_MAX_ISSUES", 1000))
+
+# Definitions loading: number of processes parsing the bundles (defaults to
+# the number of cores) and maximum number of batches waiting to be written.
+LOAD_DEFS_WORKERS = int(os.getenv("LOAD_DEFS_WORKERS", 0))
+LOAD_DEFS_QUEUE_SIZE = int(os.getenv("LOAD_DEFS_QUEUE_SIZE", 16))
+
+# Background jobs
+# the uploads and exports of the jobs must survive the restarts of the API.
+JOBS_DATA_PATH = os.getenv("JOBS_DATA_PATH", os.path.join(DATA_PATH, "jobs"))
+# number of threads running the jobs when the uwsgi spooler is not available
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", 2))
+JOBS_PROGRESS_INTERVAL = float(os.getenv("JOBS_PROGRESS_INTERVAL", 2))
+JOBS_UPLOAD_CHUNK_SIZE = int(os.getenv("JOBS_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+JOBS_TTL = int(os.getenv("JOBS_TTL", 7 * 24 * 3600))
+# running jobs record a heartbeat every JOBS_HEARTBEAT_INTERVAL seconds. Those
+# without one for JOBS_STALE_TIMEOUT seconds (their worker died) are failed.
+JOBS_HEARTBEAT_INTERVAL = float(os.getenv("JOBS_HEARTBEAT_INTERVAL", 30))
+JOBS_STALE_TIMEOUT = float(os.getenv("JOBS_STALE_TIMEOUT", 300))
+
+# Bulk data export: NDJSON files are capped to EXPORT_MAX_FILE_SIZE bytes
+EXPORT_MAX_FILE_SIZE = int(os.getenv("EXPORT_MAX_FILE_SIZE", 100 * 1024 * 1024))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+# Documents searched by the DocumentReference $search operation, and their
+# full-text index (see documents.py), updated by the index-documents job.
+DOCUMENTS_PATH = os.getenv("DOCUMENTS_PATH", "/var/data/documents")
+DOCUMENTS_INDEX_PATH = os.getenv(
+    "DOCUMENTS_INDEX_PATH", os.path.join(DATA_PATH, "documents-index.sqlite")
+)
+# size of the index mapped in memory, in bytes
+DOCUMENTS_INDEX_MMAP_SIZE = int(os.getenv("DOCUMENTS_INDEX_MMAP_SIZE", 256 * 1024 * 1024))
+# default number of documents per page of $search results
+DOCUMENTS_SEARCH_COUNT = int(os.getenv("DOCUMENTS_SEARCH_COUNT", 20))
+# number of processes extracting the documents text (index-documents
+# command), defaults to the number of cores
+DOCUMENTS_INDEX_WORKERS = int(os.getenv("DOCUMENTS_INDEX_WORKERS", 0))
+
+# Elasticsearch reindex (flask reindex-es): number of collections loaded at
+# once, of threads sending the bulk requests of a collection, and of documents
+# per bulk request
+ES_REINDEX_WORKERS = int(os.getenv("ES_REINDEX_WORKERS", 4))
+ES_REINDEX_THREADS = int(os.getenv("ES_REINDEX_THREADS", 4))
+ES_REINDEX_CHUNK_SIZE = int(os.getenv("ES_REINDEX_CHUNK_SIZE", 500))
+
+# Write-behind indexing (see outbox.py), which replaces monstache: the writes
+# of the API are indexed in Elasticsearch by a background worker, every
+# ES_OUTBOX_FLUSH_INTERVAL seconds, by bulk requests of ES_OUTBOX_BATCH_SIZE
+# resources. The worker flushing the outbox holds a lease of ES_OUTBOX_LEASE
+# seconds. The resources rejected ES_OUTBOX_MAX_ATTEMPTS times are dropped.
+# The requests waiting for their writes to be indexed (X-Refresh: wait_for)
+# wait at most ES_OUTBOX_WAIT_TIMEOUT seconds.
+ES_WRITE_BEHIND = os.getenv("ES_WRITE_BEHIND", "").lower() in ["1", "true", "yes"]
+ES_OUTBOX_FLUSH_INTERVAL = float(os.getenv("ES_OUTBOX_FLUSH_INTERVAL", 1))
+ES_OUTBOX_BATCH_SIZE = int(os.getenv("ES_OUTBOX_BATCH_SIZE", 500))
+ES_OUTBOX_LEASE = float(os.getenv("ES_OUTBOX_LEASE", 60))
+ES_OUTBOX_MAX_ATTEMPTS = int(os.getenv("ES_OUTBOX_MAX_ATTEMPTS", 5))
+ES_OUTBOX_WAIT_TIMEOUT = float(os.getenv("ES_OUTBOX_WAIT_TIMEOUT", 10))
+
+# Change streams subscriber (see change_stream.py), run by the uwsgi mule: the
+# changes are processed by batches of CHANGE_STREAM_BATCH_SIZE changes, or
+# every CHANGE_STREAM_FLUSH_INTERVAL seconds. The changed resources are
+# indexed in Elasticsearch if CHANGE_STREAM_ES_SYNC is set. After an error,
+# the stream is watched again after a delay doubled at each consecutive
+# failure, up to CHANGE_STREAM_MAX_BACKOFF seconds.
+CHANGE_STREAM_ENABLED = os.getenv("CHANGE_STREAM_ENABLED", "").lower() in ["1", "true", "yes"]
+CHANGE_STREAM_BATCH_SIZE = int(os.getenv("CHANGE_STREAM_BATCH_SIZE", 500))
+CHANGE_STREAM_FLUSH_INTERVAL = float(os.getenv("CHANGE_STREAM_FLUSH_INTERVAL", 1))
+CHANGE_STREAM_MAX_BACKOFF = float(os.getenv("CHANGE_STREAM_MAX_BACKOFF", 60))
+CHANGE_STREAM_ES_SYNC = os.getenv("CHANGE_STREAM_ES_SYNC", "").lower() in ["1", "true", "yes"]
+
+# eCRF queries (see fhir2ecrf/fhir2ecrf.py): the patients are queried by
+# chunks of ECRF_CHUNK_SIZE patients, ECRF_MAX_WORKERS chunks concurrently
+# (which bounds the memory used by a query)
+ECRF_CHUNK_SIZE = int(os.getenv("ECRF_CHUNK_SIZE", 500))
+ECRF_MAX_WORKERS = int(os.getenv("ECRF_MAX_WORKERS", 4))
 
-# Pysin
-os.environ.setdefault("DOCUMENTS_PATH", "/var/data/documents")
+# eCRF results cache (see fhir2ecrf/result_cache.py): the least recently used
+# results are evicted above ECRF_RESULTS_MAX_BYTES bytes
+ECRF_RESULTS_PATH = os.getenv("ECRF_RESULTS_PATH", os.path.join(DATA_PATH, "ecrf-results"))
+ECRF_RESULTS_MAX_BYTES = int(os.getenv("ECRF_RESULTS_MAX_BYTES", 1024 * 1024 * 1024))
+# Without the change stream subscriber, the writes of the other services are
+# not seen by the cache: its entries expire after ECRF_RESULTS_MAX_AGE seconds
+# (0: never).
+ECRF_RESULTS_MAX_AGE = float(
+    os.getenv("ECRF_RESULTS_MAX_AGE", 0 if CHANGE_STREAM_ENABLED else GENERATIONS_TTL)
+)
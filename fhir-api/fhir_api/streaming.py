@@ -0,0 +1,63 @@
+"""
+Streaming serialization of search bundles.
+
+The bundle entries are serialized and sent one by one, and released as soon as
+they have been sent, so that the serialized bundle is never held in memory.
+"""
+from flask import Response, stream_with_context
+
+from fhir_api.serialization import dumps
+
+FHIR_JSON = "application/fhir+json"
+FHIR_NDJSON = "application/fhir+ndjson"
+NDJSON_FORMATS = [FHIR_NDJSON, "application/ndjson", "ndjson"]
+
+
+def pop_entries(bundle):
+    """Removes the entries from the bundle and returns an iterator over them,
+    which releases each entry once consumed."""
+    entries = bundle.pop("entry", None) or []
+    entries.reverse()
+
+    def consume():
+        while entries:
+            yield entries.pop()
+
+    return consume()
+
+
+def bundle_chunks(bundle):
+    """Yields the JSON serialization of a bundle, entry by entry. The entry
+    array is only opened with the first entry, as empty bundles have none."""
+    entries = pop_entries(bundle)
+    head = dumps(bundle)
+    yield head[:-1]
+
+    opened = False
+    for entry in entries:
+        if opened:
+            yield b"," + dumps(entry)
+        else:
+            yield (b',"entry":[' if bundle else b'"entry":[') + dumps(entry)
+            opened = True
+    yield b"]}" if opened else b"}"
+
+
+def ndjson_lines(bundle):
+    """Yields the resources of a bundle as NDJSON lines."""
+    for entry in pop_entries(bundle):
+        yield dumps(entry["resource"]) + b"\n"
+
+
+def serialize_bundle(bundle, output_format=FHIR_JSON):
+    """Returns the chunks of the serialization of a search bundle, either as a
+    JSON Bundle or as NDJSON, and their mimetype."""
+    if output_format in NDJSON_FORMATS:
+        return ndjson_lines(bundle), FHIR_NDJSON
+    return bundle_chunks(bundle), FHIR_JSON
+
+
+def stream_bundle(bundle, output_format=FHIR_JSON):
+    """Returns a streamed response of a search bundle."""
+    chunks, mimetype = serialize_bundle(bundle, output_format)
+    return Response(stream_with_context(chunks), mimetype=mimetype)
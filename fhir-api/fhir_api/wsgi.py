@@ -1,10 +1,17 @@
 from uwsgidecorators import postfork
 
+from fhir_api import change_stream, outbox, settings
 from fhir_api.app import app  # noqa
+from fhir_api.authentication import reset_session
 from fhir_api.db import get_store, reset_db_connection
 
 
 @postfork
 def on_fork_do():
     reset_db_connection()
+    reset_session()
     get_store()
+    if settings.CHANGE_STREAM_ENABLED and change_stream.is_subscriber_process():
+        change_stream.start_subscriber()
+    if settings.ES_WRITE_BEHIND:
+        outbox.start_worker()
@@ -0,0 +1,40 @@
+import mongomock
+import pytest
+
+
+def observation(id, patient_id, code, value):
+    return {
+        "resourceType": "Observation",
+        "id": id,
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "code": {"coding": [{"code": code}]},
+        "valueQuantity": {"value": value},
+    }
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().db
+    db.Patient.insert_many(
+        [
+            {"id": "p1", "name": [{"given": ["Ann"], "family": "A"}]},
+            {"id": "p2", "name": [{"given": ["Bob", "B."], "family": "B"}]},
+            {"id": "p3", "name": [{"given": ["Cid"]}]},
+        ]
+    )
+    db.Observation.insert_many(
+        [
+            observation("o1", "p1", "29463-7", 70),
+            observation("o2", "p1", "29463-7", 71),
+            observation("o3", "p2", "8302-2", 180),
+            observation("o4", "p3", "29463-7", 90),
+        ]
+    )
+    db.DiagnosticReport.insert_one(
+        {
+            "id": "d1",
+            "subject": {"reference": "Patient/p2"},
+            "code": {"coding": [{"display": "Leg AMPUTATION"}]},
+        }
+    )
+    return db
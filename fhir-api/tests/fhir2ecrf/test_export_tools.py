@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from fhir_api.fhir2ecrf.export_tools import (
+    treatment_bool,
+    treatment_bool_column,
+    treatment_first,
+    treatment_first_column,
+    treatment_list,
+    treatment_list_column,
+)
+
+TREATMENTS = [
+    (treatment_first, treatment_first_column),
+    (treatment_bool, treatment_bool_column),
+    (treatment_list, treatment_list_column),
+]
+
+
+@pytest.mark.parametrize("cell_treatment,column_treatment", TREATMENTS)
+def test_column_treatments(cell_treatment, column_treatment):
+    """The column-wise treatments give the same frames as the cell by cell
+    ones, dtypes included"""
+    df = pd.DataFrame(
+        {
+            "values": [[np.nan, 70.5], [71], np.nan, ["a", None, 2], [np.nan]],
+            "strings": [["Ann"], ["Bob", "B."], np.nan, [None], ["x"]],
+            "floats": [1.5, np.nan, 2.0, np.nan, 3.0],
+            "nested": [[[1, 2], {"a": 1}], [[3]], np.nan, [1], [2]],
+        },
+        index=[4, 3, 2, 1, 0],
+    )
+    assert_frame_equal(df.apply(column_treatment), df.applymap(cell_treatment))
+
+
+@pytest.mark.parametrize("column_treatment", [treatment_first_column, treatment_list_column])
+def test_empty_list(column_treatment):
+    with pytest.raises(IndexError):
+        column_treatment(pd.Series([["a"], []]))
@@ -0,0 +1,128 @@
+import pytest
+
+from fhir_api.fhir2ecrf.fhir2ecrf import FHIR2eCRF
+
+CONFIG_FRONT = {
+    "attributes": [
+        {"officialName": "First name", "customName": "First name"},
+        {"officialName": "Weight", "customName": "Weight"},
+        {"officialName": "Height", "customName": "Height"},
+        {
+            "officialName": "specific diagnostic text",
+            "customName": "Amputation",
+            "type": "text",
+            "text": "amput",
+        },
+    ],
+    "idPatient": ["p1", "p2"],
+}
+
+
+class TestFHIR2eCRF:
+    def test_create_config(self, db):
+        post_treatments, columns_renaming, config = FHIR2eCRF(db=db)._create_config_fhir2dataset(
+            CONFIG_FRONT
+        )
+
+        assert post_treatments == {
+            "first": ["First name", "Weight", "Height"],
+            "bool": ["Amputation"],
+        }
+        assert columns_renaming == {
+            "patient:name.given": "First name",
+            "observation:valueQuantity.value": "Weight",
+            "observation_2:valueQuantity.value": "Height",
+            "diagnostic_text_amput:code.coding.display": "Amputation",
+        }
+        assert config == {
+            "from": {
+                "patient": "Patient",
+                "observation": "Observation",
+                "observation_2": "Observation",
+                "diagnostic_text_amput": "DiagnosticReport",
+            },
+            "select": {
+                "patient": ["id", "name.given"],
+                "observation": ["valueQuantity.value"],
+                "observation_2": ["valueQuantity.value"],
+                "diagnostic_text_amput": ["code.coding.display"],
+            },
+            "join": {
+                "child": {
+                    "observation": {"subject": "patient"},
+                    "observation_2": {"subject": "patient"},
+                    "diagnostic_text_amput": {"subject": "patient"},
+                }
+            },
+            "where": {
+                "patient": {"id": "p1,p2"},
+                "observation": {"subject.reference": "p1,p2", "code.coding.code": "29463-7"},
+                "observation_2": {"subject.reference": "p1,p2", "code.coding.code": "8302-2"},
+                "diagnostic_text_amput": {
+                    "subject.reference": "p1,p2",
+                    "code.coding.display:contains": "amput",
+                },
+            },
+        }
+
+    def test_create_config_unknown_attribute(self, db):
+        with pytest.raises(ValueError):
+            FHIR2eCRF(db=db)._create_config_fhir2dataset(
+                {
+                    "attributes": [{"officialName": "Eye color", "customName": "Eyes"}],
+                    "idPatient": ["p1"],
+                }
+            )
+
+    def test_create_config_missing_text(self, db):
+        with pytest.raises(ValueError, match="Missing text"):
+            FHIR2eCRF(db=db)._create_config_fhir2dataset(
+                {
+                    "attributes": [{"officialName": "Medication Name", "customName": "Medication"}],
+                    "idPatient": ["p1"],
+                }
+            )
+
+    def test_query(self, db):
+        df = FHIR2eCRF(db=db).query(CONFIG_FRONT)
+
+        assert df.columns.to_list() == ["First name", "Weight", "Height", "Amputation"]
+        assert df.fillna("").values.tolist() == [
+            ["Ann", 70, "", 0],
+            ["Ann", 71, "", 0],
+            ["Bob", "", 180, 1],
+        ]
+
+    def test_query_chunks(self, db):
+        """Queries the patients by chunks and concatenates the results in the
+        order of the patients"""
+        stats = []
+        df = FHIR2eCRF(db=db, chunk_size=1, max_workers=2).query(CONFIG_FRONT, stats=stats)
+
+        assert df.fillna("").values.tolist() == [
+            ["Ann", 70, "", 0],
+            ["Ann", 71, "", 0],
+            ["Bob", "", 180, 1],
+        ]
+        assert sorted((chunk["chunk"], chunk["patients"], chunk["rows"]) for chunk in stats) == [
+            (0, 1, 2),
+            (1, 1, 1),
+        ]
+
+    def test_query_batches(self, db):
+        """Yields the results by chunk of patients, with the columns in the
+        order of the attributes"""
+        batches = FHIR2eCRF(db=db, chunk_size=1, max_workers=1).query_batches(CONFIG_FRONT)
+
+        assert [batch.fillna("").values.tolist() for batch in batches] == [
+            [["Ann", 70, "", 0], ["Ann", 71, "", 0]],
+            [["Bob", "", 180, 1]],
+        ]
+
+    def test_column_post_treatments(self, db):
+        assert FHIR2eCRF(db=db).column_post_treatments(CONFIG_FRONT) == {
+            "First name": "first",
+            "Weight": "first",
+            "Height": "first",
+            "Amputation": "bool",
+        }
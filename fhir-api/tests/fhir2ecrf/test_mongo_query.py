@@ -0,0 +1,51 @@
+import pytest
+
+from fhir_api.fhir2ecrf.mongo_query import MongoQuery, path_values, projection, where_condition
+
+
+def test_path_values():
+    resource = {"name": [{"given": ["Bob", "B."]}, {"given": ["Robert"]}, {"family": "B"}]}
+    assert path_values(resource, "name.given") == ["Bob", "B.", "Robert"]
+    assert path_values(resource, "birthDate") == []
+
+
+def test_where_condition():
+    assert where_condition("id", "p1,p2") == ("id", {"$in": ["p1", "p2"]})
+    assert where_condition("code.text:contains", "a.b") == (
+        "code.text",
+        {"$regex": r"a\.b", "$options": "i"},
+    )
+    assert where_condition("birthDate", {"ge": "1970"}) == ("birthDate", {"$gte": 1970.0})
+    with pytest.raises(ValueError):
+        where_condition("code:below", "123")
+
+
+def test_projection():
+    assert projection(["id", "name", "name.given", "id"]) == {"_id": 0, "id": 1, "name": 1}
+
+
+class TestMongoQuery:
+    def test_execute(self, db):
+        """Keeps all the patients of the cohort, with a row per joined
+        observation"""
+        query = MongoQuery(db, batch_size=1)
+        query.from_config(
+            {
+                "from": {"patient": "Patient", "observation": "Observation"},
+                "select": {"patient": ["name.given"], "observation": ["valueQuantity.value"]},
+                "join": {"child": {"observation": {"subject": "patient"}}},
+                "where": {
+                    "patient": {"id": "p1,p2"},
+                    "observation": {"subject.reference": "p1,p2", "code.coding.code": "29463-7"},
+                },
+            }
+        )
+        query.execute()
+
+        df = query.main_dataframe
+        assert df.columns.to_list() == ["patient:name.given", "observation:valueQuantity.value"]
+        rows = sorted(
+            (given[0], values[0] if isinstance(values, list) else None)
+            for given, values in df.itertuples(index=False)
+        )
+        assert rows == [("Ann", 70), ("Ann", 71), ("Bob", None)]
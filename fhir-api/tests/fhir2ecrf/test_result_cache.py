@@ -0,0 +1,123 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from fhir_api.cache import Generations
+from fhir_api.fhir2ecrf.fhir2ecrf import FHIR2eCRF
+from fhir_api.fhir2ecrf.result_cache import ResultCache, config_key
+
+from .test_fhir2ecrf import CONFIG_FRONT
+
+
+@pytest.fixture
+def result_cache(tmp_path):
+    generations = Generations("test-ecrf-generations")
+    generations.clear()
+    return ResultCache(str(tmp_path / "results"), max_bytes=1024 * 1024, generations=generations)
+
+
+def test_config_key():
+    """Sorts the keys of the attributes, keeps the order of the attributes and
+    of the patients"""
+    attributes = [{"officialName": "Weight", "customName": "W"}, {"officialName": "Gender"}]
+    key = config_key({"attributes": attributes, "idPatient": ["p1", "p2"]})
+
+    assert key == config_key(
+        {
+            "idPatient": ["p1", "p2"],
+            "attributes": [{"customName": "W", "officialName": "Weight"}, attributes[1]],
+        }
+    )
+    assert key != config_key({"attributes": attributes[::-1], "idPatient": ["p1", "p2"]})
+    assert key != config_key({"attributes": attributes, "idPatient": ["p2", "p1"]})
+
+
+class TestResultCache:
+    def test_get_set(self, result_cache):
+        """Returns the stored dataframe, dtypes included"""
+        df = pd.DataFrame(
+            {"name": ["Ann", None, 3], "weight": [70.5, np.nan, 1.0], "amputation": [0, 1, 0]}
+        )
+        result_cache.set("key", df, result_cache.types_generations(["Patient"]))
+
+        assert_frame_equal(result_cache.get("key"), df, check_index_type=True)
+        assert result_cache.get("other") is None
+        assert result_cache.stats()["hits"] == 1
+        assert result_cache.stats()["items"] == 1
+
+    def test_no_pickle(self, result_cache):
+        """Stores the object columns as JSON, in a directory only accessible
+        to its owner"""
+        df = pd.DataFrame({"name": ["Ann", None], "codes": [["a", "b"], []]})
+        result_cache.set("key", df, result_cache.types_generations(["Patient"]))
+
+        path = result_cache.path
+        with np.load(f"{path}/key.npz", allow_pickle=False) as entry:
+            assert sorted(entry.files) == ["batch_0_json_0", "batch_0_json_1", "meta"]
+        assert_frame_equal(result_cache.get("key"), df)
+        assert (os.stat(path).st_mode & 0o777) == 0o700
+
+    def test_not_json(self, result_cache):
+        """Does not store the results which can not be encoded"""
+        df = pd.DataFrame({"value": [object()]})
+        result_cache.set("key", df, result_cache.types_generations(["Patient"]))
+
+        assert result_cache.get("key") is None
+        assert result_cache.stats()["items"] == 0
+
+    def test_invalidation(self, result_cache):
+        """Drops the results when one of their resource types changes"""
+        df = pd.DataFrame({"a": [1]})
+        result_cache.set("key", df, result_cache.types_generations(["Patient", "Observation"]))
+        result_cache.generations.renew("Encounter")
+        assert result_cache.get("key") is not None
+
+        result_cache.generations.renew("Observation")
+        assert result_cache.get("key") is None
+        assert result_cache.stats()["invalidations"] == 1
+        assert result_cache.stats()["items"] == 0
+
+    def test_max_age(self, result_cache):
+        """Drops the results older than max_age"""
+        df = pd.DataFrame({"a": [1]})
+        result_cache.max_age = 60
+        with patch("fhir_api.fhir2ecrf.result_cache.time.time", return_value=1000):
+            result_cache.set("key", df, result_cache.types_generations(["Patient"]))
+
+        with patch("fhir_api.fhir2ecrf.result_cache.time.time", return_value=1060):
+            assert result_cache.get("key") is not None
+        with patch("fhir_api.fhir2ecrf.result_cache.time.time", return_value=1061):
+            assert result_cache.get("key") is None
+
+    def test_eviction(self, result_cache, tmp_path):
+        """Evicts the least recently used results above max_bytes"""
+        df = pd.DataFrame({"a": range(1000)})
+        generations = result_cache.types_generations(["Patient"])
+        result_cache.set("a", df, generations)
+        result_cache.max_bytes = (tmp_path / "results" / "a.npz").stat().st_size * 2
+        result_cache.set("b", df, generations)
+        result_cache.get("a")
+        result_cache.set("c", df, generations)
+
+        assert result_cache.get("b") is None
+        assert result_cache.get("a") is not None
+        assert result_cache.get("c") is not None
+        assert result_cache.stats()["evictions"] == 1
+
+
+def test_query(db, result_cache):
+    """Caches the results of the queries, by batch, until a queried type
+    changes"""
+    fhir2ecrf = FHIR2eCRF(db=db, chunk_size=1, result_cache=result_cache)
+    df = fhir2ecrf.query(CONFIG_FRONT)
+
+    db.Observation.delete_many({})
+    assert_frame_equal(fhir2ecrf.query(CONFIG_FRONT), df)
+    assert [len(batch) for batch in fhir2ecrf.query_batches(CONFIG_FRONT)] == [2, 1]
+
+    result_cache.generations.renew("Observation")
+    assert fhir2ecrf.query(CONFIG_FRONT)["Weight"].isna().all()
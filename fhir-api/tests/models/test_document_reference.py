@@ -0,0 +1,53 @@
+from unittest.mock import patch
+
+from fhir_api.documents import Hit
+from fhir_api.models.resources.document_reference import DocumentReference
+
+
+def document_reference(id, *urls):
+    return {
+        "resourceType": "DocumentReference",
+        "id": id,
+        "content": [{"attachment": {"url": url}} for url in urls],
+    }
+
+
+@patch("fhir_api.models.resources.document_reference.get_document_index")
+@patch("fhir_api.models.resources.document_reference.get_store")
+class TestSearchDocuments:
+    def test_relevance_order(self, mock_get_store, mock_get_index):
+        """Joins the hits and the DocumentReferences by document name, in the
+        order of relevance, whatever the order of the mongo results"""
+        mock_get_index.return_value.search.return_value = (
+            [Hit("b.pdf", "...b...", -2.0), Hit("a.pdf", "...a...", -1.0)],
+            12,
+        )
+        mock_get_store.return_value.db["DocumentReference"].find.return_value = [
+            document_reference("1", "a.pdf"),
+            document_reference("2", "b.pdf"),
+            document_reference("3", "a.pdf", "b.pdf"),
+        ]
+
+        bundle = DocumentReference.search_documents("diabete", count=2, offset=4)
+
+        mock_get_index.return_value.search.assert_called_once_with("diabete", count=2, offset=4)
+        mock_get_store.return_value.db["DocumentReference"].find.assert_called_once()
+        query = mock_get_store.return_value.db["DocumentReference"].find.call_args[0][0]
+        assert sorted(query["content.attachment.url"]["$in"]) == ["a.pdf", "b.pdf"]
+
+        assert bundle["total"] == 12
+        assert [entry["resource"]["id"] for entry in bundle["entry"]] == ["2", "3", "1"]
+        assert [entry["resource"]["description"] for entry in bundle["entry"]] == [
+            "...b...",
+            "...b...",
+            "...a...",
+        ]
+
+    def test_no_document_reference(self, mock_get_store, mock_get_index):
+        """Skips the documents which have no DocumentReference"""
+        mock_get_index.return_value.search.return_value = ([Hit("a.pdf", "...", -1.0)], 1)
+        mock_get_store.return_value.db["DocumentReference"].find.return_value = []
+
+        bundle = DocumentReference.search_documents("diabete")
+        assert bundle["total"] == 1
+        assert bundle["entry"] == []
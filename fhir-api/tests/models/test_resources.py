@@ -1,3 +1,4 @@
+import json
 from unittest.mock import patch
 
 import pytest
@@ -5,8 +6,13 @@ from fhir.resources.operationoutcome import OperationOutcome
 from fhir.resources.patient import Patient
 from multidict import MultiDict
 
-from fhir_api.errors import BadRequest
-from fhir_api.models.base import BaseResource
+from fhir_api.errors import BadRequest, NotFound
+from fhir_api.models.base import BaseResource, resource_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_resource_cache():
+    resource_cache.clear()
 
 
 @patch("fhir_api.models.base.get_store", autospec=True)
@@ -99,6 +105,49 @@ class TestResource:
         mock_get_store.return_value.read.assert_called_once_with("BaseResource", "test")
         assert r.resource == resource
 
+    def test_read_raw(self, mock_get_store):
+        """Returns the stored document without building its model"""
+        collection = mock_get_store.return_value.db.__getitem__.return_value
+        collection.find_one.return_value = {"resourceType": "Patient", "id": "test"}
+
+        data = BaseResource(id="test").read_raw()
+
+        assert json.loads(data) == {"resourceType": "Patient", "id": "test"}
+        collection.find_one.assert_called_once_with({"id": "test"}, {"_id": 0})
+        assert mock_get_store.return_value.normalize_resource.call_count == 0
+
+    def test_read_raw_not_found(self, mock_get_store):
+        collection = mock_get_store.return_value.db.__getitem__.return_value
+        collection.find_one.return_value = None
+
+        with pytest.raises(NotFound, match="BaseResource/test was not found"):
+            BaseResource(id="test").read_raw()
+
+    def test_read_raw_cached(self, mock_get_store):
+        """Reads a resource from the store only once"""
+        collection = mock_get_store.return_value.db.__getitem__.return_value
+        collection.find_one.return_value = {"resourceType": "Patient", "id": "test"}
+
+        assert BaseResource(id="test").read_raw() == BaseResource(id="test").read_raw()
+        BaseResource(id="other").read_raw()
+        assert collection.find_one.call_count == 2
+
+    def test_read_raw_cache_invalidated(self, mock_get_store):
+        """Reads a resource from the store again after it has been written"""
+        collection = mock_get_store.return_value.db.__getitem__.return_value
+        collection.find_one.return_value = {"resourceType": "Patient", "id": "test"}
+        BaseResource(id="test").read_raw()
+
+        mock_get_store.return_value.update.return_value = Patient(id="test", gender="other")
+        BaseResource(id="test").update({"gender": "other"})
+        collection.find_one.return_value = {"resourceType": "Patient", "gender": "other"}
+
+        assert json.loads(BaseResource(id="test").read_raw()) == {
+            "resourceType": "Patient",
+            "gender": "other",
+        }
+        assert collection.find_one.call_count == 2
+
     def test_read_missing_id(self, mock_get_store):
         """Raises an error when the id was not provided at init"""
         resource = Patient()
@@ -316,7 +365,7 @@ class TestResource:
         r = BaseResource(resource=resource)
 
         r.json()
-        mock_jsonify.assert_called_once_with(resource.dict())
+        mock_jsonify.assert_called_once_with(resource)
 
     @patch("fhir_api.models.base.jsonify")
     def test_json_with_id(self, mock_jsonify, mock_get_store):
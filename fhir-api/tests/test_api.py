@@ -0,0 +1,131 @@
+from unittest.mock import MagicMock, patch
+
+import mongomock
+import pytest
+from fhir.resources.operationoutcome import OperationOutcome
+from flask import Flask
+
+from fhir_api import models, settings
+from fhir_api.api import api
+from fhir_api.documents import DocumentIndex
+from fhir_api.models import BaseResource
+from fhir_api.models.base import resource_cache
+from fhir_api.serialization import JSONEncoder
+
+HEADERS = {"Authorization": "Bearer token"}
+
+
+class Patient(BaseResource):
+    pass
+
+
+@pytest.fixture
+def store():
+    store = MagicMock()
+    store.db = mongomock.MongoClient().db
+    with patch("fhir_api.models.base.get_store", return_value=store), patch(
+        "fhir_api.models.resources.document_reference.get_store", return_value=store
+    ):
+        yield store
+
+
+@pytest.fixture
+def client(store):
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    app.json_encoder = JSONEncoder
+    resource_cache.clear()
+    with patch.dict("fhir_api.api.resources_models", {"Patient": Patient}), patch(
+        "fhir_api.authentication.validate_token", return_value=True
+    ):
+        yield app.test_client()
+
+
+class TestRead:
+    def test_read(self, client, store):
+        store.db["Patient"].insert_one({"id": "1", "resourceType": "Patient"})
+
+        response = client.get("/Patient/1", headers=HEADERS)
+
+        assert response.status_code == 200
+        assert response.get_json() == {"id": "1", "resourceType": "Patient"}
+
+    def test_not_modified(self, client, store):
+        store.db["Patient"].insert_one({"id": "1", "resourceType": "Patient"})
+        etag = client.get("/Patient/1", headers=HEADERS).headers["ETag"]
+
+        response = client.get("/Patient/1", headers={**HEADERS, "If-None-Match": etag})
+
+        assert response.status_code == 304
+
+    @pytest.mark.parametrize(
+        "validator",
+        [{"If-None-Match": "*"}, {"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}],
+    )
+    def test_not_modified_unknown(self, client, validator):
+        """The validators of unknown resources always fail"""
+        response = client.get("/Patient/unknown", headers={**HEADERS, **validator})
+
+        assert response.status_code == 404
+
+    def test_validate_unknown(self, client, store):
+        """Returns the OperationOutcome of the store with a 404"""
+        store.read.return_value = OperationOutcome(
+            issue=[{"severity": "error", "code": "not-found", "diagnostics": "not found"}]
+        )
+
+        response = client.get("/Patient/unknown?_validate=true", headers=HEADERS)
+
+        assert response.status_code == 404
+        assert response.get_json()["resourceType"] == "OperationOutcome"
+
+
+class TestKeywordSearch:
+    @pytest.fixture
+    def documents(self, tmpdir, store):
+        """Indexes a document, referenced by a DocumentReference"""
+        tmpdir.mkdir("documents").join("1.pdf").write("Le patient présente un diabète.")
+        index = DocumentIndex(str(tmpdir.join("index.sqlite")))
+        index.update(str(tmpdir.join("documents")), extract=lambda path: open(path).read())
+        store.db["DocumentReference"].insert_one(
+            {
+                "resourceType": "DocumentReference",
+                "id": "1",
+                "content": [{"attachment": {"url": "1.pdf"}}],
+            }
+        )
+        with patch("fhir_api.documents.index", index):
+            yield index
+
+    def test_search(self, client, store, documents):
+        """The DocumentReferences are searched with their specific model"""
+        connection = {settings.DB_NAME: store.db}
+        with patch("fhir_api.models.db.get_db_connection", return_value=connection):
+            with patch.dict(models.resources_models, clear=True):
+                models.init()
+                response = client.get("/DocumentReference?$search=diabete", headers=HEADERS)
+
+        assert response.status_code == 200
+        bundle = response.get_json()
+        assert bundle["total"] == 1
+        assert bundle["entry"][0]["resource"]["id"] == "1"
+        assert "diabète" in bundle["entry"][0]["resource"]["description"]
+
+
+class TestBulkExport:
+    def test_unknown_group(self, client, store):
+        """Checks that the group exists at kickoff"""
+        with patch("fhir_api.export.get_store", return_value=store), patch(
+            "fhir_api.api.jobs.create_job"
+        ) as create_job:
+            response = client.get("/Group/1/$export", headers=HEADERS)
+
+        assert response.status_code == 404
+        assert response.get_json()["resourceType"] == "OperationOutcome"
+        assert create_job.call_count == 0
+
+    def test_invalid_since(self, client):
+        response = client.get("/$export?_since=yesterday", headers=HEADERS)
+
+        assert response.status_code == 400
+        assert "Invalid _since" in response.get_json()["issue"][0]["diagnostics"]
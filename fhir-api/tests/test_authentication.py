@@ -0,0 +1,198 @@
+import json
+import time
+from unittest.mock import patch
+
+import jwt
+import pytest
+import requests
+
+from fhir_api.authentication import JWKSKeys, get_cache_ttl, token_cache, validate_token, verify_jwt
+
+
+@pytest.fixture(autouse=True)
+def clear_token_cache():
+    token_cache.clear()
+
+
+@patch("fhir_api.authentication.get_session")
+class TestValidateToken:
+    def test_active_token(self, mock_get_session):
+        """Calls the introspection endpoint once per token"""
+        mock_get_session.return_value.post.return_value.json.return_value = {"active": True}
+
+        assert validate_token("token")
+        assert validate_token("token")
+        assert mock_get_session.return_value.post.call_count == 1
+
+    def test_inactive_token(self, mock_get_session):
+        """Caches rejected tokens too"""
+        mock_get_session.return_value.post.return_value.json.return_value = {"active": False}
+
+        assert not validate_token("token")
+        assert not validate_token("token")
+        assert mock_get_session.return_value.post.call_count == 1
+
+    def test_scope(self, mock_get_session):
+        """Caches the validation per (token, scope)"""
+        mock_get_session.return_value.post.return_value.json.return_value = {"active": True}
+
+        validate_token("token")
+        validate_token("token", scope="read")
+        assert mock_get_session.return_value.post.call_count == 2
+        assert mock_get_session.return_value.post.call_args[1]["data"] == {
+            "token": "token",
+            "scope": "read",
+        }
+
+    def test_expired_token(self, mock_get_session):
+        """Does not validate cached tokens past their expiration"""
+        mock_get_session.return_value.post.return_value.json.return_value = {
+            "active": True,
+            "exp": time.time() - 1,
+        }
+
+        assert not validate_token("token")
+
+
+@patch("fhir_api.authentication.settings")
+class TestGetCacheTTL:
+    def test_active(self, mock_settings):
+        mock_settings.TOKEN_CACHE_TTL = 300
+        assert get_cache_ttl({"active": True}) == 300
+
+    def test_active_with_exp(self, mock_settings):
+        """Does not cache tokens after their expiration"""
+        mock_settings.TOKEN_CACHE_TTL = 300
+        ttl = get_cache_ttl({"active": True, "exp": time.time() + 60})
+        assert 59 < ttl <= 60
+
+    def test_inactive(self, mock_settings):
+        mock_settings.TOKEN_CACHE_NEGATIVE_TTL = 5
+        assert get_cache_ttl({"active": False}) == 5
+
+
+@pytest.fixture(scope="module")
+def rsa_key():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def jwt_settings(rsa_key):
+    with patch("fhir_api.authentication.jwks_keys") as mock_jwks_keys, patch(
+        "fhir_api.authentication.settings"
+    ) as mock_settings:
+        mock_jwks_keys.get.side_effect = lambda kid: rsa_key.public_key() if kid == "1" else None
+        mock_settings.TOKEN_VALIDATION_MODE = "jwt"
+        mock_settings.TOKEN_ALGORITHMS = ["RS256"]
+        mock_settings.TOKEN_AUDIENCE = "fhir-api"
+        mock_settings.TOKEN_ISSUER = None
+        yield mock_settings
+
+
+@pytest.mark.usefixtures("jwt_settings")
+@patch("fhir_api.authentication.validate_token_introspection")
+class TestValidateJWT:
+    def make_token(self, rsa_key, kid="1", **claims):
+        claims = {"exp": time.time() + 60, "aud": "fhir-api", **claims}
+        return jwt.encode(claims, rsa_key, algorithm="RS256", headers={"kid": kid})
+
+    def test_valid_jwt(self, mock_introspection, rsa_key):
+        """Validates signed JWTs without calling the introspection endpoint"""
+        assert validate_token(self.make_token(rsa_key, scope="read write"), scope="read")
+        assert mock_introspection.call_count == 0
+
+    def test_expired_jwt(self, mock_introspection, rsa_key):
+        assert not validate_token(self.make_token(rsa_key, exp=time.time() - 60))
+        assert mock_introspection.call_count == 0
+
+    def test_wrong_audience(self, mock_introspection, rsa_key):
+        assert not validate_token(self.make_token(rsa_key, aud="other"))
+
+    def test_missing_scope(self, mock_introspection, rsa_key):
+        assert not validate_token(self.make_token(rsa_key, scope="write"), scope="read")
+
+    def test_unknown_key(self, mock_introspection, rsa_key):
+        """Falls back to the introspection endpoint when the key is unknown"""
+        token = self.make_token(rsa_key, kid="2")
+        assert validate_token(token) == mock_introspection.return_value
+        mock_introspection.assert_called_once_with(token, scope=None)
+
+    def test_opaque_token(self, mock_introspection):
+        """Falls back to the introspection endpoint for opaque tokens"""
+        assert validate_token("opaque") == mock_introspection.return_value
+        mock_introspection.assert_called_once_with("opaque", scope=None)
+
+
+class SynchronousThread:
+    """Runs the target of a thread when it is started"""
+
+    def __init__(self, target, **kwargs):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+@pytest.fixture
+def jwks_session(rsa_key):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(rsa_key.public_key()))
+    with patch("fhir_api.authentication.get_session") as mock_get_session, patch(
+        "fhir_api.authentication.threading.Thread", SynchronousThread
+    ):
+        mock_get_session.return_value.get.return_value.json.return_value = {
+            "keys": [{**jwk, "kid": "1"}]
+        }
+        yield mock_get_session.return_value
+
+
+class TestJWKSKeys:
+    def test_get(self, jwks_session, rsa_key):
+        """Fetches the key set once"""
+        keys = JWKSKeys("http://jwks")
+        assert keys.get("1").public_numbers() == rsa_key.public_key().public_numbers()
+        assert keys.get(None) is not None
+        assert jwks_session.get.call_count == 1
+
+    def test_unknown_kid(self, jwks_session):
+        """Refreshes the key set in the background, at most once per
+        JWKS_MIN_REFRESH_INTERVAL seconds"""
+        keys = JWKSKeys("http://jwks")
+        assert keys.get("1") is not None
+        assert keys.get("2") is None
+        assert jwks_session.get.call_count == 1
+
+        with patch("fhir_api.authentication.settings.JWKS_MIN_REFRESH_INTERVAL", 0):
+            assert keys.get("2") is None
+        assert jwks_session.get.call_count == 2
+        assert not keys._refreshing
+
+    def test_refresh_failure(self, jwks_session):
+        """Does not know any key until the key set is fetched, and does not
+        retry before JWKS_MIN_REFRESH_INTERVAL seconds"""
+        jwks_session.get.side_effect = requests.ConnectionError("unreachable")
+        keys = JWKSKeys("http://jwks")
+        assert keys.get("1") is None
+        assert keys.get("1") is None
+        assert jwks_session.get.call_count == 1
+
+        jwks_session.get.side_effect = None
+        with patch("fhir_api.authentication.settings.JWKS_MIN_REFRESH_INTERVAL", 0):
+            assert keys.get("1") is not None
+
+    def test_invalid_key_set(self, jwks_session):
+        jwks_session.get.return_value.json.side_effect = ValueError("not JSON")
+        assert JWKSKeys("http://jwks").get("1") is None
+
+    def test_no_url(self, jwks_session):
+        assert JWKSKeys(None).get("1") is None
+        jwks_session.get.assert_not_called()
+
+    def test_verify_jwt_fallback(self, jwks_session, rsa_key):
+        """The tokens are validated by introspection when the key set can not
+        be fetched"""
+        jwks_session.get.side_effect = requests.ConnectionError("unreachable")
+        token = jwt.encode({"exp": time.time() + 60}, rsa_key, algorithm="RS256")
+        with patch("fhir_api.authentication.jwks_keys", JWKSKeys("http://jwks")):
+            assert verify_jwt(token) is None
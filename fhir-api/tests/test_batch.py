@@ -0,0 +1,201 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from fhir_api.batch import BatchProcessor, replace_references
+from fhir_api.errors import BadRequest
+
+
+def make_bundle(type_, entries):
+    return {"resourceType": "Bundle", "type": type_, "entry": entries}
+
+
+def post(resource, full_url=None):
+    entry = {"request": {"method": "POST", "url": resource["resourceType"]}, "resource": resource}
+    if full_url:
+        entry["fullUrl"] = full_url
+    return entry
+
+
+def make_store(**results):
+    store = MagicMock()
+    store.db.__getitem__.return_value.bulk_write.return_value.bulk_api_result = results
+    return store
+
+
+class TestBatchProcessor:
+    def test_not_a_batch(self):
+        processor = BatchProcessor(make_store(), ["Patient"])
+        with pytest.raises(BadRequest, match="the Bundle type must be batch or transaction"):
+            processor.process(make_bundle("collection", []))
+
+    def test_batch(self):
+        """Groups the entries by operation and resource type"""
+        store = make_store()
+        store.db.__getitem__.return_value.bulk_write.side_effect = [
+            MagicMock(bulk_api_result={}),
+            MagicMock(bulk_api_result={}),
+            MagicMock(bulk_api_result={"upserted": [{"index": 0, "_id": "x"}]}),
+        ]
+        bundle = make_bundle(
+            "batch",
+            [
+                post({"resourceType": "Patient", "id": "1"}),
+                {"request": {"method": "DELETE", "url": "Patient/2"}},
+                {"request": {"method": "PUT", "url": "Patient/3"}, "resource": {"gender": "male"}},
+                post({"resourceType": "Patient", "id": "4"}),
+                {"request": {"method": "GET", "url": "Patient/1"}},
+            ],
+        )
+
+        response, status = BatchProcessor(store, ["Patient"]).process(bundle)
+
+        assert status == 200
+        assert response["type"] == "batch-response"
+        assert [entry["response"]["status"] for entry in response["entry"]] == [
+            "201 Created",
+            "204 No Content",
+            "201 Created",
+            "201 Created",
+            "405 Method Not Allowed",
+        ]
+        assert response["entry"][4]["response"]["outcome"]["issue"][0]["code"] == "not-supported"
+        # one bulk write per operation and resource type, deletions first
+        calls = store.db.__getitem__.return_value.bulk_write.call_args_list
+        assert [len(call[0][0]) for call in calls] == [1, 2, 1]
+
+    def test_invalid_entries(self):
+        """Fails the malformed entries, and accepts a null entry list"""
+        processor = BatchProcessor(make_store(), ["Patient"])
+        assert processor.process(make_bundle("batch", None)) == (
+            {"resourceType": "Bundle", "type": "batch-response", "entry": []},
+            200,
+        )
+
+        bundle = make_bundle("batch", [None, {"request": {"method": "PUT", "url": None}}])
+        response, status = BatchProcessor(make_store(), ["Patient"]).process(bundle)
+
+        assert status == 200
+        assert [entry["response"]["status"] for entry in response["entry"]] == [
+            "400 Bad Request",
+            "400 Bad Request",
+        ]
+
+    def test_batch_write_errors(self):
+        """Reports the write errors of a batch per entry"""
+        store = make_store()
+        store.db.__getitem__.return_value.bulk_write.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}]}
+        )
+        bundle = make_bundle("batch", [post({"resourceType": "Patient", "id": "1"})] * 2)
+
+        response, _ = BatchProcessor(store, ["Patient"]).process(bundle)
+
+        assert [entry["response"]["status"] for entry in response["entry"]] == [
+            "201 Created",
+            "409 Conflict",
+        ]
+
+    def test_transaction_invalid(self):
+        """Writes nothing when an entry of a transaction is invalid"""
+        store = make_store()
+        store.normalize_resource.side_effect = [None, Exception("invalid resource")]
+        bundle = make_bundle(
+            "transaction",
+            [post({"resourceType": "Patient"}), post({"resourceType": "Patient"})],
+        )
+
+        response, status = BatchProcessor(store, ["Patient"]).process(bundle)
+
+        assert status == 400
+        assert response["issue"] == [
+            {
+                "severity": "error",
+                "code": "invalid",
+                "diagnostics": "invalid resource",
+                "expression": ["Bundle.entry[1]"],
+            }
+        ]
+        assert store.db.__getitem__.return_value.bulk_write.call_count == 0
+
+    def test_transaction_rollback(self):
+        store = make_store()
+        session = store.db.client.start_session.return_value.__enter__.return_value
+        session.with_transaction.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}]}
+        )
+        bundle = make_bundle("transaction", [post({"resourceType": "Patient", "id": "1"})])
+
+        response, status = BatchProcessor(store, ["Patient"]).process(bundle)
+
+        assert status == 409
+        assert response["issue"][0]["code"] == "conflict"
+
+    @patch("fhir_api.batch.changes.type_changed")
+    @patch("fhir_api.batch.resource_cache")
+    def test_transaction_invalidation(self, mock_resource_cache, mock_type_changed):
+        """Invalidates the caches once the transaction is committed"""
+        store = make_store()
+        session = store.db.client.start_session.return_value.__enter__.return_value
+
+        def with_transaction(callback):
+            callback(session)
+            assert mock_resource_cache.invalidate.call_count == 0
+            assert mock_type_changed.call_count == 0
+
+        session.with_transaction.side_effect = with_transaction
+        bundle = make_bundle("transaction", [post({"resourceType": "Patient", "id": "1"})])
+
+        response, status = BatchProcessor(store, ["Patient"]).process(bundle)
+
+        assert status == 200
+        mock_resource_cache.invalidate.assert_called_once_with("Patient", "1")
+        mock_type_changed.assert_called_once_with("Patient")
+
+    @patch("fhir_api.batch.outbox.enqueue", return_value=["entry"])
+    def test_transaction_outbox(self, mock_enqueue):
+        """Queues the indexing of the writes once the transaction is
+        committed"""
+        store = make_store()
+        session = store.db.client.start_session.return_value.__enter__.return_value
+
+        def with_transaction(callback):
+            callback(session)
+            assert mock_enqueue.call_count == 0
+
+        session.with_transaction.side_effect = with_transaction
+        bundle = make_bundle("transaction", [post({"resourceType": "Patient", "id": "1"})])
+
+        processor = BatchProcessor(store, ["Patient"])
+        response, status = processor.process(bundle)
+
+        assert status == 200
+        mock_enqueue.assert_called_once_with("Patient", ["1"])
+        assert processor.outbox_entries == ["entry"]
+
+    def test_transaction_references(self):
+        """Resolves the references to the resources created by a transaction"""
+        store = make_store()
+        session = store.db.client.start_session.return_value.__enter__.return_value
+        session.with_transaction.side_effect = lambda callback: callback(session)
+        observation = {"resourceType": "Observation", "subject": {"reference": "urn:uuid:1"}}
+        bundle = make_bundle(
+            "transaction",
+            [
+                post({"resourceType": "Patient", "id": "p1"}, full_url="urn:uuid:1"),
+                post(observation),
+            ],
+        )
+
+        response, status = BatchProcessor(store, ["Patient", "Observation"]).process(bundle)
+
+        assert status == 200
+        assert response["type"] == "transaction-response"
+        assert observation["subject"] == {"reference": "Patient/p1"}
+
+
+def test_replace_references():
+    resource = {"a": [{"reference": "urn:uuid:1"}, {"reference": "Patient/2"}]}
+    replace_references(resource, {"urn:uuid:1": "Patient/1"})
+    assert resource == {"a": [{"reference": "Patient/1"}, {"reference": "Patient/2"}]}
@@ -0,0 +1,130 @@
+import io
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from fhir_api.bundle import BundleLoader, iter_bundle_entries
+from fhir_api.errors import BadRequest
+
+
+def as_stream(data):
+    return io.BytesIO(json.dumps(data).encode())
+
+
+class TestIterBundleEntries:
+    def test_entries(self):
+        """Yields the bundle entries"""
+        entries = [
+            {"resource": {"resourceType": "Patient", "id": "1", "name": [{"given": ["A"]}]}},
+            {"resource": {"resourceType": "Observation", "valueQuantity": {"value": 1.5}}},
+        ]
+        bundle = {"resourceType": "Bundle", "type": "collection", "entry": entries}
+
+        assert list(iter_bundle_entries(as_stream(bundle))) == entries
+
+    def test_not_a_bundle(self):
+        with pytest.raises(BadRequest, match="input must be a FHIR Bundle resource"):
+            list(iter_bundle_entries(as_stream({"resourceType": "Patient"})))
+
+    def test_entries_before_resource_type(self):
+        bundle = {"entry": [{"resource": {"resourceType": "Patient"}}], "resourceType": "Bundle"}
+        with pytest.raises(BadRequest, match="input must be a FHIR Bundle resource"):
+            list(iter_bundle_entries(as_stream(bundle)))
+
+    def test_invalid_json(self):
+        with pytest.raises(BadRequest, match="invalid JSON"):
+            list(iter_bundle_entries(io.BytesIO(b'{"resourceType": "Bundle", "entry": [')))
+
+
+class TestBundleLoader:
+    def test_batches(self):
+        """Writes the resources by batches of batch_size, per resource type"""
+        store = MagicMock()
+        store.db.__getitem__.return_value.insert_many.side_effect = lambda docs, **_: MagicMock(
+            inserted_ids=[None] * len(docs)
+        )
+        entries = [{"resource": {"resourceType": "Patient", "id": str(i)}} for i in range(5)]
+
+        loader = BundleLoader(store, ["Patient"], batch_size=2).load(entries)
+
+        insert_many = store.db.__getitem__.return_value.insert_many
+        assert [len(call[0][0]) for call in insert_many.call_args_list] == [2, 2, 1]
+        assert loader.created == 5
+        assert loader.operation_outcome()["issue"] == [
+            {
+                "severity": "information",
+                "code": "informational",
+                "diagnostics": "5 entries processed: 5 resources created, "
+                "0 already existing, 0 failed",
+            }
+        ]
+
+    def test_invalid_entries(self):
+        """Reports an issue per invalid entry"""
+        store = MagicMock()
+        store.normalize_resource.side_effect = [ValueError("invalid gender"), None]
+        store.db.__getitem__.return_value.insert_many.return_value.inserted_ids = [None]
+        entries = [
+            {"request": {}},
+            {"resource": {"resourceType": "Unknown"}},
+            {"resource": {"resourceType": "Patient", "gender": "?"}},
+            {"resource": {"resourceType": "Patient"}},
+        ]
+
+        loader = BundleLoader(store, ["Patient"]).load(entries)
+
+        issues = loader.operation_outcome()["issue"]
+        assert [(issue["code"], issue["expression"]) for issue in issues[1:]] == [
+            ("required", ["Bundle.entry[0]"]),
+            ("not-supported", ["Bundle.entry[1]"]),
+            ("invalid", ["Bundle.entry[2]"]),
+        ]
+        assert loader.created == 1
+        assert entries[3]["resource"]["id"]
+
+    def test_duplicates(self):
+        """Skips the resources which already exist"""
+        store = MagicMock()
+        store.db.__getitem__.return_value.insert_many.side_effect = BulkWriteError(
+            {"nInserted": 1, "writeErrors": [{"index": 1, "code": 11000, "errmsg": "dup"}]}
+        )
+        entries = [{"resource": {"resourceType": "Patient", "id": str(i)}} for i in range(2)]
+
+        loader = BundleLoader(store, ["Patient"]).load(entries)
+
+        assert loader.created == 1
+        assert loader.duplicates == 1
+        assert loader.operation_outcome()["issue"][1]["severity"] == "warning"
+        assert loader.operation_outcome()["issue"][1]["expression"] == ["Bundle.entry[1]"]
+
+    def test_invalid_json(self):
+        """Writes the entries read before the error and reports them"""
+        store = MagicMock()
+        store.db.__getitem__.return_value.insert_many.side_effect = lambda docs, **_: MagicMock(
+            inserted_ids=[None] * len(docs)
+        )
+        stream = io.BytesIO(
+            b'{"resourceType": "Bundle", "entry": ['
+            b'{"resource": {"resourceType": "Patient", "id": "1"}}, {"resource": '
+        )
+        loader = BundleLoader(store, ["Patient"])
+
+        with pytest.raises(BadRequest, match="1 entries processed: 1 resources created"):
+            loader.load(iter_bundle_entries(stream))
+
+        assert loader.created == 1
+
+    def test_invalidation(self):
+        """Invalidates the cached resources which have been written"""
+        store = MagicMock()
+        store.db.__getitem__.return_value.insert_many.side_effect = BulkWriteError(
+            {"nInserted": 1, "writeErrors": [{"index": 1, "code": 11000, "errmsg": "dup"}]}
+        )
+        entries = [{"resource": {"resourceType": "Patient", "id": str(i)}} for i in range(2)]
+
+        with patch("fhir_api.bundle.resource_cache") as resource_cache:
+            BundleLoader(store, ["Patient"]).load(entries)
+
+        resource_cache.invalidate.assert_called_once_with("Patient", "0")
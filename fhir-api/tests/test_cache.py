@@ -0,0 +1,152 @@
+from unittest.mock import patch
+
+from fhir_api.cache import LRUCache, ResourceCache, SearchCache, SharedCache, get_stats
+
+
+class TestLRUCache:
+    def test_get_set(self):
+        """Returns the stored values and counts hits and misses"""
+        cache = LRUCache("test-get-set")
+        cache.set("key", "value")
+
+        assert cache.get("key") == "value"
+        assert cache.get("other") is None
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_evicts_least_recently_used(self):
+        """Evicts the least recently used entries when full"""
+        cache = LRUCache("test-lru", max_items=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.stats()["evictions"] == 1
+
+    def test_evicts_on_size(self):
+        """Evicts entries when the total size exceeds max_bytes"""
+        cache = LRUCache("test-size", max_bytes=10)
+        cache.set("a", "a", size=6)
+        cache.set("b", "b", size=6)
+        cache.set("c", "c", size=11)
+
+        assert cache.get("a") is None
+        assert cache.get("b") == "b"
+        assert cache.get("c") is None
+        assert cache.stats()["bytes"] == 6
+
+    @patch("fhir_api.cache.time.monotonic")
+    def test_expiration(self, mock_monotonic):
+        """Does not return expired entries"""
+        mock_monotonic.return_value = 100
+        cache = LRUCache("test-ttl", ttl=10)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=20)
+
+        mock_monotonic.return_value = 115
+        assert cache.get("a") is None
+        assert cache.get("b") == 2
+
+    def test_zero_ttl(self):
+        """Does not store entries which are already expired"""
+        cache = LRUCache("test-zero-ttl")
+        cache.set("a", 1, ttl=0)
+
+        assert cache.get("a") is None
+
+    def test_delete(self):
+        cache = LRUCache("test-delete")
+        cache.set("a", 1, size=1)
+        cache.delete("a")
+        cache.delete("unknown")
+
+        assert cache.get("a") is None
+        assert cache.stats()["bytes"] == 0
+
+
+class TestSharedCache:
+    def test_local_fallback(self):
+        """Uses a local cache when not running under uwsgi"""
+        cache = SharedCache("test-shared")
+        cache.set("key", {"active": True})
+
+        assert cache.get("key") == {"active": True}
+        assert get_stats()["test-shared"]["shared"] is False
+        assert "test-shared.local" not in get_stats()
+
+
+class TestResourceCache:
+    def test_get_set(self):
+        cache = ResourceCache("test-resources")
+        resource, key = cache.get("Patient", "1")
+        assert resource is None
+
+        cache.set(key, {"id": "1"})
+        assert cache.get("Patient", "1") == ({"id": "1"}, key)
+
+    def test_invalidate(self):
+        """Entries cached before an invalidation are not served anymore"""
+        cache = ResourceCache("test-resources-invalidate")
+        _, key = cache.get("Patient", "1")
+        cache.set(key, {"id": "1"})
+
+        cache.invalidate("Patient", "1")
+        resource, new_key = cache.get("Patient", "1")
+        assert resource is None
+        assert new_key != key
+
+    def test_concurrent_write(self):
+        """A resource read before a write is cached under an outdated key"""
+        cache = ResourceCache("test-resources-concurrent")
+        _, key = cache.get("Patient", "1")
+        cache.invalidate("Patient", "1")
+        cache.set(key, {"id": "1"})
+
+        assert cache.get("Patient", "1")[0] is None
+
+    def test_disabled(self):
+        cache = ResourceCache("test-resources-disabled", max_items=0)
+        _, key = cache.get("Patient", "1")
+        cache.set(key, {"id": "1"})
+
+        assert cache.get("Patient", "1") == (None, None)
+
+    def test_disabled_generations(self):
+        """Keeps the generations (ETags) of the resources when disabled"""
+        cache = ResourceCache("test-resources-disabled-generations", max_items=0)
+
+        assert cache.generation("Patient", "1") == cache.generation("Patient", "1")
+
+
+class TestSearchCache:
+    def test_caching(self):
+        """Caches the results once all their chunks are consumed, and counts
+        the hits by resource type"""
+        cache = SearchCache("test-searches")
+        assert cache.get("Patient", "key") is None
+
+        chunks = cache.caching("key", iter([b'{"a":', b"1}"]), "application/fhir+json")
+        assert next(chunks) == b'{"a":'
+        assert cache.get("Patient", "key") is None
+        assert list(chunks) == [b"1}"]
+
+        assert cache.get("Patient", "key") == ("application/fhir+json", b'{"a":1}')
+        stats = get_stats()["test-searches"]
+        assert stats["bytes"] == 7
+        assert stats["types"]["Patient"] == {"hits": 1, "misses": 2, "hit_ratio": 1 / 3}
+        assert "test-searches.results" not in get_stats()
+
+    def test_max_entry_bytes(self):
+        cache = SearchCache("test-searches-large", max_entry_bytes=4)
+        assert list(cache.caching("key", iter([b"123", b"456"]), "text/plain")) == [b"123", b"456"]
+        assert cache.get(None, "key") is None
+
+    def test_disabled(self):
+        cache = SearchCache("test-searches-disabled", max_items=0)
+        assert list(cache.caching("key", iter([b"1"]), "text/plain")) == [b"1"]
+        assert cache.get("Patient", "key") is None
+        assert cache.stats()["types"] == {}
@@ -0,0 +1,135 @@
+from unittest.mock import MagicMock, patch
+
+import mongomock
+import pytest
+from pymongo.errors import OperationFailure
+
+from fhir_api import change_stream, changes, settings
+from fhir_api.models.base import resource_cache
+
+
+class FakeStream:
+    """Change stream yielding the given changes, then stopping its
+    subscriber"""
+
+    def __init__(self, changes, subscriber):
+        self.changes = list(changes)
+        self.subscriber = subscriber
+        self.alive = True
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def try_next(self):
+        if not self.changes:
+            self.subscriber.stop()
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = change["_id"]
+        return change
+
+
+def change(token, operation, resource_type, id=None):
+    change = {"_id": {"_data": token}, "operationType": operation, "ns": {"coll": resource_type}}
+    if id is not None:
+        change["fullDocument"] = {"id": id}
+    return change
+
+
+@pytest.fixture
+def internal_db():
+    internal_db = mongomock.MongoClient().internal
+    with patch("fhir_api.db.get_internal_db", return_value=internal_db):
+        yield internal_db
+
+
+@pytest.fixture
+def store():
+    store = MagicMock()
+    with patch("fhir_api.db.get_store", return_value=store), patch.dict(
+        "fhir_api.change_stream.resources_models", {"Patient": None, "Observation": None}
+    ):
+        yield store
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    resource_cache.clear()
+    changes.type_generations.clear()
+
+
+class TestSubscriber:
+    def test_run(self, internal_db, store):
+        """Invalidates the caches, counts the changes and saves the resume
+        token"""
+        subscriber = change_stream.Subscriber(batch_size=2)
+        store.db.watch.side_effect = lambda *args, **kwargs: FakeStream(
+            [
+                change("1", "insert", "Patient", "p1"),
+                change("2", "update", "Patient", "p1"),
+                change("3", "delete", "Observation"),
+            ],
+            subscriber,
+        )
+        patient = resource_cache.generation("Patient", "p1")
+        observations = changes.type_generations.get("Observation")
+
+        subscriber.run()
+
+        assert resource_cache.generation("Patient", "p1") != patient
+        assert changes.type_generations.get("Observation") != observations
+        counters = change_stream.get_counters()
+        assert counters["Patient"]["insert"] == 1
+        assert counters["Patient"]["update"] == 1
+        assert counters["Observation"]["delete"] == 1
+        state = internal_db.change_streams.find_one({"_id": "resources"})
+        assert state["resume_token"] == {"_data": "3"}
+
+    def test_resume(self, internal_db, store):
+        """Resumes after the saved token, and restarts the stream when the
+        token is not in the oplog anymore"""
+        internal_db.change_streams.insert_one({"_id": "resources", "resume_token": {"_data": "1"}})
+        subscriber = change_stream.Subscriber()
+        store.db.watch.side_effect = [
+            OperationFailure("history lost", code=286),
+            FakeStream([change("5", "insert", "Patient", "p1")], subscriber),
+        ]
+        all_types = changes.type_generations.get(changes.ALL_TYPES)
+
+        subscriber.run()
+
+        resume_after = [call[1]["resume_after"] for call in store.db.watch.call_args_list]
+        assert resume_after == [{"_data": "1"}, None]
+        assert changes.type_generations.get(changes.ALL_TYPES) != all_types
+        assert internal_db.change_streams.find_one()["resume_token"] == {"_data": "5"}
+
+    def test_back_off(self, internal_db, store):
+        """Watches the changes again after the errors, waiting longer after
+        each consecutive failure"""
+        subscriber = change_stream.Subscriber(flush_interval=1)
+        store.db.watch.side_effect = [
+            OperationFailure("not authorized", code=13),
+            OperationFailure("not authorized", code=13),
+            FakeStream([change("1", "insert", "Patient", "p1")], subscriber),
+        ]
+        with patch.object(subscriber.stopped, "wait") as wait, patch.object(
+            settings, "CHANGE_STREAM_MAX_BACKOFF", 1.5
+        ):
+            subscriber.run()
+
+        assert [call[0][0] for call in wait.call_args_list] == [1, 1.5]
+        assert subscriber.failures == 0
+        assert internal_db.change_streams.find_one()["resume_token"] == {"_data": "1"}
+
+    def test_es_sync(self, internal_db, store):
+        subscriber = change_stream.Subscriber(es_sync=True)
+        subscriber.process(change("1", "insert", "Patient", "p2"))
+        subscriber.process(change("2", "replace", "Patient", "p1"))
+        subscriber.process(change("3", "update", "Patient", "p1"))
+        with patch("fhir_api.outbox.queue") as queue:
+            subscriber.flush()
+        queue.assert_called_once_with("Patient", ["p1", "p2"])
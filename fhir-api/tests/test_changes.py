@@ -0,0 +1,131 @@
+from flask import Flask
+from werkzeug.datastructures import MultiDict
+
+from fhir_api import changes
+from fhir_api.changes import is_not_modified, normalize_search, search_etag, search_types
+
+app = Flask(__name__)
+
+
+class TestSearchTypes:
+    def test_resource_type(self):
+        assert search_types("Patient", MultiDict({"name": "Donald"})) == {"Patient"}
+
+    def test_included_types(self):
+        args = MultiDict(
+            [
+                ("_include", "Observation:subject:Patient"),
+                ("_revinclude", "Encounter:patient"),
+                ("_has:Condition:subject:code", "1234"),
+            ]
+        )
+        assert search_types("Observation", args) == {
+            "Observation",
+            "Patient",
+            "Encounter",
+            "Condition",
+        }
+
+    def test_type(self):
+        assert search_types(None, MultiDict({"_type": "Patient,Observation"})) == {
+            "Patient",
+            "Observation",
+        }
+
+    def test_unknown_types(self):
+        """The included types are unknown when the target type is missing"""
+        assert search_types("Observation", MultiDict({"_include": "Observation:subject"})) is None
+        assert search_types(None, MultiDict()) is None
+
+
+class TestNormalizeSearch:
+    def test_normalize(self):
+        """Sorts the parameters and their alternative values, and lowercases
+        the modifiers (not the resource types)"""
+        args = MultiDict(
+            [
+                ("name:Exact", "Donald"),
+                ("gender", "male,female"),
+                ("_include", "Observation:subject:Patient"),
+                ("subject:Patient", "1"),
+            ]
+        )
+        assert normalize_search(args) == [
+            ("_include", "Observation:subject:Patient"),
+            ("gender", "female,male"),
+            ("name:exact", "Donald"),
+            ("subject:Patient", "1"),
+        ]
+
+    def test_ordered(self):
+        """Keeps the order of the sort parameters"""
+        args = MultiDict([("_sort", "name,-birthdate"), ("a", "1"), ("_sort", "_id")])
+        assert normalize_search(args) == [
+            ("_sort", "name,-birthdate"),
+            ("_sort", "_id"),
+            ("a", "1"),
+        ]
+
+
+class TestSearchEtag:
+    def test_normalized(self):
+        """The ETag does not depend on the order of the parameters"""
+        etag = search_etag("Patient", MultiDict([("a", "1"), ("b", "2")]), [1])
+        assert etag == search_etag("Patient", MultiDict([("b", "2"), ("a", "1")]), [1])
+        etag = search_etag("Patient", MultiDict([("a:missing", "true"), ("b", "1,2")]), [1])
+        assert etag == search_etag("Patient", MultiDict([("b", "2,1"), ("a:Missing", "true")]), [1])
+        assert etag != search_etag("Patient", MultiDict([("a", "1"), ("b", "2")]), [2])
+
+    def test_type_changed(self):
+        """The generations change when a type is written"""
+        args = MultiDict({"_include": "Observation:subject:Patient"})
+        generations = changes.search_generations("Observation", args)
+
+        changes.type_changed("Encounter")
+        assert changes.search_generations("Observation", args) == generations
+        changes.type_changed("Patient")
+        assert changes.search_generations("Observation", args) != generations
+
+    def test_type_versions(self):
+        """The versions of the types do not expire, and are all renewed when
+        any type may have changed"""
+        version = changes.type_versions.get("Patient")
+        assert changes.type_versions.tokens.ttl is None
+
+        changes.type_changed("Encounter")
+        assert changes.type_versions.get("Patient") == version
+        changes.type_changed("Patient")
+        assert changes.type_versions.get("Patient") != version
+
+        version = changes.type_versions.get("Patient")
+        changes.type_changed(changes.ALL_TYPES)
+        assert changes.type_versions.get("Patient") != version
+
+
+class TestIsNotModified:
+    def test_if_none_match(self):
+        with app.test_request_context(headers={"If-None-Match": 'W/"123"'}):
+            assert is_not_modified("123", 1_000_000_000)
+            assert not is_not_modified("456", 1_000_000_000)
+
+    def test_if_modified_since(self):
+        headers = {"If-Modified-Since": "Thu, 01 Jan 1970 00:00:10 GMT"}
+        with app.test_request_context(headers=headers):
+            assert is_not_modified("123", 10_000_000_000)
+            assert not is_not_modified("123", 11_000_000_000)
+
+    def test_unconditional(self):
+        with app.test_request_context():
+            assert not is_not_modified("123", 1_000_000_000)
+
+
+class TestStamp:
+    def test_stamp(self):
+        """Sets meta.lastUpdated as a UTC instant, keeping the other meta"""
+        resource = {"resourceType": "Patient", "meta": {"versionId": "1"}}
+
+        changes.stamp(resource)
+
+        assert resource["meta"]["versionId"] == "1"
+        assert resource["meta"]["lastUpdated"].endswith("Z")
+        assert len(resource["meta"]["lastUpdated"]) == len("2020-01-01T00:00:00.000Z")
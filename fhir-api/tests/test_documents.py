@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+from fhir_api.documents import DocumentIndex, match_expression
+from fhir_api.errors import BadRequest
+
+
+def read_text(path):
+    """Fake extraction: the test documents are text files"""
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def documents(tmpdir):
+    tmpdir.join("1.pdf").write("Le patient présente un diabète de type 2.")
+    tmpdir.join("2.pdf").write("Pas de diabète. Hypertension artérielle traitée.")
+    tmpdir.mkdir("sub").join("3.pdf").write("Diabete diabete diabete, suivi annuel.")
+    tmpdir.join("notes.txt").write("diabète")
+    return tmpdir
+
+
+@pytest.fixture
+def index(tmpdir_factory):
+    return DocumentIndex(str(tmpdir_factory.mktemp("index").join("index.sqlite")))
+
+
+class TestMatchExpression:
+    def test_terms(self):
+        assert match_expression("diab") == '("diab"*)'
+        assert match_expression('+type "diabète de type 2" -insipide') == (
+            '"type"* AND ("diabète de type 2") NOT "insipide"*'
+        )
+
+    def test_only_forbidden_terms(self):
+        with pytest.raises(BadRequest):
+            match_expression("-diabete")
+
+
+class TestDocumentIndex:
+    def test_search(self, documents, index):
+        """Ranks the matching documents and ignores the accents"""
+        assert index.update(str(documents), extract=read_text).outcomes["added"] == 3
+
+        hits, total = index.search("diabete")
+        assert total == 3
+        assert [hit.name for hit in hits][0] == "3.pdf"
+        assert "diabète de type 2" in {hit.name: hit.snippet for hit in hits}["1.pdf"]
+
+        hits, total = index.search("+diabete -hypertension", count=1)
+        assert total == 2
+        assert len(hits) == 1
+
+    def test_incremental_update(self, documents, index):
+        """Only extracts the added or changed documents"""
+        index.update(str(documents), extract=read_text)
+
+        extracted = []
+
+        def extract(path):
+            extracted.append(os.path.basename(path))
+            return read_text(path)
+
+        documents.join("1.pdf").write("Le patient présente une hypertension.")
+        os.utime(documents.join("2.pdf"), (0, 0))
+        documents.join("sub", "3.pdf").remove()
+        documents.join("4.pdf").write("Nouveau document.")
+
+        assert index.update(str(documents), extract=extract).outcomes == {
+            "added": 1,
+            "updated": 1,
+            "unchanged": 1,
+            "removed": 1,
+            "failed": 0,
+        }
+        assert sorted(extracted) == ["1.pdf", "4.pdf"]
+        assert index.search("hypertension")[1] == 2
+        assert index.search("diabete")[1] == 1
+
+    def test_parallel_extraction(self, documents, index):
+        stats = index.update(str(documents), workers=2, extract=read_text)
+        assert stats.outcomes["added"] == 3
+        assert stats.extracted == 3
+        assert index.search("hypertension")[1] == 1
+
+    def test_text_cache(self, documents, index):
+        """Extracts the documents with the same content once, and reuses the
+        extracted texts when rebuilding the index"""
+        documents.join("copy.pdf").write(documents.join("1.pdf").read())
+        assert index.update(str(documents), extract=read_text).extracted == 3
+
+        def extract(path):
+            raise AssertionError(f"{path} extracted again")
+
+        index.clear()
+        stats = index.update(str(documents), extract=extract)
+        assert stats.outcomes["added"] == 4
+        assert stats.extracted == 0
+        assert index.search("diabete")[1] == 4
+
+    def test_failed_extraction(self, documents, index):
+        """Does not index the documents which could not be extracted, so that
+        they are extracted again on the next update"""
+
+        def extract(path):
+            if path.endswith("2.pdf"):
+                raise ValueError("corrupted file")
+            return read_text(path)
+
+        assert index.update(str(documents), extract=extract).outcomes["failed"] == 1
+        assert index.search("hypertension")[1] == 0
+
+        assert index.update(str(documents), extract=read_text).outcomes["added"] == 1
+        assert index.search("hypertension")[1] == 1
+
+    def test_concurrent_index(self, documents, index):
+        """A file indexed meanwhile by another update keeps its id, no
+        content is left without its file"""
+        path = str(documents.join("1.pdf"))
+        index.index_file(None, "1.pdf", os.stat(path), "hash", read_text(path))
+        index.index_file(None, "1.pdf", os.stat(path), "hash", read_text(path))
+
+        (contents,) = index.connection.execute("SELECT count(*) FROM contents").fetchone()
+        assert contents == 1
+        assert index.search("diabete")[1] == 1
+
+    def test_is_empty(self, documents, index):
+        assert index.is_empty()
+
+        index.update(str(documents), extract=read_text)
+
+        assert not index.is_empty()
@@ -0,0 +1,116 @@
+import io
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+from flask import Flask
+from werkzeug.datastructures import MIMEAccept
+
+from fhir_api import ecrf
+from fhir_api.errors import BadRequest
+
+app = Flask(__name__)
+
+CONFIG_FRONT = {
+    "attributes": [
+        {"officialName": "First name", "customName": "First name"},
+        {"officialName": "Weight", "customName": "Weight"},
+    ],
+    "idPatient": ["p1", "p2"],
+}
+
+
+class TestOutputFormat:
+    def test_format_parameter(self):
+        assert ecrf.output_format("csv", MIMEAccept([("application/json", 1)])) == ecrf.CSV
+        with pytest.raises(BadRequest):
+            ecrf.output_format("xlsx", MIMEAccept())
+
+    @patch("fhir_api.ecrf.pyarrow", object())
+    def test_accept(self):
+        accept = MIMEAccept([(ecrf.CSV, 0.5), (ecrf.PARQUET, 1)])
+        assert ecrf.output_format(None, accept) == ecrf.PARQUET
+        assert ecrf.output_format(None, MIMEAccept([("*/*", 1)])) == ecrf.CSV
+        assert ecrf.output_format(None, MIMEAccept()) == ecrf.CSV
+
+    @patch("fhir_api.ecrf.pyarrow", None)
+    def test_without_pyarrow(self):
+        """Falls back to CSV when pyarrow is not installed"""
+        assert ecrf.output_format(None, MIMEAccept([(ecrf.ARROW, 1)])) == ecrf.CSV
+        with pytest.raises(BadRequest):
+            ecrf.output_format("parquet", MIMEAccept())
+
+
+@pytest.mark.parametrize(
+    "config_front",
+    [
+        [],
+        {"attributes": [], "idPatient": ["p1"]},
+        {"attributes": [{"officialName": "Weight"}], "idPatient": ["p1"]},
+        {"attributes": CONFIG_FRONT["attributes"], "idPatient": []},
+    ],
+)
+def test_validate(config_front):
+    with pytest.raises(BadRequest):
+        ecrf.validate(config_front)
+
+
+@patch("fhir_api.ecrf.get_fhir2ecrf")
+def test_export_csv(mock_get_fhir2ecrf):
+    """Streams the batches of results, with the header in the first one"""
+    mock_get_fhir2ecrf.return_value.column_post_treatments.return_value = {
+        "First name": "first",
+        "Weight": "first",
+    }
+    mock_get_fhir2ecrf.return_value.query_batches.return_value = iter(
+        [
+            pd.DataFrame({"First name": ["Ann", "Ann"], "Weight": [70, 71]}),
+            pd.DataFrame({"First name": ["Bob"], "Weight": [None]}),
+        ]
+    )
+
+    with app.test_request_context():
+        response = ecrf.export(CONFIG_FRONT, ecrf.CSV)
+        chunks = list(response.response)
+
+    assert response.mimetype == ecrf.CSV
+    assert response.headers["Content-Disposition"] == 'attachment; filename="ecrf.csv"'
+    assert chunks == [b"First name,Weight\nAnn,70\nAnn,71\n", b"Bob,\n"]
+
+
+@patch("fhir_api.ecrf.get_fhir2ecrf")
+def test_export_unknown_attribute(mock_get_fhir2ecrf):
+    mock_get_fhir2ecrf.return_value.column_post_treatments.side_effect = ValueError("unknown")
+    with pytest.raises(BadRequest):
+        ecrf.export(CONFIG_FRONT, ecrf.CSV)
+
+
+@pytest.mark.skipif(ecrf.pyarrow is None, reason="pyarrow is not installed")
+def test_export_arrow():
+    batches = [
+        pd.DataFrame({"Weight": [70.5, None], "Amputation": [0, 1]}),
+        pd.DataFrame({"Weight": ["70; 71"], "Amputation": [0]}),
+    ]
+    schema = ecrf.arrow_schema(["Weight", "Amputation"], {"Amputation"})
+    data = b"".join(ecrf.arrow_chunks(iter(batches), schema, ecrf.ARROW))
+
+    table = ecrf.pyarrow.ipc.open_stream(data).read_all()
+    assert table.to_pydict() == {"Weight": ["70.5", None, "70; 71"], "Amputation": [0, 1, 0]}
+
+
+@pytest.mark.skipif(ecrf.pyarrow is None, reason="pyarrow is not installed")
+def test_export_parquet():
+    """Writes a row group per batch, read back as a single table"""
+    batches = [
+        pd.DataFrame({"Weight": [70.5, None], "Amputation": [0, 1]}),
+        pd.DataFrame({"Weight": ["70; 71"], "Amputation": [0]}),
+    ]
+    schema = ecrf.arrow_schema(["Weight", "Amputation"], {"Amputation"})
+    data = b"".join(ecrf.arrow_chunks(iter(batches), schema, ecrf.PARQUET))
+
+    parquet_file = ecrf.pyarrow.parquet.ParquetFile(io.BytesIO(data))
+    assert parquet_file.num_row_groups == 2
+    assert parquet_file.read().to_pydict() == {
+        "Weight": ["70.5", None, "70; 71"],
+        "Amputation": [0, 1, 0],
+    }
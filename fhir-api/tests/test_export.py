@@ -0,0 +1,116 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from fhir_api import jobs
+from fhir_api.errors import BadRequest
+from fhir_api.export import (
+    GROUP,
+    PATIENT,
+    SYSTEM,
+    NDJSONWriter,
+    build_query,
+    get_output_directory,
+    parse_since,
+)
+
+
+class TestNDJSONWriter:
+    def test_files(self, tmpdir):
+        """Writes a file per resource type, capped to max_file_size bytes"""
+        writer = NDJSONWriter(str(tmpdir), max_file_size=40)
+        for i in range(3):
+            writer.write("Patient", {"resourceType": "Patient", "id": str(i)})
+        writer.write("Observation", {"resourceType": "Observation", "id": "0"})
+        writer.close()
+
+        assert writer.outputs == [
+            ("Patient", "Patient.1.ndjson", 1),
+            ("Patient", "Patient.2.ndjson", 1),
+            ("Patient", "Patient.3.ndjson", 1),
+            ("Observation", "Observation.1.ndjson", 1),
+        ]
+        lines = tmpdir.join("Patient.2.ndjson").read().splitlines()
+        assert [json.loads(line) for line in lines] == [{"resourceType": "Patient", "id": "1"}]
+
+
+class TestBuildQuery:
+    def test_system(self):
+        assert build_query(SYSTEM, "Observation") == {}
+        since = "2020-01-01T00:00:00.000Z"
+        assert build_query(SYSTEM, "Observation", since=since) == {
+            "$and": [
+                {
+                    "$or": [
+                        {"meta.lastUpdated": {"$gte": since}},
+                        {"meta.lastUpdated": {"$exists": False}},
+                    ]
+                }
+            ]
+        }
+
+    def test_patient(self):
+        """Exports the resources of the patient compartment"""
+        assert build_query(PATIENT, "Patient") == {}
+        assert build_query(PATIENT, "Observation") == {
+            "$or": [
+                {"subject.reference": {"$regex": "^Patient/"}},
+                {"patient.reference": {"$regex": "^Patient/"}},
+            ]
+        }
+
+    def test_group(self):
+        """Exports the resources of the group members"""
+        patients = ["Patient/1", "Patient/2"]
+        assert build_query(GROUP, "Patient", patients=patients) == {"id": {"$in": ["1", "2"]}}
+        assert build_query(GROUP, "Observation", patients=patients) == {
+            "$or": [
+                {"subject.reference": {"$in": patients}},
+                {"patient.reference": {"$in": patients}},
+            ]
+        }
+
+
+class TestParseSince:
+    def test_instant(self):
+        """Formats the instants as the stamped meta.lastUpdated"""
+        assert parse_since(None) is None
+        assert parse_since("2020-01-01T02:00:00.5+02:00") == "2020-01-01T00:00:00.500Z"
+        assert parse_since("2020-01-01T00:00:00Z") == "2020-01-01T00:00:00.000Z"
+
+    @pytest.mark.parametrize("since", ["2020-01-01", "2020-13-01T00:00:00Z", "yesterday"])
+    def test_invalid(self, since):
+        with pytest.raises(BadRequest, match="Invalid _since"):
+            parse_since(since)
+
+
+class TestGetOutputDirectory:
+    @pytest.fixture
+    def mock_get_job(self):
+        job = {
+            "_id": "id",
+            "kind": "export",
+            "status": jobs.COMPLETED,
+            "params": {"files_url": "http://api/export-file"},
+            "result": {"output": [{"url": "http://api/export-file/id/Patient-1.ndjson"}]},
+        }
+        with patch("fhir_api.export.jobs.get_job", return_value=job) as mock_get_job:
+            yield mock_get_job
+
+    def test_output_file(self, mock_get_job):
+        """Serves the files of the manifest of the job"""
+        assert get_output_directory("id", "Patient-1.ndjson") == jobs.job_path("id")
+
+    def test_not_in_manifest(self, mock_get_job):
+        """Does not serve the other files of the job directory"""
+        assert get_output_directory("id", "input.json") is None
+
+    def test_not_export(self, mock_get_job):
+        """Does not serve the files of the other jobs"""
+        mock_get_job.return_value["kind"] = "upload-bundle"
+        assert get_output_directory("id", "Patient-1.ndjson") is None
+
+    def test_unknown_job(self, mock_get_job):
+        mock_get_job.return_value = None
+        assert get_output_directory("../id", "Patient-1.ndjson") is None
@@ -0,0 +1,125 @@
+import datetime
+import os
+from unittest.mock import MagicMock, patch
+
+import mongomock
+import pytest
+
+from fhir_api import jobs
+
+
+@pytest.fixture
+def mock_collection():
+    with patch("fhir_api.jobs.get_jobs_collection") as mock_get_jobs_collection:
+        yield mock_get_jobs_collection.return_value
+
+
+@pytest.fixture(autouse=True)
+def jobs_data_path(tmpdir):
+    with patch("fhir_api.jobs.settings.JOBS_DATA_PATH", str(tmpdir)):
+        yield tmpdir
+
+
+@pytest.fixture
+def mock_task():
+    with patch.dict(jobs.tasks) as tasks:
+        tasks["test"] = mock = MagicMock()
+        yield mock
+
+
+class TestJobProgress:
+    @patch("fhir_api.jobs.time.monotonic")
+    def test_report(self, mock_monotonic, mock_collection):
+        """Writes the job progress and throughput at most every interval"""
+        mock_monotonic.return_value = 0
+        progress = jobs.JobProgress("id")
+
+        mock_monotonic.return_value = 1
+        progress.report(processed=10)
+        assert mock_collection.update_one.call_count == 0
+
+        mock_monotonic.return_value = 5
+        progress.report(processed=100)
+        mock_collection.update_one.assert_called_once_with(
+            {"_id": "id", "status": jobs.RUNNING},
+            {"$set": {"progress": {"processed": 100, "elapsed": 5, "throughput": 20}}},
+        )
+
+    def test_cancelled(self, mock_collection):
+        """Interrupts the job when it is not running anymore"""
+        mock_collection.update_one.return_value.matched_count = 0
+        progress = jobs.JobProgress("id")
+
+        with pytest.raises(jobs.JobCancelled):
+            progress.report(force=True, processed=1)
+
+
+class TestRunJob:
+    def test_completed(self, mock_collection, mock_task):
+        """Runs the job task and stores its result"""
+        mock_collection.find_one_and_update.return_value = {"kind": "test", "params": {"a": 1}}
+        mock_task.return_value = {"result": True}
+
+        jobs.run_job("id")
+
+        assert mock_task.call_args[1] == {"a": 1}
+        update = mock_collection.update_one.call_args[0][1]["$set"]
+        assert update["status"] == jobs.COMPLETED
+        assert update["result"] == {"result": True}
+
+    def test_failed(self, mock_collection, mock_task):
+        """Stores the error of failed jobs"""
+        mock_collection.find_one_and_update.return_value = {"kind": "test", "params": {}}
+        mock_task.side_effect = ValueError("boom")
+
+        jobs.run_job("id")
+
+        update = mock_collection.update_one.call_args[0][1]["$set"]
+        assert update["status"] == jobs.FAILED
+        assert update["error"] == "boom"
+
+    def test_not_queued(self, mock_collection, mock_task):
+        """Does not run jobs which are not queued anymore"""
+        mock_collection.find_one_and_update.return_value = None
+
+        jobs.run_job("id")
+
+        assert mock_task.call_count == 0
+
+    def test_stale_jobs(self):
+        """Fails the running jobs which stopped recording their heartbeat"""
+        collection = mongomock.MongoClient().db.jobs
+        now = datetime.datetime.utcnow()
+        yesterday = now - datetime.timedelta(days=1)
+        collection.insert_many(
+            [
+                {"_id": "dead", "status": jobs.RUNNING, "heartbeat_at": yesterday},
+                {"_id": "alive", "status": jobs.RUNNING, "heartbeat_at": now},
+            ]
+        )
+
+        with patch("fhir_api.jobs.get_jobs_collection", return_value=collection):
+            jobs.fail_stale_jobs()
+
+        assert collection.find_one({"_id": "dead"})["status"] == jobs.FAILED
+        assert collection.find_one({"_id": "alive"})["status"] == jobs.RUNNING
+
+
+class TestJobFiles:
+    def test_job_path(self, jobs_data_path):
+        """Only creates the job directories for the jobs writing files"""
+        assert jobs.job_path("id") == str(jobs_data_path / "id")
+        assert not (jobs_data_path / "id").exists()
+
+        jobs.get_job_path("id")
+        assert (jobs_data_path / "id").isdir()
+
+    def test_remove_expired_files(self, jobs_data_path, mock_collection):
+        """Removes the files of the jobs expired by the TTL index"""
+        jobs.get_job_path("expired")
+        jobs.get_job_path("finished")
+        mock_collection.find.return_value = [{"_id": "finished"}]
+
+        jobs.remove_expired_files()
+
+        assert sorted(os.listdir(jobs_data_path)) == ["finished"]
@@ -0,0 +1,92 @@
+import os
+from unittest.mock import MagicMock, patch
+
+from fhir_api import loader
+from fhir_api.bundle import BundleLoader
+from fhir_api.loader import DefinitionsLoader, LoadingStats, file_hash
+
+
+def failing_parse_file(path, batch_size):
+    if path.endswith("b.json"):
+        raise ValueError("unexpected")
+    loader.started_queue.put((path, os.getpid()))
+    loader.batches_queue.put((path, None, {"entries": 0, "issues": []}))
+
+
+def dying_parse_file(path, batch_size):
+    loader.started_queue.put((path, os.getpid()))
+    os._exit(1)
+
+
+@patch("fhir_api.loader.get_loaded_files_collection")
+class TestPendingFiles:
+    def test_skips_loaded_files(self, mock_collection, tmpdir):
+        """Skips the files whose content has already been loaded"""
+        tmpdir.join("a.json").write('{"resourceType": "Bundle"}')
+        tmpdir.join("b.json").write('{"resourceType": "Bundle", "entry": []}')
+        loaded_hash = file_hash(str(tmpdir.join("a.json")))
+        mock_collection.return_value.find.return_value = [{"_id": loaded_hash}]
+
+        files = DefinitionsLoader(echo=lambda _: None).pending_files(str(tmpdir))
+
+        assert list(files) == [str(tmpdir.join("b.json"))]
+
+    def test_force(self, mock_collection, tmpdir):
+        """Loads every file when forced to"""
+        tmpdir.join("a.json").write('{"resourceType": "Bundle"}')
+
+        files = DefinitionsLoader(force=True).pending_files(str(tmpdir))
+
+        assert list(files) == [str(tmpdir.join("a.json"))]
+        assert mock_collection.return_value.find.call_count == 0
+
+
+@patch("fhir_api.loader.db.get_store", return_value=MagicMock())
+@patch("fhir_api.loader.get_loaded_files_collection")
+class TestLoad:
+    def make_files(self, tmpdir):
+        tmpdir.join("a.json").write('{"resourceType": "Bundle", "entry": []}')
+        tmpdir.join("b.json").write('{"resourceType": "Bundle"}')
+
+    @patch("fhir_api.loader._parse_file", failing_parse_file)
+    def test_worker_error(self, mock_collection, mock_get_store, tmpdir):
+        """Reports the files whose worker raised, and loads the other ones"""
+        self.make_files(tmpdir)
+
+        results = DefinitionsLoader(workers=2, echo=lambda _: None).load(str(tmpdir))
+
+        assert results["b.json"] == {"error": "unexpected"}
+        assert "error" not in results["a.json"]
+
+    @patch("fhir_api.loader._parse_file", dying_parse_file)
+    def test_dead_worker(self, mock_collection, mock_get_store, tmpdir):
+        """Does not wait for the files whose worker died"""
+        self.make_files(tmpdir)
+
+        results = DefinitionsLoader(workers=1, echo=lambda _: None).load(str(tmpdir))
+
+        assert results == {
+            "a.json": {"error": "the worker process died"},
+            "b.json": {"error": "the worker process died"},
+        }
+
+
+@patch("fhir_api.loader.get_loaded_files_collection")
+class TestFileDone:
+    def test_write_errors(self, mock_collection, tmpdir):
+        """Only records the files whose resources have all been written"""
+        tmpdir.join("a.json").write('{"resourceType": "Bundle"}')
+        path = str(tmpdir.join("a.json"))
+        definitions_loader = DefinitionsLoader(echo=lambda _: None)
+        stats = LoadingStats(1, 0)
+        summary = {"entries": 2, "issues": []}
+
+        writer = BundleLoader(MagicMock(), ["Patient"])
+        writer.duplicates = 1
+        definitions_loader.file_done(path, "hash", writer, summary, stats)
+        assert mock_collection.return_value.replace_one.call_count == 1
+
+        writer = BundleLoader(MagicMock(), ["Patient"])
+        writer.write_errors = 1
+        definitions_loader.file_done(path, "hash", writer, summary, stats)
+        assert mock_collection.return_value.replace_one.call_count == 1
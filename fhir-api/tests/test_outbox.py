@@ -0,0 +1,165 @@
+import datetime
+from unittest.mock import MagicMock, patch
+
+import mongomock
+import pytest
+
+from fhir_api import outbox, settings
+
+
+@pytest.fixture
+def internal_db():
+    internal_db = mongomock.MongoClient().internal
+    with patch("fhir_api.db.get_internal_db", return_value=internal_db), patch(
+        "fhir_api.outbox.start_worker"
+    ), patch.object(settings, "ES_WRITE_BEHIND", True):
+        yield internal_db
+
+
+@pytest.fixture
+def store():
+    store = MagicMock()
+    store.db = mongomock.MongoClient().fhirstore
+    store.db.Patient.insert_many([{"id": "p1", "gender": "male"}, {"id": "p2"}])
+    store.search_engine.get_index_name.return_value = "fhirstore"
+    with patch("fhir_api.db.get_store", return_value=store):
+        yield store
+
+
+@pytest.fixture
+def es():
+    es = MagicMock()
+    with patch("fhir_api.db.get_es_connection", return_value=es):
+        yield es
+
+
+@pytest.fixture
+def bulk(es):
+    """Fake bulk indexing, failing for the resources with a "fail" id"""
+
+    def fake_bulk(es, actions, **kwargs):
+        for action in actions:
+            op_type = action.get("_op_type", "index")
+            if action["_id"].endswith("/fail"):
+                yield False, {op_type: {"_id": action["_id"], "status": 400, "error": "mapping"}}
+            elif op_type == "delete":
+                yield False, {op_type: {"_id": action["_id"], "status": 404}}
+            else:
+                yield True, {op_type: {"_id": action["_id"], "status": 200}}
+
+    with patch("fhir_api.outbox.streaming_bulk", side_effect=fake_bulk) as bulk:
+        yield bulk
+
+
+def sent_actions(bulk):
+    return [action for call in bulk.call_args_list for action in call[0][1]]
+
+
+def test_enqueue_disabled(internal_db):
+    with patch.object(settings, "ES_WRITE_BEHIND", False):
+        assert outbox.enqueue("Patient", ["p1"]) == []
+    assert internal_db.es_outbox.count_documents({}) == 0
+
+
+class TestLease:
+    def test_acquire(self, internal_db):
+        """Excludes the other holders until it expires"""
+        lease, other = outbox.Lease(), outbox.Lease()
+        assert lease.acquire()
+        assert lease.acquire()
+        assert not other.acquire()
+
+        lease.release()
+        assert other.acquire()
+
+    def test_expired(self, internal_db):
+        lease, other = outbox.Lease(duration=-1), outbox.Lease()
+        assert lease.acquire()
+        assert other.acquire()
+
+
+class TestFlusher:
+    def test_flush(self, internal_db, store, bulk):
+        """Indexes the current state of the written resources once, and
+        deletes the missing ones"""
+        entries = outbox.enqueue("Patient", ["p1", "p2", "p1"])
+        entries += outbox.enqueue("Observation", ["deleted"])
+
+        assert outbox.Flusher(batch_size=2).flush() == set(entries)
+        actions = sent_actions(bulk)
+        assert {
+            "_index": "fhirstore",
+            "_id": "Patient/p1",
+            "_source": {"Patient": store.db.Patient.find_one({"id": "p1"}, {"_id": 0})},
+        } in actions
+        assert {
+            "_op_type": "delete",
+            "_index": "fhirstore",
+            "_id": "Observation/deleted",
+        } in actions
+        assert internal_db.es_outbox.count_documents({}) == 0
+        assert internal_db.es_outbox_lease.count_documents({}) == 0
+
+    def test_retry(self, internal_db, store, bulk):
+        """Keeps the resources which could not be indexed, then drops them
+        after ES_OUTBOX_MAX_ATTEMPTS attempts"""
+        outbox.enqueue("Patient", ["p1", "fail"])
+        flusher = outbox.Flusher()
+        with patch.object(settings, "ES_OUTBOX_MAX_ATTEMPTS", 2):
+            assert len(flusher.flush()) == 1
+            assert internal_db.es_outbox.find_one()["attempts"] == 1
+
+            assert flusher.flush() == set()
+        assert internal_db.es_outbox.count_documents({}) == 0
+
+    def test_retry_by_type(self, internal_db, store, bulk):
+        """Keeps only the entry of the failed resource when a resource of
+        another type shares its id"""
+        store.db.Observation.insert_one({"id": "p1"})
+        outbox.enqueue("Patient", ["p1"])
+        outbox.enqueue("Observation", ["p1"])
+        bulk.side_effect = None
+        bulk.return_value = [
+            (False, {"index": {"_id": "Patient/p1", "status": 400, "error": "mapping"}}),
+            (True, {"index": {"_id": "Observation/p1", "status": 200}}),
+        ]
+
+        assert len(outbox.Flusher().flush()) == 1
+        retried = internal_db.es_outbox.find_one()
+        assert (retried["resource_type"], retried["id"]) == ("Patient", "p1")
+        assert internal_db.es_outbox.count_documents({}) == 1
+
+    def test_held_lease(self, internal_db, store, bulk):
+        outbox.enqueue("Patient", ["p1"])
+        assert outbox.Lease().acquire()
+        assert outbox.Flusher().flush() == set()
+        bulk.assert_not_called()
+
+
+class TestWait:
+    def test_wait(self, internal_db, store, es, bulk):
+        """Flushes the entries with refresh=wait_for"""
+        entries = outbox.enqueue("Patient", ["p1"])
+        assert outbox.wait(entries)
+        assert bulk.call_args[1]["refresh"] == "wait_for"
+        es.indices.refresh.assert_not_called()
+
+    def test_flushed_by_worker(self, internal_db, store, es, bulk):
+        """Refreshes the index when the entries were flushed by the worker"""
+        entries = outbox.enqueue("Patient", ["p1"])
+        internal_db.es_outbox_lease.insert_one(
+            {"_id": "flusher", "owner": "worker", "until": datetime.datetime.max}
+        )
+        with patch(
+            "fhir_api.outbox.time.sleep",
+            side_effect=lambda _: internal_db.es_outbox.delete_many({}),
+        ):
+            assert outbox.wait(entries)
+        es.indices.refresh.assert_called_once_with(index="fhirstore")
+
+    def test_timeout(self, internal_db, store, es, bulk):
+        entries = outbox.enqueue("Patient", ["p1"])
+        internal_db.es_outbox_lease.insert_one(
+            {"_id": "flusher", "owner": "worker", "until": datetime.datetime.max}
+        )
+        assert not outbox.wait(entries, timeout=0.01)
@@ -0,0 +1,200 @@
+from unittest.mock import MagicMock, patch
+
+import mongomock
+import pytest
+from pymongo.errors import OperationFailure
+
+from fhir_api import reindex
+
+ALIAS = "fhirstore"
+
+
+class FakeStream:
+    """Change stream yielding the given changes, then None"""
+
+    def __init__(self, changes=(), resume_token=None):
+        self.changes = list(changes)
+        self.resume_token = resume_token
+
+    def try_next(self):
+        if not self.changes:
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = change["_id"]
+        return change
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def change(token, collection, id):
+    return {"_id": token, "ns": {"coll": collection}, "fullDocument": {"id": id}}
+
+
+@pytest.fixture
+def reindex_collection():
+    collection = mongomock.MongoClient().db.es_reindex
+    with patch("fhir_api.reindex.get_reindex_collection", return_value=collection):
+        yield collection
+
+
+@pytest.fixture
+def store():
+    store = MagicMock()
+    store.db = mongomock.MongoClient().fhirstore
+    store.db.Patient.insert_many([{"id": "p1"}, {"id": "p2"}])
+    store.db.Observation.insert_many([{"id": "o1"}, {"id": "p1"}])
+    store.db.watch = MagicMock(return_value=FakeStream(resume_token="start"))
+    store.search_engine.get_index_name.return_value = ALIAS
+    return store
+
+
+@pytest.fixture
+def es():
+    es = MagicMock()
+    es.indices.get.return_value = {
+        "fhirstore-1": {
+            "settings": {
+                "index": {"number_of_shards": "2", "uuid": "x", "analysis": {"analyzer": {}}}
+            },
+            "mappings": {"properties": {}},
+        }
+    }
+    es.indices.get_alias.return_value = {"fhirstore-1": {"aliases": {ALIAS: {}}}}
+    es.indices.get_settings.return_value = {
+        "fhirstore-1": {"settings": {"index": {"number_of_replicas": "1"}}}
+    }
+    return es
+
+
+@pytest.fixture
+def indexed():
+    """Ids of the resources sent to parallel_bulk"""
+    ids = []
+
+    def fake_bulk(es, actions, **kwargs):
+        for action in actions:
+            ids.append(action["_id"])
+            yield True, {"index": {"_id": action["_id"]}}
+
+    with patch("fhir_api.reindex.parallel_bulk", side_effect=fake_bulk):
+        yield ids
+
+
+@pytest.fixture
+def reindexer(store, es, reindex_collection, indexed):
+    models = {"Patient": None, "Observation": None}
+    with patch("fhir_api.db.get_store", return_value=store), patch(
+        "fhir_api.db.get_es_connection", return_value=es
+    ), patch.dict("fhir_api.reindex.resources_models", models):
+        yield reindex.Reindexer(workers=2, threads=1, chunk_size=1, echo=lambda _: None)
+
+
+def test_index_body(es):
+    """Keeps the analysis and mappings, not the uuid, and disables the
+    refreshes and replicas"""
+    assert reindex.index_body(es, ALIAS) == {
+        "settings": {
+            "index": {
+                "number_of_shards": "2",
+                "analysis": {"analyzer": {}},
+                "refresh_interval": "-1",
+                "number_of_replicas": 0,
+            }
+        },
+        "mappings": {"properties": {}},
+    }
+
+
+class TestReindexer:
+    def test_run(self, reindexer, es, reindex_collection, indexed):
+        """Loads the collections in a new index, then swaps the alias. The
+        resources of different types sharing an id are distinct documents"""
+        result = reindexer.run()
+
+        index = result["index"]
+        assert index.startswith(f"{ALIAS}-")
+        es.indices.create.assert_called_once()
+        assert result["previous"] == ["fhirstore-1"]
+        assert sorted(indexed) == ["Observation/o1", "Observation/p1", "Patient/p1", "Patient/p2"]
+        assert result["processed"] == 4
+        es.indices.update_aliases.assert_called_once_with(
+            body={
+                "actions": [
+                    {"remove": {"index": "fhirstore-1", "alias": ALIAS}},
+                    {"add": {"index": index, "alias": ALIAS}},
+                ]
+            }
+        )
+        es.indices.delete.assert_called_once_with(index="fhirstore-1", ignore=[404])
+        assert reindex_collection.count_documents({}) == 0
+
+    def test_resume(self, reindexer, es, reindex_collection, indexed):
+        """Skips the collections already loaded in the index in progress"""
+        reindex_collection.insert_one(
+            {
+                "_id": ALIAS,
+                "index": "fhirstore-2",
+                "loaded": {"Patient": {"documents": 2, "errors": 0}},
+                "started_at": "2030-01-01T00:00:00",
+                "resume_token": "start",
+            }
+        )
+        result = reindexer.run()
+
+        assert result["index"] == "fhirstore-2"
+        es.indices.create.assert_not_called()
+        assert indexed == ["Observation/o1", "Observation/p1"]
+
+    def test_catch_up(self, reindexer, store, indexed):
+        """Indexes again the resources written since the start of the
+        reindex, then the ones written until the swap"""
+        store.db.watch.side_effect = [
+            FakeStream(resume_token="start"),
+            FakeStream([change("1", "Patient", "p2"), change("2", "Encounter", "e1")]),
+            FakeStream([change("3", "Observation", "o1")]),
+        ]
+        reindexer.run()
+
+        resume_after = [call[1].get("resume_after") for call in store.db.watch.call_args_list]
+        assert resume_after == [None, "start", "2"]
+        assert sorted(indexed) == [
+            "Observation/o1",
+            "Observation/o1",
+            "Observation/p1",
+            "Patient/p1",
+            "Patient/p2",
+            "Patient/p2",
+        ]
+
+    def test_catch_up_history_lost(self, reindexer, store):
+        """Loads all the collections again when the changes are lost"""
+        store.db.watch.side_effect = [
+            OperationFailure("history lost", code=286),
+            FakeStream(resume_token="reload"),
+        ]
+        stats = reindex.ReindexStats(2)
+
+        assert reindexer.catch_up("fhirstore-2", ["Observation", "Patient"], "start", stats) == (
+            "reload"
+        )
+        assert stats.documents == 4
+
+    def test_swap_concrete_index(self, reindexer, es, reindex_collection):
+        """Replaces the index named like the alias (before the first
+        reindex) in the same atomic operation"""
+        es.indices.exists_alias.return_value = False
+        es.indices.exists.return_value = True
+
+        assert reindexer.swap("fhirstore-2") == []
+        es.indices.update_aliases.assert_called_once_with(
+            body={
+                "actions": [
+                    {"remove_index": {"index": ALIAS}},
+                    {"add": {"index": "fhirstore-2", "alias": ALIAS}},
+                ]
+            }
+        )
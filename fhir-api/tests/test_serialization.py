@@ -0,0 +1,63 @@
+import datetime
+import json
+from decimal import Decimal
+
+from bson import ObjectId
+from fhir.resources.encounter import Encounter
+from fhir.resources.patient import Patient
+from flask import Flask
+from flask import json as flask_json
+
+from fhir_api.serialization import JSONEncoder, dumps, jsonify
+
+
+class TestDumps:
+    def test_types(self):
+        data = {
+            "_id": ObjectId("5f4f5e5c9d1b2c3d4e5f6a7b"),
+            "date": datetime.datetime(2021, 1, 2, 3, 4, 5),
+            "value": Decimal("1.5"),
+        }
+        assert json.loads(dumps(data)) == {
+            "_id": "5f4f5e5c9d1b2c3d4e5f6a7b",
+            "date": "2021-01-02T03:04:05",
+            "value": 1.5,
+        }
+
+    def test_decimal_precision(self):
+        """Keeps the digits of the decimals"""
+        data = {"value": Decimal("1.50"), "small": Decimal("1E-7")}
+        assert dumps(data) == b'{"value":1.50,"small":1E-7}'
+        assert json.loads(dumps(data), parse_float=Decimal) == data
+
+    def test_models(self):
+        """Serializes the FHIR models as their dict()"""
+        patient = Patient(
+            id="1", birthDate="2000-01-01", name=[{"family": "Doe", "given": ["John"]}]
+        )
+        encounter = Encounter.parse_obj(
+            {"resourceType": "Encounter", "status": "planned", "class": {"code": "IMP"}}
+        )
+
+        assert json.loads(dumps(patient)) == json.loads(patient.json())
+        assert json.loads(dumps(encounter)) == json.loads(encounter.json())
+        assert json.loads(dumps({"resource": patient}))["resource"]["resourceType"] == "Patient"
+
+
+class TestFlask:
+    def test_jsonify(self):
+        app = Flask(__name__)
+        with app.app_context():
+            response = jsonify({"a": 1})
+
+        assert response.mimetype == "application/json"
+        assert json.loads(response.data) == {"a": 1}
+
+    def test_encoder(self):
+        """The flask helpers use orjson"""
+        app = Flask(__name__)
+        app.json_encoder = JSONEncoder
+        with app.app_context():
+            assert flask_json.loads(
+                flask_json.dumps({"_id": ObjectId("5f4f5e5c9d1b2c3d4e5f6a7b")})
+            ) == {"_id": "5f4f5e5c9d1b2c3d4e5f6a7b"}
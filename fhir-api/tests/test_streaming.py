@@ -0,0 +1,38 @@
+import json
+
+from fhir_api.streaming import bundle_chunks, ndjson_lines
+
+
+def make_bundle():
+    return {
+        "resourceType": "Bundle",
+        "total": 2,
+        "entry": [
+            {"resource": {"resourceType": "Patient", "id": "1"}, "search": {"mode": "match"}},
+            {"resource": {"resourceType": "Patient", "id": "2"}, "search": {"mode": "match"}},
+        ],
+    }
+
+
+class TestStreaming:
+    def test_bundle_chunks(self):
+        """The concatenated chunks are the serialized bundle"""
+        chunks = list(bundle_chunks(make_bundle()))
+
+        assert len(chunks) == 4
+        assert json.loads(b"".join(chunks)) == make_bundle()
+
+    def test_bundle_chunks_no_entries(self):
+        """Empty bundles have no entry array"""
+        chunks = bundle_chunks({"resourceType": "Bundle", "total": 0})
+
+        assert json.loads(b"".join(chunks)) == {"resourceType": "Bundle", "total": 0}
+
+    def test_ndjson_lines(self):
+        lines = list(ndjson_lines(make_bundle()))
+
+        assert [json.loads(line) for line in lines] == [
+            {"resourceType": "Patient", "id": "1"},
+            {"resourceType": "Patient", "id": "2"},
+        ]
+        assert all(line.endswith(b"\n") for line in lines)